@@ -5,7 +5,12 @@ from anthill.common.validate import validate
 from anthill.common import access
 
 from . model.access import NoAccessData
-from . model.profile import ProfileError, NoSuchProfileError, ProfileQueryError
+from . model.profile import ProfileError, NoSuchProfileError, ProfileQueryError, ProfileQueryTooExpensive
+from . model.job import JobError, NoSuchJobError
+from . model.lookup import LookupFieldError
+from . model.counters import CounterFieldError
+
+from tornado.ioloop import IOLoop
 
 import json
 
@@ -67,6 +72,12 @@ class GamespaceAccessController(a.AdminController):
                                      access_protected.split(","),
                                      access_public.split(","))
 
+        try:
+            await self.application.jobs.submit_public_rebuild(self.gamespace)
+        except JobError as e:
+            raise a.ActionError("Access has been updated, but the public profiles could not be rebuilt: " +
+                                str(e))
+
         result = {
             "access_private": access_private,
             "access_public": access_public,
@@ -222,15 +233,36 @@ class QueryProfilesController(a.AdminController):
                                             for the query format.
                                          """),
             }, methods={
-                "do_query": a.method("Search", "primary")
+                "do_query": a.method("Search", "primary"),
+                "do_query_job": a.method("Run in background", "default")
             }, data=data),
             a.links("Navigate", [
-                a.link("index", "Go back", icon="chevron-left")
+                a.link("index", "Go back", icon="chevron-left"),
+                a.link("query_jobs", "Background jobs", icon="tasks"),
+                a.link("slow_queries", "Slow queries", icon="clock-o")
             ])
         ])
 
         return r
 
+    @validate(query="load_json_dict")
+    async def do_query_job(self, query):
+
+        if not query:
+            raise a.ActionError("Query cannot be an empty object")
+
+        jobs = self.application.jobs
+
+        try:
+            job_id = await jobs.submit_query(self.gamespace, query)
+        except (ProfileQueryError, JobError) as e:
+            raise a.ActionError(str(e))
+
+        raise a.Redirect(
+            "query_job",
+            message="Query has been scheduled",
+            job_id=job_id)
+
     @validate(query="load_json_dict")
     async def do_query(self, query):
 
@@ -245,6 +277,17 @@ class QueryProfilesController(a.AdminController):
 
         try:
             results, count = await q.query(count=True)
+        except ProfileQueryTooExpensive:
+            # the query is still going to be run, just without hurting anybody
+            try:
+                job_id = await self.application.jobs.submit_query(self.gamespace, query)
+            except (ProfileQueryError, JobError) as e:
+                raise a.ActionError(str(e))
+
+            raise a.Redirect(
+                "query_job",
+                message="The query is too expensive to be run right away, so it has been scheduled",
+                job_id=job_id)
         except ProfileQueryError as e:
             raise a.ActionError(str(e))
 
@@ -286,13 +329,689 @@ class QueryProfilesController(a.AdminController):
         raise a.Redirect("profile", account=account["id"])
 
 
+class QueryJobsController(a.AdminController):
+    async def get(self):
+        jobs = self.application.jobs
+
+        return {
+            "jobs": await jobs.list_jobs(self.gamespace)
+        }
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([
+                a.link("query", "Query User Profiles")
+            ], "Background jobs"),
+            a.content("Background jobs", [
+                {
+                    "id": "id",
+                    "title": "Job"
+                },
+                {
+                    "id": "kind",
+                    "title": "Kind"
+                },
+                {
+                    "id": "status",
+                    "title": "Status"
+                },
+                {
+                    "id": "progress",
+                    "title": "Profiles scanned"
+                },
+                {
+                    "id": "found",
+                    "title": "Found / affected"
+                },
+                {
+                    "id": "created",
+                    "title": "Created"
+                }
+            ], [
+                {
+                    "id": [
+                        a.link("query_job", job.job_id, icon="tasks", job_id=job.job_id)
+                    ],
+                    "kind": job.kind,
+                    "status": job.status,
+                    "progress": str(job.processed),
+                    "found": str(job.affected),
+                    "created": str(job.created)
+                } for job in data["jobs"]
+            ], "default", empty="There are no background jobs"),
+            a.links("Navigate", [
+                a.link("query", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["profile_admin"]
+
+
+class QueryJobController(a.AdminController):
+    @validate(job_id="int", after="int")
+    async def get(self, job_id, after=0):
+        jobs = self.application.jobs
+
+        try:
+            job = await jobs.get_job(self.gamespace, job_id)
+            if job.kind == jobs.KIND_QUERY:
+                job, results = await jobs.get_query_results(self.gamespace, job_id, after=after, limit=100)
+            else:
+                results = []
+        except NoSuchJobError:
+            raise a.ActionError("No such job")
+
+        return {
+            "job": job,
+            "results": results
+        }
+
+    def render(self, data):
+        job = data["job"]
+        results = data["results"]
+
+        title = "{0} job {1}".format(job.kind.capitalize(), job.job_id)
+
+        r = [
+            a.breadcrumbs([
+                a.link("query", "Query User Profiles"),
+                a.link("query_jobs", "Background jobs")
+            ], title),
+            a.form(title, fields={
+                "query": a.field("Job arguments", "readonly", "primary"),
+                "status": a.field("Status", "readonly", "primary"),
+                "processed": a.field("Profiles scanned", "readonly", "primary"),
+                "found": a.field("Profiles found / affected", "readonly", "primary"),
+                "error": a.field("Error", "readonly", "primary")
+            }, methods={
+                "cancel": a.method("Cancel", "danger"),
+                "delete": a.method("Delete", "danger")
+            }, data={
+                "query": json.dumps(job.args),
+                "status": job.status,
+                "processed": str(job.processed),
+                "found": str(job.affected),
+                "error": job.error or ""
+            })
+        ]
+
+        if job.kind == self.application.jobs.KIND_QUERY:
+            r.append(a.content("Results", [
+                {
+                    "id": "account_id",
+                    "title": "Account"
+                },
+                {
+                    "id": "profile",
+                    "title": "Profile Object"
+                }
+            ], [
+                {
+                    "account_id": [
+                        a.link("profile", result.account, icon="user", account=result.account)
+                    ],
+                    "profile": [
+                        a.json_view(result.profile)
+                    ],
+                } for result in results
+            ], "default", empty="No results yet"))
+
+        navigate = [
+            a.link("query_jobs", "Go back", icon="chevron-left")
+        ]
+
+        if results:
+            navigate.append(a.link("query_job", "Next page", icon="chevron-right",
+                                   job_id=job.job_id, after=results[-1].account))
+
+        r.append(a.links("Navigate", navigate))
+        return r
+
+    def access_scopes(self):
+        return ["profile_admin"]
+
+    async def cancel(self, **ignored):
+        job_id = self.context.get("job_id")
+        await self.application.jobs.cancel_job(self.gamespace, job_id)
+
+        raise a.Redirect(
+            "query_job",
+            message="Job has been cancelled",
+            job_id=job_id)
+
+    async def delete(self, **ignored):
+        job_id = self.context.get("job_id")
+        await self.application.jobs.delete_job(self.gamespace, job_id)
+
+        raise a.Redirect(
+            "query_jobs",
+            message="Job has been deleted")
+
+
+class ArchiveController(a.AdminController):
+    async def get(self):
+        archive = self.application.archive
+
+        settings = await archive.get_settings(self.gamespace)
+        archived = await archive.get_archived_count(self.gamespace)
+
+        return {
+            "archive_after_days": settings.archive_after_days,
+            "archived": str(archived)
+        }
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Profile archive"),
+            a.form("Archive inactive profiles", fields={
+                "archive_after_days": a.field(
+                    "Archive the profiles nobody has updated for this many days (0 to never archive). "
+                    "Archived profiles are restored automatically once requested, but are not found by queries.",
+                    "text", "primary", "number"),
+                "archived": a.field("Profiles in the archive", "readonly", "primary")
+            }, methods={
+                "update": a.method("Update", "primary")
+            }, data=data),
+            a.links("Navigate", [
+                a.link("@back", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["profile_admin"]
+
+    @validate(archive_after_days="int")
+    async def update(self, archive_after_days, **ignored):
+        if archive_after_days < 0:
+            raise a.ActionError("Should be a positive number")
+
+        await self.application.archive.set_settings(self.gamespace, archive_after_days)
+
+        raise a.Redirect("archive", message="Settings have been updated")
+
+
+class QuotasController(a.AdminController):
+    async def get(self):
+        quotas = self.application.quotas
+
+        quota = await quotas.get_quota(self.gamespace)
+        report = await quotas.get_report(self.gamespace)
+
+        return {
+            "max_size": quota.max_size,
+            "paths": quota.paths,
+            "report": report
+        }
+
+    @staticmethod
+    def __format_size__(size):
+        for unit in ["bytes", "KB", "MB"]:
+            if size < 1024:
+                return "{0} {1}".format(int(size), unit)
+            size /= 1024.0
+        return "{0:.1f} GB".format(size)
+
+    def render(self, data):
+        report = data["report"]
+
+        result = [
+            a.breadcrumbs([], "Profile quotas"),
+            a.form("Limit the size of the profiles", fields={
+                "max_size": a.field(
+                    "Maximum size of a profile, in bytes (0 for unlimited)", "text", "primary", "number"),
+                "paths": a.field(
+                    "Maximum sizes of the parts of a profile, in bytes", "json", "primary", height=120,
+                    description="""
+                        For example: {"mail": 65536, "logs/battles": 16384}.
+                        The profiles that already exceed the quota may only shrink.
+                    """)
+            }, methods={
+                "update": a.method("Update", "primary")
+            }, data={
+                "max_size": data["max_size"],
+                "paths": data["paths"]
+            })
+        ]
+
+        if report:
+            result.extend([
+                a.content("Profile sizes (storage size, sampled at {0}: {1} profiles, {2} in total)".format(
+                    report.time, report.count, QuotasController.__format_size__(report.total)), [
+                    {
+                        "id": "size",
+                        "title": "Size"
+                    },
+                    {
+                        "id": "count",
+                        "title": "Profiles"
+                    }
+                ], [
+                    {
+                        "size": "up to " + QuotasController.__format_size__(bucket["max"])
+                        if bucket["max"] else "more",
+                        "count": bucket["count"]
+                    }
+                    for bucket in report.histogram
+                ], "default"),
+                a.content("Largest profiles", [
+                    {
+                        "id": "account",
+                        "title": "Account"
+                    },
+                    {
+                        "id": "size",
+                        "title": "Size"
+                    }
+                ], [
+                    {
+                        "account": [
+                            a.link("profile", entry["account"], icon="user", account=entry["account"])
+                        ],
+                        "size": QuotasController.__format_size__(entry["size"])
+                    }
+                    for entry in report.largest
+                ], "default", empty="No profiles")
+            ])
+
+        result.extend([
+            a.form("Sample the sizes of the profiles (in the background, the report is updated once done)",
+                   fields={}, methods={
+                       "sample": a.method("Sample now", "default")
+                   }, data={}),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ])
+
+        return result
+
+    def access_scopes(self):
+        return ["profile_admin"]
+
+    @validate(max_size="int", paths="load_json_dict")
+    async def update(self, max_size=0, paths=None, **ignored):
+        try:
+            await self.application.quotas.set_quota(self.gamespace, max_size, paths or {})
+        except ProfileError as e:
+            raise a.ActionError(e.message)
+
+        raise a.Redirect("quotas", message="Quotas have been updated")
+
+    async def sample(self, **ignored):
+        IOLoop.current().spawn_callback(self.application.quotas.sample_gamespace, self.gamespace)
+        raise a.Redirect("quotas", message="The sizes are being sampled, refresh the page later")
+
+
+class LookupFieldsController(a.AdminController):
+    async def get(self):
+        fields = await self.application.lookup.get_fields(self.gamespace)
+
+        return {
+            "fields": fields
+        }
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Lookup fields"),
+            a.content("Lookup fields", [
+                {
+                    "id": "path",
+                    "title": "Field"
+                },
+                {
+                    "id": "unique",
+                    "title": "Unique"
+                }
+            ], [
+                {
+                    "path": field.path,
+                    "unique": "yes" if field.unique else "no"
+                }
+                for field in data["fields"]
+            ], "default", empty="No lookup fields"),
+            a.form("Add a lookup field", fields={
+                "path": a.field("Profile field path, for example: nickname or social/friend_code", "text", "primary"),
+                "unique": a.field("Unique (no two profiles may have the same value)", "switch", "primary")
+            }, methods={
+                "add": a.method("Add", "primary")
+            }, data={"unique": "false"}),
+            a.form("Remove a lookup field", fields={
+                "path": a.field("Profile field path", "text", "primary")
+            }, methods={
+                "remove": a.method("Remove", "danger")
+            }, data={}),
+            a.form("Index the existing profiles (in the background)", fields={}, methods={
+                "rebuild": a.method("Rebuild the index", "default")
+            }, data={}),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left"),
+                a.link("query_jobs", "Background jobs", icon="tasks")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["profile_admin"]
+
+    @validate(path="str", unique="bool")
+    async def add(self, path, unique=False, **ignored):
+        try:
+            await self.application.lookup.add_field(self.gamespace, path, unique)
+        except LookupFieldError as e:
+            raise a.ActionError(str(e))
+
+        await self.rebuild()
+
+    @validate(path="str")
+    async def remove(self, path, **ignored):
+        await self.application.lookup.delete_field(self.gamespace, path)
+        raise a.Redirect("lookup_fields", message="Lookup field has been removed")
+
+    async def rebuild(self, **ignored):
+        try:
+            job_id = await self.application.jobs.submit_lookup_rebuild(self.gamespace)
+        except JobError as e:
+            raise a.ActionError(str(e))
+
+        raise a.Redirect("query_job", message="The index is being rebuilt", job_id=job_id)
+
+
+class CounterFieldsController(a.AdminController):
+    async def get(self):
+        fields = await self.application.counters.get_fields(self.gamespace)
+
+        return {
+            "fields": fields
+        }
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Counter fields"),
+            a.content("Counter fields", [
+                {
+                    "id": "path",
+                    "title": "Field"
+                },
+                {
+                    "id": "shards",
+                    "title": "Shards"
+                }
+            ], [
+                {
+                    "path": field.path,
+                    "shards": field.shards
+                }
+                for field in data["fields"]
+            ], "default", empty="No counter fields"),
+            a.form("Add a counter field", fields={
+                "path": a.field(
+                    "Profile field path, for example: contribution or events/summer/score", "text", "primary",
+                    description="""
+                        The increments of the field ({"@func": "++", "@value": 1}) are spread across the shards
+                        instead of locking the profile, and are folded into the profile in the background.
+                    """),
+                "shards": a.field("Number of shards (more for the fields incremented by many at once)",
+                                  "text", "primary", "number")
+            }, methods={
+                "add": a.method("Add", "primary")
+            }, data={"shards": "8"}),
+            a.form("Remove a counter field (the pending increments are folded into the profiles first)", fields={
+                "path": a.field("Profile field path", "text", "primary")
+            }, methods={
+                "remove": a.method("Remove", "danger")
+            }, data={}),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["profile_admin"]
+
+    @validate(path="str", shards="int")
+    async def add(self, path, shards=8, **ignored):
+        try:
+            await self.application.counters.add_field(self.gamespace, path, shards)
+        except CounterFieldError as e:
+            raise a.ActionError(str(e))
+
+        raise a.Redirect("counter_fields", message="Counter field has been added")
+
+    @validate(path="str")
+    async def remove(self, path, **ignored):
+        await self.application.counters.delete_field(self.gamespace, path)
+        raise a.Redirect("counter_fields", message="Counter field has been removed")
+
+
+class MigrationController(a.AdminController):
+    async def get(self):
+        return {
+            "steps": [],
+            "dry_run": "true",
+            "batch_delay": "0"
+        }
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Migrate profiles"),
+            a.form("Transform the profiles of the gamespace in the background", fields={
+                "steps": a.field(
+                    "Steps, applied in order", "json", "primary", "non-empty", height=200,
+                    description="""
+                        A list of: {"op": "rename", "from": "coins", "to": "gold"},
+                        {"op": "move", "from": "coins", "to": "currency/soft"},
+                        {"op": "delete", "path": "event_2026_summer"},
+                        {"op": "default", "path": "settings/sound", "value": true}.
+                        The archived profiles are not migrated.
+                    """),
+                "dry_run": a.field("Dry run (only count the profiles that would be changed)", "switch", "primary"),
+                "batch_delay": a.field("Extra delay between the batches (in seconds), to throttle the migration",
+                                       "text", "primary", "number")
+            }, methods={
+                "run": a.method("Run", "danger")
+            }, data=data),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left"),
+                a.link("query_jobs", "Background jobs", icon="tasks")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["profile_admin"]
+
+    @validate(steps="load_json", dry_run="bool", batch_delay="float")
+    async def run(self, steps, dry_run=False, batch_delay=0, **ignored):
+        try:
+            job_id = await self.application.jobs.submit_migration(
+                self.gamespace, steps, dry_run=dry_run, batch_delay=batch_delay)
+        except JobError as e:
+            raise a.ActionError(str(e))
+
+        raise a.Redirect("query_job", message="Migration has been scheduled", job_id=job_id)
+
+
+class CloneController(a.AdminController):
+    async def get(self):
+        return {
+            "target": "",
+            "fields": "",
+            "exclude": "",
+            "anonymize": "",
+            "overwrite": "false",
+            "batch_delay": "0"
+        }
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Clone profiles"),
+            a.form("Copy the profiles of the gamespace into another gamespace in the background", fields={
+                "target": a.field(
+                    "Target gamespace ID", "text", "primary", "number",
+                    description="The access of the gamespace is copied as well. "
+                                "The archived profiles are not copied."),
+                "fields": a.field(
+                    "Top-level fields to copy (everything is copied if empty)", "tags", "primary"),
+                "exclude": a.field("Paths to strip from the copies", "tags", "primary"),
+                "anonymize": a.field(
+                    "Paths to anonymize (the values are replaced with their hashes)", "tags", "primary"),
+                "overwrite": a.field(
+                    "Overwrite the profiles that already exist in the target gamespace", "switch", "primary"),
+                "batch_delay": a.field("Extra delay between the batches (in seconds), to throttle the copy",
+                                       "text", "primary", "number")
+            }, methods={
+                "run": a.method("Clone", "danger")
+            }, data=data),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left"),
+                a.link("query_jobs", "Background jobs", icon="tasks")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["profile_admin"]
+
+    @validate(target="int", fields="str", exclude="str", anonymize="str", overwrite="bool", batch_delay="float")
+    async def run(self, target, fields="", exclude="", anonymize="", overwrite=False, batch_delay=0, **ignored):
+
+        def paths(value):
+            return [path for path in value.split(",") if path]
+
+        try:
+            job_id = await self.application.jobs.submit_clone(
+                self.gamespace, target, fields=paths(fields), exclude=paths(exclude), anonymize=paths(anonymize),
+                overwrite=overwrite, batch_delay=batch_delay)
+        except JobError as e:
+            raise a.ActionError(str(e))
+
+        raise a.Redirect("query_job", message="Clone has been scheduled", job_id=job_id)
+
+
+class SlowQueriesController(a.AdminController):
+    async def get(self):
+        guard = self.application.guard
+
+        return {
+            "queries": guard.get_log(),
+            "max_rows": guard.max_rows,
+            "slow_time": guard.slow_time
+        }
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([
+                a.link("query", "Query User Profiles")
+            ], "Slow queries"),
+            a.content("Recent slow and rejected queries on this worker "
+                      "(slower than {0}s, or estimated to examine more than {1} rows)".format(
+                          data["slow_time"], data["max_rows"] or "any"), [
+                {
+                    "id": "time",
+                    "title": "Time"
+                },
+                {
+                    "id": "gamespace",
+                    "title": "Gamespace"
+                },
+                {
+                    "id": "status",
+                    "title": "Status"
+                },
+                {
+                    "id": "duration",
+                    "title": "Duration"
+                },
+                {
+                    "id": "estimate",
+                    "title": "Rows estimate"
+                },
+                {
+                    "id": "plan",
+                    "title": "Plan"
+                },
+                {
+                    "id": "filters",
+                    "title": "Query"
+                }
+            ], [
+                {
+                    "time": str(query.time),
+                    "gamespace": str(query.gamespace_id),
+                    "status": query.status,
+                    "duration": "{0:.3f}s".format(query.duration) if query.duration is not None else "-",
+                    "estimate": str(query.estimate) if query.estimate is not None else "-",
+                    "plan": query.summary(),
+                    "filters": [
+                        a.json_view(query.filters or {})
+                    ]
+                }
+                for query in data["queries"]
+            ], "default", empty="No slow queries yet"),
+            a.links("Navigate", [
+                a.link("query", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["profile_admin"]
+
+
+class WorkersController(a.AdminController):
+    async def get(self):
+        workers = self.application.workers
+
+        return {
+            "workers": workers.alive_workers(),
+            "stats": workers.aggregate_stats()
+        }
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Service workers"),
+            a.content("Counters across {0} worker(s) of this node".format(data["workers"]), [
+                {
+                    "id": "group",
+                    "title": "Group"
+                },
+                {
+                    "id": "name",
+                    "title": "Counter"
+                },
+                {
+                    "id": "value",
+                    "title": "Value"
+                }
+            ], [
+                {
+                    "group": group,
+                    "name": name,
+                    "value": str(value)
+                }
+                for group, counters in sorted(data["stats"].items())
+                for name, value in sorted(counters.items())
+            ], "default", empty="No counters yet"),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["profile_admin"]
+
+
 class RootAdminController(a.AdminController):
     def render(self, data):
         return [
             a.links("Profile service", [
                 a.link("profiles", "Edit User Profiles", icon="user"),
                 a.link("query", "Query User Profiles", icon="search"),
-                a.link("access", "Edit Profile Access", icon="lock")
+                a.link("access", "Edit Profile Access", icon="lock"),
+                a.link("archive", "Profile Archive", icon="archive"),
+                a.link("lookup_fields", "Lookup Fields", icon="key"),
+                a.link("migration", "Migrate Profiles", icon="exchange"),
+                a.link("clone", "Clone Profiles", icon="clone"),
+                a.link("quotas", "Profile Quotas", icon="balance-scale"),
+                a.link("counter_fields", "Counter Fields", icon="calculator"),
+                a.link("workers", "Service Workers", icon="server")
             ])
         ]
 
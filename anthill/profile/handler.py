@@ -1,17 +1,65 @@
 
 from anthill.common import handler, access
-from tornado.web import HTTPError
+from tornado.web import HTTPError, RequestHandler
+from tornado.ioloop import IOLoop
 
 from anthill.common.access import scoped, internal
 from anthill.common.internal import InternalError
 from anthill.common.validate import validate_value, ValidationError
 
-from . model.profile import NoSuchProfileError, ProfileError, ProfileQueryError
+from . model.profile import NoSuchProfileError, ProfileError, ProfileQueryError, ProfileVersionError
+from . model.profile import ProfilePreconditionError, RawJSON, ProfileQueryTooExpensive
 from . model.access import AccessDenied
+from . model.job import JobError, NoSuchJobError
+from . model.lookup import LookupFieldError
+from . model.changes import TooManySubscribers
+from . model.quota import ProfileQuotaExceeded
 
 import ujson
 
 
+def format_etag(version, access_fingerprint=None):
+    """
+    Profile ETag is the profile version, plus a fingerprint of the access lists if the response
+    has been filtered with them, so changing the access invalidates the filtered responses.
+    """
+    if access_fingerprint:
+        return '"{0}-{1}"'.format(version, access_fingerprint)
+    return '"{0}"'.format(version)
+
+
+def parse_etag_version(etag):
+    """
+    Returns the profile version an ETag (as sent in If-Match header) stands for, or None if any version would do
+    """
+    if etag is None:
+        return None
+
+    etag = etag.split(",")[0].strip()
+
+    if etag == "*":
+        return None
+
+    if etag.startswith("W/"):
+        etag = etag[2:]
+
+    try:
+        return int(etag.strip('"').split("-")[0])
+    except ValueError:
+        raise HTTPError(400, "Corrupted If-Match header")
+
+
+def write_json(request_handler, data):
+    """
+    Writes the data as JSON response, the results that are already encoded (see RawJSON) are written as is
+    """
+    if isinstance(data, RawJSON):
+        request_handler.set_header("Content-Type", "application/json; charset=UTF-8")
+        request_handler.write(data)
+    else:
+        request_handler.dumps(data)
+
+
 class InternalHandler(object):
     def __init__(self, application):
         self.application = application
@@ -28,7 +76,7 @@ class InternalHandler(object):
         else:
             return profiles
 
-    async def update_profile(self, gamespace_id, account_id, fields, path="", merge=True):
+    async def update_profile(self, gamespace_id, account_id, fields, path="", merge=True, version=None):
 
         profiles = self.application.profiles
 
@@ -43,15 +91,62 @@ class InternalHandler(object):
                 account_id,
                 fields,
                 path,
-                merge=merge)
+                merge=merge,
+                version=version)
 
+        except ProfileQuotaExceeded as e:
+            raise InternalError(413, e.message)
         except ProfileError as e:
             raise InternalError(400, e.message)
+        except ProfileVersionError as e:
+            raise InternalError(409, "Profile version mismatch, current version is {0}".format(e.version))
         except AccessDenied as e:
             raise InternalError(403, str(e))
         else:
+            if isinstance(result, RawJSON):
+                return ujson.loads(result)
             return result
 
+    async def delete_profile_path(self, gamespace_id, account_id, path):
+        """
+        Removes a part of the profile by path, returns {"deleted": true} if the profile had it
+        """
+        result = await self.delete_profiles_path(gamespace_id, [account_id], path)
+
+        return {
+            "deleted": bool(result["deleted"])
+        }
+
+    async def delete_profiles_path(self, gamespace_id, accounts, path):
+        profiles = self.application.profiles
+
+        if not isinstance(accounts, list):
+            raise InternalError(400, "Expected 'accounts' to be a list.")
+
+        try:
+            deleted = await profiles.delete_profiles_path(gamespace_id, accounts, path)
+        except ProfileError as e:
+            raise InternalError(400, e.message)
+
+        return {
+            "deleted": deleted
+        }
+
+    async def delete_profiles(self, gamespace_id, accounts):
+        profiles = self.application.profiles
+
+        if not isinstance(accounts, list):
+            raise InternalError(400, "Expected 'accounts' to be a list.")
+
+        try:
+            deleted = await profiles.delete_profiles(gamespace_id, accounts)
+        except ProfileError as e:
+            raise InternalError(400, e.message)
+
+        return {
+            "deleted": deleted
+        }
+
     async def get_my_profile(self, gamespace_id, account_id, path=""):
         profiles = self.application.profiles
 
@@ -92,19 +187,42 @@ class InternalHandler(object):
         else:
             return result
 
-    async def query_profiles(self, gamespace_id, query, limit=1000):
+    async def query_profiles(self, gamespace_id, query, limit=1000, order_by=None, order_desc=False, after=None,
+                             profile_fields=None, background=False):
+        """
+        If the query is too expensive to be run right away, it is rejected, unless background is true,
+        in which case it is submitted as a query job instead, and {"job": <job id>} is returned
+        """
         profiles = self.application.profiles
 
         q = profiles.profile_query(gamespace_id)
         q.filters = query
         q.limit = limit
+        q.fields = profile_fields
+        q.order_by = order_by
+        q.order_desc = order_desc
+        q.after = after
 
         try:
             results, count = await q.query(count=True)
+        except ProfileQueryTooExpensive as e:
+            if not background:
+                raise InternalError(400, str(e))
+
+            try:
+                job_id = await self.application.jobs.submit_query(gamespace_id, query)
+            except (ProfileQueryError, JobError) as e:
+                raise InternalError(400, str(e))
+
+            return {
+                "job": job_id
+            }
         except ProfileQueryError as e:
             raise InternalError(500, str(e))
 
-        return {
+        results = list(results)
+
+        result = {
             "results": {
                 r.account: {
                     "profile": r.profile
@@ -114,8 +232,195 @@ class InternalHandler(object):
             "total_count": count
         }
 
+        if order_by:
+            # the results object is not guaranteed to keep the order
+            result["order"] = [r.account for r in results]
+            result["next"] = q.next_cursor
+
+        return result
+
+    async def aggregate_profiles(self, gamespace_id, query, function, field=None, group_by=None, bucket=None):
+        profiles = self.application.profiles
+
+        q = profiles.profile_query(gamespace_id)
+        q.filters = query
+
+        try:
+            result = await q.aggregate(function, field=field, group_by=group_by, bucket=bucket)
+        except ProfileQueryError as e:
+            raise InternalError(400, str(e))
+
+        if q.truncated:
+            return {
+                "result": result,
+                "truncated": True
+            }
+
+        return {
+            "result": result
+        }
+
+    async def batch(self, gamespace_id, operations):
+        profiles = self.application.profiles
+
+        if not isinstance(operations, list):
+            raise InternalError(400, "Expected 'operations' to be a list.")
+
+        try:
+            results = await profiles.batch(gamespace_id, operations)
+        except ProfileError as e:
+            raise InternalError(400, e.message)
+
+        return {
+            "results": results
+        }
+
+    async def update_profiles_atomic(self, gamespace_id, changes, preconditions=None):
+        profiles = self.application.profiles
+
+        if not isinstance(changes, list):
+            raise InternalError(400, "Expected 'changes' to be a list.")
+
+        if preconditions is not None and not isinstance(preconditions, list):
+            raise InternalError(400, "Expected 'preconditions' to be a list.")
+
+        try:
+            results = await profiles.update_profiles_atomic(gamespace_id, changes, preconditions)
+        except ProfilePreconditionError as e:
+            raise InternalError(409, e.message)
+        except ProfileError as e:
+            raise InternalError(400, e.message)
+
+        return {
+            "results": results
+        }
+
+    async def lookup_profiles(self, gamespace_id, field, value, limit=100):
+        """
+        Returns the accounts that have such value of the lookup field (see ProfileLookupModel)
+        """
+        lookup = self.application.lookup
+
+        try:
+            accounts = await lookup.lookup(gamespace_id, field, value, limit=min(int(limit), 1000))
+        except LookupFieldError as e:
+            raise InternalError(404, str(e))
+
+        return {
+            "accounts": accounts
+        }
+
+    async def submit_query_job(self, gamespace_id, query):
+        jobs = self.application.jobs
+
+        try:
+            job_id = await jobs.submit_query(gamespace_id, query)
+        except (ProfileQueryError, JobError) as e:
+            raise InternalError(400, str(e))
+
+        return {
+            "id": job_id
+        }
+
+    async def submit_migration(self, gamespace_id, steps, dry_run=False, batch_delay=None):
+        """
+        Submits a background migration of the profiles (see ProfileJobsModel.submit_migration),
+        its progress is reported by get_query_job
+        """
+        jobs = self.application.jobs
+
+        try:
+            job_id = await jobs.submit_migration(gamespace_id, steps, dry_run=dry_run, batch_delay=batch_delay)
+        except JobError as e:
+            raise InternalError(400, str(e))
+
+        return {
+            "id": job_id
+        }
 
-class ProfileMeHandler(handler.AuthenticatedHandler):
+    async def clone_profiles(self, gamespace_id, target_gamespace_id, fields=None, exclude=None, anonymize=None,
+                             overwrite=False, batch_delay=None):
+        """
+        Submits a background copy of the profiles into another gamespace (see ProfileJobsModel.submit_clone),
+        its progress is reported by get_query_job
+        """
+        jobs = self.application.jobs
+
+        try:
+            job_id = await jobs.submit_clone(
+                gamespace_id, target_gamespace_id, fields=fields, exclude=exclude, anonymize=anonymize,
+                overwrite=overwrite, batch_delay=batch_delay)
+        except JobError as e:
+            raise InternalError(400, str(e))
+
+        return {
+            "id": job_id
+        }
+
+    async def get_query_job(self, gamespace_id, job_id):
+        jobs = self.application.jobs
+
+        try:
+            job = await jobs.get_job(gamespace_id, job_id)
+        except NoSuchJobError:
+            raise InternalError(404, "No such job")
+
+        return job.dump()
+
+    async def get_query_job_results(self, gamespace_id, job_id, after=0, limit=1000):
+        jobs = self.application.jobs
+
+        try:
+            job, results = await jobs.get_query_results(gamespace_id, job_id, after=after, limit=min(limit, 1000))
+        except NoSuchJobError:
+            raise InternalError(404, "No such job")
+
+        return {
+            "job": job.dump(),
+            "results": {
+                r.account: {
+                    "profile": r.profile
+                }
+                for r in results
+            },
+            # pass as 'after' to get the next page
+            "next": results[-1].account if results else None
+        }
+
+    async def cancel_query_job(self, gamespace_id, job_id):
+        await self.application.jobs.cancel_job(gamespace_id, job_id)
+        return {}
+
+
+class ProfileReadHandler(handler.AuthenticatedHandler):
+    async def not_modified(self, gamespace_id, account_id, access_fingerprint):
+        """
+        Checks If-None-Match header against the current profile version, without fetching the profile itself.
+        Returns True (and sets the 304 status) if the client already has the latest profile.
+        """
+        if not self.request.headers.get("If-None-Match"):
+            return False
+
+        if await self.application.profiles.has_counters(gamespace_id):
+            # the increments of the counter fields do not change the version
+            return False
+
+        version = await self.application.profiles.get_profile_version(gamespace_id, account_id)
+
+        if not version:
+            return False
+
+        self.set_header("ETag", format_etag(version, access_fingerprint))
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+
+        self.clear_header("ETag")
+        return False
+
+
+class ProfileMeHandler(ProfileReadHandler):
     @scoped(scopes=["profile"])
     async def get(self, path):
 
@@ -129,18 +434,33 @@ class ProfileMeHandler(handler.AuthenticatedHandler):
         path = list(filter(bool, path.split("/"))) if path is not None else None
 
         if self.token.has_scope("profile_private"):
-            method = profiles.get_profile_data
-        else:
-            method = profiles.get_profile_me
+            # nothing to filter, so the profile is passed as is
+            if await self.not_modified(gamespace_id, account_id, None):
+                return
+
+            try:
+                profile, version = await profiles.get_profile_data_raw(gamespace_id, account_id, path)
+            except NoSuchProfileError:
+                raise HTTPError(404, "Profile was not found.")
+
+            self.set_header("ETag", format_etag(version))
+            write_json(self, RawJSON(profile))
+            return
+
+        access_fingerprint = (await profiles.access.get_access(gamespace_id)).get_fingerprint()
+
+        if await self.not_modified(gamespace_id, account_id, access_fingerprint):
+            return
 
         try:
-            profile = await method(gamespace_id, account_id, path)
+            profile, version = await profiles.get_profile_me(gamespace_id, account_id, path, with_version=True)
 
         except NoSuchProfileError:
             raise HTTPError(404, "Profile was not found.")
         except AccessDenied:
             raise HTTPError(403, "Access denied")
         else:
+            self.set_header("ETag", format_etag(version, access_fingerprint))
             self.dumps(profile)
 
     @scoped(scopes=["profile_write"])
@@ -156,7 +476,7 @@ class ProfileMeHandler(handler.AuthenticatedHandler):
         path = list(filter(bool, path.split("/"))) if path is not None else None
 
         try:
-            fields = ujson.loads(self.get_argument("data"))
+            fields = await self.application.offload.loads(self.get_argument("data"))
         except (KeyError, ValueError):
             raise HTTPError(400, "Corrupted 'data' field: expecting JSON object.")
 
@@ -164,6 +484,7 @@ class ProfileMeHandler(handler.AuthenticatedHandler):
             raise HTTPError(400, "Expected 'data' field to be an object (a set of fields).")
 
         merge = self.get_argument("merge", "true") == "true"
+        version = parse_etag_version(self.request.headers.get("If-Match"))
 
         if self.token.has_scope("profile_private"):
             method = profiles.set_profile_rw
@@ -171,22 +492,150 @@ class ProfileMeHandler(handler.AuthenticatedHandler):
             method = profiles.set_profile_me
 
         try:
-            result = await method(
+            result, version = await method(
                 gamespace_id,
                 account_id,
                 fields,
                 path,
-                merge=merge)
+                merge=merge,
+                version=version,
+                with_version=True)
 
+        except ProfileQuotaExceeded as e:
+            raise HTTPError(413, str(e))
         except ProfileError as e:
             raise HTTPError(400, str(e))
+        except ProfileVersionError:
+            raise HTTPError(412, "Profile has been changed")
         except AccessDenied as e:
             raise HTTPError(403, str(e))
         else:
-            self.dumps(result)
+            self.set_header("ETag", format_etag(version))
+            write_json(self, result)
+
+
+class ProfileChangesHandler(handler.AuthenticatedHandler):
+    """
+    Long polls for the changes of the profile of the current user (any field, or the comma separated paths)
+    since the version. Responds with {"version", "changes"}, or the whole "profile" if the changes are not known,
+    204 on timeout
+    """
+
+    DEFAULT_TIMEOUT = 30
+    MAX_TIMEOUT = 60
+
+    subscription = None
+
+    def on_connection_close(self):
+        if self.subscription is not None:
+            self.subscription.close()
+
+    async def __respond__(self, gamespace_id, account_id, fields):
+        profiles = self.application.profiles
 
+        try:
+            if self.token.has_scope("profile_private"):
+                profile, version = await profiles.get_profile_data(gamespace_id, account_id, None, with_version=True)
+            else:
+                profile, version = await profiles.get_profile_me(gamespace_id, account_id, None, with_version=True)
+        except NoSuchProfileError:
+            raise HTTPError(404, "Profile was not found.")
+        except AccessDenied:
+            raise HTTPError(403, "Access denied")
+
+        self.set_header("ETag", format_etag(version))
+
+        if fields is None:
+            self.dumps({
+                "version": version,
+                "profile": profile
+            })
+            return
+
+        self.dumps({
+            "version": version,
+            "changes": {
+                field: profile.get(field)
+                for field in fields
+            }
+        })
 
-class ProfileUserHandler(handler.AuthenticatedHandler):
+    @scoped(scopes=["profile"])
+    async def get(self):
+
+        profiles = self.application.profiles
+        changes = self.application.changes
+
+        account_id = self.current_user.token.account
+
+        gamespace_id = self.current_user.token.get(
+            access.AccessToken.GAMESPACE)
+
+        # only the top-level fields are tracked
+        paths = set(filter(bool, (
+            path.strip("/").split("/")[0]
+            for path in self.get_argument("paths", "").split(","))))
+
+        try:
+            version = int(self.get_argument("version", 0))
+            timeout = float(self.get_argument("timeout", ProfileChangesHandler.DEFAULT_TIMEOUT))
+        except ValueError:
+            raise HTTPError(400, "Bad 'version' or 'timeout'")
+
+        timeout = min(max(timeout, 1), ProfileChangesHandler.MAX_TIMEOUT)
+
+        try:
+            self.subscription = changes.subscribe(gamespace_id, account_id)
+        except TooManySubscribers:
+            raise HTTPError(503, "Too many subscribers, poll later")
+
+        try:
+            # subscribed before the check, so nothing is missed in between
+            current = await profiles.get_profile_version(gamespace_id, account_id)
+
+            if current and current != version:
+                await self.__respond__(gamespace_id, account_id, sorted(paths) if paths else None)
+                return
+
+            if self.token.has_scope("profile_private"):
+                private = set()
+            else:
+                private = set((await profiles.access.get_access(gamespace_id)).get_private())
+
+            deadline = IOLoop.current().time() + timeout
+
+            while True:
+                change = await self.subscription.get(deadline - IOLoop.current().time())
+
+                if change is None:
+                    if not self.subscription.closed:
+                        self.set_status(204)
+                    return
+
+                if change.get("version") and change["version"] <= version:
+                    # the client has seen that one already
+                    continue
+
+                fields = change.get("fields")
+
+                if fields is None:
+                    # anything could have been changed
+                    await self.__respond__(gamespace_id, account_id, sorted(paths) if paths else None)
+                    return
+
+                fields = set(fields) - private
+
+                if paths:
+                    fields &= paths
+
+                if fields:
+                    await self.__respond__(gamespace_id, account_id, sorted(fields))
+                    return
+        finally:
+            self.subscription.close()
+
+
+class ProfileUserHandler(ProfileReadHandler):
     @scoped(scopes=["profile"])
     async def get(self, account_id, path):
 
@@ -196,12 +645,18 @@ class ProfileUserHandler(handler.AuthenticatedHandler):
 
         path = list(filter(bool, path.split("/"))) if path is not None else None
 
+        access_fingerprint = (await profiles.access.get_access(gamespace_id)).get_fingerprint()
+
+        if await self.not_modified(gamespace_id, account_id, access_fingerprint):
+            return
+
         try:
-            profile = await profiles.get_profile_others(gamespace_id, account_id, path)
+            profile, version = await profiles.get_profile_others(gamespace_id, account_id, path, with_version=True)
 
         except NoSuchProfileError:
             raise HTTPError(404, "Profile was not found.")
         else:
+            self.set_header("ETag", format_etag(version, access_fingerprint))
             self.dumps(profile)
 
     @internal
@@ -214,7 +669,7 @@ class ProfileUserHandler(handler.AuthenticatedHandler):
         path = list(filter(bool, path.split("/"))) if path is not None else None
 
         try:
-            fields = ujson.loads(self.get_argument("data"))
+            fields = await self.application.offload.loads(self.get_argument("data"))
         except (KeyError, ValueError):
             raise HTTPError(400, "Corrupted 'data' field: expecting JSON object.")
 
@@ -222,16 +677,24 @@ class ProfileUserHandler(handler.AuthenticatedHandler):
             raise HTTPError(400, "Expected 'data' field to be an object (a set of fields).")
 
         merge = self.get_argument("merge", True)
+        version = parse_etag_version(self.request.headers.get("If-Match"))
 
         try:
-            result = await profiles.set_profile_rw(gamespace_id, account_id, fields, path, merge=merge)
+            result, version = await profiles.set_profile_rw(
+                gamespace_id, account_id, fields, path, merge=merge,
+                version=version, with_version=True)
 
+        except ProfileQuotaExceeded as e:
+            raise HTTPError(413, str(e))
         except ProfileError as e:
             raise HTTPError(400, str(e))
+        except ProfileVersionError:
+            raise HTTPError(412, "Profile has been changed")
         except AccessDenied as e:
             raise HTTPError(403, str(e))
         else:
-            self.dumps(result)
+            self.set_header("ETag", format_etag(version))
+            write_json(self, result)
 
 
 class MassProfileUsersHandler(handler.AuthenticatedHandler):
@@ -279,7 +742,7 @@ class MassProfileUsersHandler(handler.AuthenticatedHandler):
         gamespace_id = self.current_user.token.get(access.AccessToken.GAMESPACE)
 
         try:
-            profiles = ujson.loads(self.get_argument("data"))
+            profiles = await self.application.offload.loads(self.get_argument("data"))
             profiles = validate_value(profiles, "json_dict_of_dicts")
         except (KeyError, ValueError, ValidationError):
             raise HTTPError(400, "Corrupted 'data' field: expecting JSON object of JSON objects.")
@@ -289,9 +752,27 @@ class MassProfileUsersHandler(handler.AuthenticatedHandler):
         try:
             result = await profiles_data.set_profiles_rw(gamespace_id, profiles, merge=merge)
 
+        except ProfileQuotaExceeded as e:
+            raise HTTPError(413, str(e))
         except ProfileError as e:
             raise HTTPError(400, str(e))
         except AccessDenied as e:
             raise HTTPError(403, str(e))
         else:
-            self.dumps(result)
\ No newline at end of file
+            write_json(self, result)
+
+
+class ReadyHandler(RequestHandler):
+    """
+    Tells the load balancer (or the orchestrator) whether the node is warmed up and may take the traffic,
+    see ProfileWarmupModel
+    """
+
+    def get(self):
+        warmup = self.application.warmup
+
+        if not warmup.is_ready():
+            self.set_status(503)
+
+        self.set_header("Cache-Control", "no-cache")
+        self.write(warmup.dump())
@@ -1,6 +1,10 @@
 
 from anthill.common.model import Model
 
+from . singleflight import SingleFlight
+
+import zlib
+
 __author__ = "desertkun"
 
 
@@ -10,6 +14,12 @@ class AccessAdapter(object):
         self.protected = data.get("access_protected", "").split("\n")
         self.public = data.get("access_public", "").split("\n")
 
+        self.fingerprint = "{0:08x}".format(zlib.crc32("\n\n".join([
+            data.get("access_private", ""),
+            data.get("access_protected", ""),
+            data.get("access_public", "")
+        ]).encode("utf-8")))
+
     def get_private(self):
         return self.private
 
@@ -19,6 +29,12 @@ class AccessAdapter(object):
     def get_public(self):
         return self.public
 
+    def get_fingerprint(self):
+        """
+        A short hash that changes whenever the access lists are changed
+        """
+        return self.fingerprint
+
 
 class AccessDenied(Exception):
     pass
@@ -49,6 +65,7 @@ class ProfileAccessModel(Model):
 
     def __init__(self, db):
         self.db = db
+        self.reads = SingleFlight()
 
     async def setup_table_gamespace_access(self):
         await self.set_access(1, [], [], ["name", "avatar", "@time_updated", "@time_created"])
@@ -62,7 +79,8 @@ class ProfileAccessModel(Model):
     async def get_access(self, gamespace_id):
         
         try:
-            access = await self.__get_access_data__(gamespace_id)
+            # the concurrent lookups of the same gamespace share one
+            access = await self.reads.do(gamespace_id, lambda: self.__get_access_data__(gamespace_id))
         except NoAccessData:
             return AccessAdapter({})
 
@@ -0,0 +1,167 @@
+
+from tornado.ioloop import PeriodicCallback, IOLoop
+
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError
+
+import asyncio
+import logging
+
+
+class ArchiveSettingsAdapter(object):
+    def __init__(self, data):
+        self.gamespace_id = data.get("gamespace_id")
+        self.archive_after_days = data.get("archive_after_days", 0)
+
+
+class ProfileArchiveModel(Model):
+    """
+    Moves the profiles nobody has touched for a while into the compressed archive,
+    see restore_archived_profiles
+    """
+
+    # do not hold a single sweep for too long
+    MAX_BATCHES_PER_SWEEP = 100
+
+    def __init__(self, db, interval=3600, batch_size=500, batch_delay=0.5):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+
+        self.sweep_callback = None
+        self.sweeping = False
+
+    def get_setup_tables(self):
+        return ["account_profiles_archive", "profile_archive_settings"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(ProfileArchiveModel, self).started(application)
+
+        if self.interval:
+            self.sweep_callback = PeriodicCallback(
+                lambda: IOLoop.current().spawn_callback(self.sweep),
+                self.interval * 1000)
+            self.sweep_callback.start()
+
+    async def stopped(self):
+        if self.sweep_callback:
+            self.sweep_callback.stop()
+            self.sweep_callback = None
+
+        await super(ProfileArchiveModel, self).stopped()
+
+    async def get_settings(self, gamespace_id):
+        settings = await self.db.get(
+            """
+                SELECT *
+                FROM `profile_archive_settings`
+                WHERE `gamespace_id`=%s;
+            """, gamespace_id)
+
+        return ArchiveSettingsAdapter(settings or {"gamespace_id": gamespace_id})
+
+    async def set_settings(self, gamespace_id, archive_after_days):
+        """
+        Sets after how many days of inactivity the profiles of the gamespace are archived, 0 to disable
+        """
+        await self.db.execute(
+            """
+                INSERT INTO `profile_archive_settings`
+                (`gamespace_id`, `archive_after_days`)
+                VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE `archive_after_days`=VALUES(`archive_after_days`);
+            """, gamespace_id, archive_after_days)
+
+    async def get_archived_count(self, gamespace_id):
+        result = await self.db.get(
+            """
+                SELECT COUNT(*) AS `count`
+                FROM `account_profiles_archive`
+                WHERE `gamespace_id`=%s;
+            """, gamespace_id)
+
+        return result["count"] if result else 0
+
+    async def sweep(self):
+        if self.sweeping:
+            return
+
+        self.sweeping = True
+
+        try:
+            settings = await self.db.query(
+                """
+                    SELECT *
+                    FROM `profile_archive_settings`
+                    WHERE `archive_after_days`>0;
+                """)
+
+            for setting in map(ArchiveSettingsAdapter, settings):
+                archived = await self.archive_gamespace(setting.gamespace_id, setting.archive_after_days)
+                if archived:
+                    logging.info("Archived {0} profile(s) of gamespace {1}".format(archived, setting.gamespace_id))
+        except DatabaseError:
+            logging.exception("Failed to archive profiles")
+        finally:
+            self.sweeping = False
+
+    async def archive_gamespace(self, gamespace_id, archive_after_days):
+        total = 0
+
+        for _ in range(0, ProfileArchiveModel.MAX_BATCHES_PER_SWEEP):
+            archived = await self.__archive_batch__(gamespace_id, archive_after_days)
+            if not archived:
+                break
+            total += archived
+            await asyncio.sleep(self.batch_delay)
+
+        return total
+
+    async def __archive_batch__(self, gamespace_id, archive_after_days):
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                # other nodes sweeping at the same time simply take the other rows
+                profiles = await db.query(
+                    """
+                        SELECT `account_id`
+                        FROM `account_profiles`
+                        WHERE `gamespace_id`=%s AND `time_updated` < NOW() - INTERVAL %s DAY
+                        ORDER BY `time_updated`
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED;
+                    """, gamespace_id, archive_after_days, self.batch_size)
+
+                if not profiles:
+                    await db.commit()
+                    return 0
+
+                account_ids = [profile["account_id"] for profile in profiles]
+
+                await db.execute(
+                    """
+                        INSERT INTO `account_profiles_archive`
+                        (`account_id`, `gamespace_id`, `payload`, `version`, `time_updated`, `time_archived`)
+                        SELECT `account_id`, `gamespace_id`, COMPRESS(CAST(`payload` AS CHAR)), `version`,
+                            `time_updated`, NOW()
+                        FROM `account_profiles`
+                        WHERE `gamespace_id`=%s AND `account_id` IN %s
+                        ON DUPLICATE KEY UPDATE `payload`=VALUES(`payload`), `version`=VALUES(`version`),
+                            `time_updated`=VALUES(`time_updated`), `time_archived`=VALUES(`time_archived`);
+                    """, gamespace_id, account_ids)
+
+                await db.execute(
+                    """
+                        DELETE FROM `account_profiles`
+                        WHERE `gamespace_id`=%s AND `account_id` IN %s;
+                    """, gamespace_id, account_ids)
+
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+
+        return len(account_ids)
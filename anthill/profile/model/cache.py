@@ -0,0 +1,100 @@
+
+import collections
+import time
+import ujson
+
+
+class QueryCache(object):
+    """
+    Keeps the query results for ttl seconds (a single write does not invalidate them, the bulk operations do),
+    least recently used evicted once over max_size bytes
+    """
+
+    # approximate overhead of a row besides the payload
+    ROW_OVERHEAD = 64
+
+    def __init__(self, ttl=0, max_size=67108864, workers=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.workers = workers
+
+        # key -> (gamespace_id, expires at, size, value)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.stats = collections.Counter()
+
+        if workers is not None:
+            workers.subscribe("query_cache_invalidate", self.__on_invalidate__)
+
+    def is_enabled(self):
+        return self.ttl > 0 and self.max_size > 0
+
+    @staticmethod
+    def key(gamespace_id, *args):
+        """
+        The filters are normalized (sorted keys), so the same filter written differently shares the entry
+        """
+        return str(gamespace_id) + ":" + ujson.dumps(args, sort_keys=True)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+
+        gamespace_id, expires, size, value = entry
+
+        if expires < time.time():
+            self.__remove__(key)
+            self.stats["misses"] += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def put(self, gamespace_id, key, value, size):
+        if not self.is_enabled() or size > self.max_size:
+            return
+
+        if key in self.entries:
+            self.__remove__(key)
+
+        self.entries[key] = (str(gamespace_id), time.time() + self.ttl, size, value)
+        self.size += size
+
+        while self.size > self.max_size and self.entries:
+            self.__remove__(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+
+    @staticmethod
+    def rows_size(rows):
+        return sum(len(row.get("payload") or "") + QueryCache.ROW_OVERHEAD for row in rows)
+
+    def __remove__(self, key):
+        gamespace_id, expires, size, value = self.entries.pop(key)
+        self.size -= size
+
+    def invalidate(self, gamespace_id):
+        """
+        Drops the results of the gamespace, here and on the other workers of the node
+        """
+        self.__invalidate__(gamespace_id)
+
+        if self.workers is not None:
+            self.workers.broadcast("query_cache_invalidate", str(gamespace_id))
+
+    def __on_invalidate__(self, gamespace_id):
+        self.__invalidate__(gamespace_id)
+
+    def __invalidate__(self, gamespace_id):
+        if not self.entries:
+            return
+
+        gamespace_id = str(gamespace_id)
+
+        for key in [key for key, entry in self.entries.items() if entry[0] == gamespace_id]:
+            self.__remove__(key)
+
+        self.stats["invalidations"] += 1
@@ -0,0 +1,176 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.common.model import Model
+
+import collections
+import asyncio
+import logging
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class ChangeBus(object):
+    """
+    Delivers the changes to the other processes, calling deliver(message) for the ones published elsewhere.
+    This one delivers nothing
+    """
+
+    def __init__(self):
+        self.deliver = None
+
+    def attach(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, message):
+        pass
+
+
+class WorkerChangeBus(ChangeBus):
+    """
+    Delivers the changes to the other workers of the same node (see WorkerGroup)
+    """
+
+    KIND = "profile_changes"
+
+    def __init__(self, workers):
+        super(WorkerChangeBus, self).__init__()
+        self.workers = workers
+        workers.subscribe(WorkerChangeBus.KIND, self.__on_message__)
+
+    def __on_message__(self, message):
+        if self.deliver is not None:
+            self.deliver(message)
+
+    def publish(self, message):
+        self.workers.broadcast(WorkerChangeBus.KIND, message)
+
+
+class Subscription(object):
+    def __init__(self, model, key):
+        self.model = model
+        self.key = key
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    def put(self, change):
+        self.queue.put_nowait(change)
+
+    async def get(self, timeout):
+        """
+        Waits for the next change of the profile, returns None on timeout or once the subscription is closed
+        """
+        if self.closed or timeout <= 0:
+            return None
+
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.model.__unsubscribe__(self)
+        # wake up the waiting one
+        self.queue.put_nowait(None)
+
+
+class ProfileChangesModel(Model):
+    """
+    Notifies the long polling clients about the changes of their profiles, best effort (the subscribers compare
+    the versions). Each change is {"gamespace", "account", "fields": top-level fields or None, "version"}
+    """
+
+    # the changes are published to the bus in chunks, so a message fits into a datagram
+    PUBLISH_CHUNK = 200
+
+    def __init__(self, bus=None, max_subscribers=10000):
+        self.bus = bus if bus is not None else ChangeBus()
+        self.bus.attach(self.__on_message__)
+        self.max_subscribers = max_subscribers
+
+        # (gamespace_id, account_id) -> set of subscriptions
+        self.subscriptions = collections.defaultdict(set)
+        self.count = 0
+        self.stats = collections.Counter()
+
+    def subscribe(self, gamespace_id, account_id):
+        """
+        Subscribes to the changes of the profile, the subscription should be closed once not needed anymore
+        """
+        if self.count >= self.max_subscribers:
+            self.stats["rejected"] += 1
+            raise TooManySubscribers()
+
+        subscription = Subscription(self, (str(gamespace_id), str(account_id)))
+        self.subscriptions[subscription.key].add(subscription)
+        self.count += 1
+
+        return subscription
+
+    def __unsubscribe__(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.key)
+
+        if subscriptions is None or subscription not in subscriptions:
+            return
+
+        subscriptions.discard(subscription)
+        self.count -= 1
+
+        if not subscriptions:
+            del self.subscriptions[subscription.key]
+
+    def publish(self, gamespace_id, changes):
+        """
+        Publishes the changes, a list of (account_id, top-level fields changed or None, new version or None)
+        """
+        if not changes:
+            return
+
+        gamespace_id = str(gamespace_id)
+
+        message = [
+            {
+                "gamespace": gamespace_id,
+                "account": str(account_id),
+                "fields": fields,
+                "version": version
+            }
+            for account_id, fields, version in changes
+        ]
+
+        self.__deliver__(message)
+
+        for i in range(0, len(message), ProfileChangesModel.PUBLISH_CHUNK):
+            try:
+                self.bus.publish(message[i:i + ProfileChangesModel.PUBLISH_CHUNK])
+            except Exception:
+                logging.exception("Failed to publish profile changes")
+
+    def __on_message__(self, message):
+        # the callbacks of the bus may come from anywhere
+        IOLoop.current().add_callback(self.__deliver__, message)
+
+    def __deliver__(self, message):
+        if not self.subscriptions:
+            return
+
+        for change in message:
+            subscriptions = self.subscriptions.get((change["gamespace"], change["account"]))
+
+            if not subscriptions:
+                continue
+
+            for subscription in subscriptions:
+                subscription.put(change)
+                self.stats["delivered"] += 1
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["subscribers"] = self.count
+        return stats
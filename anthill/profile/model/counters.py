@@ -0,0 +1,564 @@
+
+from tornado.ioloop import PeriodicCallback, IOLoop
+
+from anthill.common.model import Model
+from anthill.common import access
+from anthill.common.database import DatabaseError
+
+from . singleflight import SingleFlight
+from . statements import values_placeholder
+
+import collections
+import logging
+import random
+import copy
+import ujson
+
+
+class CounterFieldAdapter(object):
+    def __init__(self, data):
+        self.path = data.get("field_path")
+        self.shards = data.get("field_shards", 1)
+
+    def dump(self):
+        return {
+            "path": self.path,
+            "shards": self.shards
+        }
+
+
+class CounterFieldError(Exception):
+    pass
+
+
+FUNC = "@func"
+VALUE = "@value"
+
+# function -> the sign of the delta
+INCREMENTS = {
+    "++": 1,
+    "--": -1
+}
+
+
+def increment_delta(value):
+    """
+    Returns the delta of an increment ({"@func": "++", "@value": 5}), or None if the value is not a plain one
+    """
+    if not isinstance(value, dict) or value.get(FUNC) not in INCREMENTS or set(value.keys()) - {FUNC, VALUE}:
+        return None
+
+    amount = value.get(VALUE, 1)
+
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+        return None
+
+    return INCREMENTS[value[FUNC]] * amount
+
+
+def split_increments(fields, path, counter_paths):
+    """
+    Takes the increments of the counter fields out of a (merged) write of the fields at path.
+    Returns (the rest of the fields, or None if nothing is left, counter path -> delta)
+    """
+    path = list(path or [])
+    increments = {}
+
+    # the caller's fields are left intact
+    fields = copy.deepcopy(fields)
+
+    for counter in counter_paths:
+        keys = counter.split("/")
+
+        if keys[:len(path)] != path:
+            continue
+
+        relative = keys[len(path):]
+
+        if not relative:
+            delta = increment_delta(fields)
+            if delta is not None:
+                return None, {counter: delta}
+            continue
+
+        parents = [fields]
+
+        for key in relative[:-1]:
+            parent = parents[-1].get(key) if isinstance(parents[-1], dict) else None
+            parents.append(parent)
+
+        parent = parents[-1]
+
+        if not isinstance(parent, dict) or relative[-1] not in parent:
+            continue
+
+        delta = increment_delta(parent[relative[-1]])
+
+        if delta is None:
+            continue
+
+        del parent[relative[-1]]
+        increments[counter] = delta
+
+        # the objects emptied by the removal would not change anything
+        for key, parent in reversed(list(zip(relative[:-1], parents[:-1]))):
+            if parent[key]:
+                break
+            del parent[key]
+
+    if increments and not fields:
+        return None, increments
+
+    return fields, increments
+
+
+def touched_counters(fields, path, merge, counter_paths):
+    """
+    Returns the counters a write sets directly (not increments), their pending increments are discarded
+    """
+    path = list(path or [])
+    result = []
+
+    for counter in counter_paths:
+        keys = counter.split("/")
+
+        if keys[:len(path)] != path:
+            continue
+
+        if not merge:
+            result.append(counter)
+            continue
+
+        value = fields
+
+        for key in keys[len(path):]:
+            if not isinstance(value, dict) or key not in value:
+                value = None
+                break
+            value = value[key]
+
+        if value is not None:
+            result.append(counter)
+
+    return result
+
+
+def apply_counters(data, path, sums):
+    """
+    Adds the sums of the counters (counter path -> sum) to the profile (or its part by path) read.
+    The data is not modified, the parts changed are copied.
+    """
+    path = list(path or [])
+
+    for counter, value in sums.items():
+        keys = counter.split("/")
+
+        if keys[:len(path)] != path:
+            continue
+
+        relative = keys[len(path):]
+
+        if not relative:
+            data = (data if isinstance(data, (int, float)) and not isinstance(data, bool) else 0) + value
+            continue
+
+        if data is not None and not isinstance(data, dict):
+            continue
+
+        data = dict(data or {})
+        parent = data
+
+        for key in relative[:-1]:
+            child = parent.get(key)
+            if child is not None and not isinstance(child, dict):
+                parent = None
+                break
+            parent[key] = dict(child or {})
+            parent = parent[key]
+
+        if parent is None:
+            continue
+
+        current = parent.get(relative[-1])
+
+        if isinstance(current, bool) or not isinstance(current, (int, float)):
+            current = 0
+
+        parent[relative[-1]] = current + value
+
+    return data
+
+
+# a column to select along with a profile from `account_profiles`: its pending increments, read within the same
+# statement (so the same snapshot) as the payload, otherwise a fold in between would count them twice or never
+SHARDS_COLUMN = """
+    (SELECT JSON_ARRAYAGG(JSON_ARRAY(`shards`.`field_path`, `shards`.`shard_value`))
+     FROM `profile_counter_shards` AS `shards`
+     WHERE `shards`.`gamespace_id`=`account_profiles`.`gamespace_id`
+        AND `shards`.`account_id`=`account_profiles`.`account_id`) AS `counter_shards`
+"""
+
+
+def sum_shards(shards):
+    """
+    Sums up the shards, as selected with SHARDS_COLUMN, into a dict of counter path -> pending increment
+    """
+    if isinstance(shards, (str, bytes)):
+        shards = ujson.loads(shards)
+
+    sums = collections.defaultdict(int)
+
+    for path, value in shards or []:
+        sums[path] += value
+
+    return {
+        path: ProfileCountersModel.__number__(value)
+        for path, value in sums.items()
+    }
+
+
+class ProfileCountersModel(Model):
+    """
+    Counter fields take the increments into one of the N shard rows at random instead of locking the profile row,
+    the reads add the shards up, and the shards are folded back into the profiles in the background
+    """
+
+    MAX_FIELDS = 16
+    MAX_SHARDS = 64
+
+    def __init__(self, db, access_model, fold_interval=60, fold_batch=100):
+        self.db = db
+        # a ProfileAccessModel, the public counters are folded into the public projections as well
+        self.access = access_model
+        self.fold_interval = fold_interval
+        self.fold_batch = fold_batch
+
+        self.reads = SingleFlight()
+        self.fold_callback = None
+        self.folding = False
+        self.stats = collections.Counter()
+
+    def get_setup_tables(self):
+        return ["profile_counter_fields", "profile_counter_shards"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(ProfileCountersModel, self).started(application)
+
+        if self.fold_interval:
+            self.fold_callback = PeriodicCallback(
+                lambda: IOLoop.current().spawn_callback(self.fold),
+                self.fold_interval * 1000)
+            self.fold_callback.start()
+
+    async def stopped(self):
+        if self.fold_callback:
+            self.fold_callback.stop()
+            self.fold_callback = None
+
+        await super(ProfileCountersModel, self).stopped()
+
+    # fields
+
+    async def __get_fields__(self, gamespace_id):
+        fields = await self.db.query(
+            """
+                SELECT *
+                FROM `profile_counter_fields`
+                WHERE `gamespace_id`=%s
+                ORDER BY `field_path`;
+            """, gamespace_id, cache_hash=('profile_counter_fields', gamespace_id), cache_time=600)
+
+        return list(map(CounterFieldAdapter, fields))
+
+    async def get_fields(self, gamespace_id):
+        return await self.reads.do(gamespace_id, lambda: self.__get_fields__(gamespace_id))
+
+    async def add_field(self, gamespace_id, path, shards):
+        path = "/".join(filter(bool, path.split("/")))
+
+        if not path or len(path) > 255:
+            raise CounterFieldError("Bad field path")
+
+        if shards < 1 or shards > ProfileCountersModel.MAX_SHARDS:
+            raise CounterFieldError("The number of shards should be between 1 and {0}".format(
+                ProfileCountersModel.MAX_SHARDS))
+
+        fields = await self.get_fields(gamespace_id)
+
+        for field in fields:
+            if field.path != path and (field.path.startswith(path + "/") or path.startswith(field.path + "/")):
+                raise CounterFieldError("Counter fields cannot be inside each other: {0}".format(field.path))
+
+        if path not in [field.path for field in fields] and len(fields) >= ProfileCountersModel.MAX_FIELDS:
+            raise CounterFieldError("Too many counter fields (maximum {0})".format(ProfileCountersModel.MAX_FIELDS))
+
+        await self.db.execute(
+            """
+                INSERT INTO `profile_counter_fields`
+                (`gamespace_id`, `field_path`, `field_shards`)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE `field_shards`=VALUES(`field_shards`);
+            """, gamespace_id, path, shards, cache_hash=('profile_counter_fields', gamespace_id))
+
+        return path
+
+    async def delete_field(self, gamespace_id, path):
+        """
+        Folds the pending increments of the field, and makes it a usual one
+        """
+        await self.fold_gamespace(gamespace_id)
+
+        await self.db.execute(
+            """
+                DELETE FROM `profile_counter_fields`
+                WHERE `gamespace_id`=%s AND `field_path`=%s;
+            """, gamespace_id, path, cache_hash=('profile_counter_fields', gamespace_id))
+
+    # increments
+
+    async def increment(self, gamespace_id, account_id, increments, fields, db=None):
+        """
+        Adds the increments (a dict of counter path -> delta) to random shards of the counters,
+        within the transaction of db if given
+        """
+        if not increments:
+            return
+
+        shards = {field.path: field.shards for field in fields}
+
+        # the rows are always locked in the same order
+        rows = sorted(
+            (path, random.randrange(0, shards.get(path, 1)), delta)
+            for path, delta in increments.items())
+
+        entries = []
+
+        for path, shard_id, delta in rows:
+            entries.extend([gamespace_id, account_id, path, shard_id, delta])
+
+        await (db or self.db).execute(
+            """
+                INSERT INTO `profile_counter_shards`
+                (`gamespace_id`, `account_id`, `field_path`, `shard_id`, `shard_value`)
+                VALUES {0}
+                ON DUPLICATE KEY UPDATE `shard_value`=`shard_value`+VALUES(`shard_value`);
+            """.format(values_placeholder(len(rows), 5)), *entries)
+
+        self.stats["increments"] += len(rows)
+
+    async def get_sums(self, gamespace_id, account_id, paths=None, db=None):
+        """
+        Returns a dict of counter path -> the sum of its shards (the increments not folded yet)
+        """
+        sums = await (db or self.db).query(
+            """
+                SELECT `field_path`, SUM(`shard_value`) AS `value`
+                FROM `profile_counter_shards`
+                WHERE `gamespace_id`=%s AND `account_id`=%s
+                GROUP BY `field_path`;
+            """, gamespace_id, account_id)
+
+        return {
+            entry["field_path"]: ProfileCountersModel.__number__(entry["value"])
+            for entry in sums
+            if paths is None or entry["field_path"] in paths
+        }
+
+    @staticmethod
+    def __number__(value):
+        # the shards are DOUBLE, the whole values are returned as integers
+        value = float(value or 0)
+        return int(value) if value.is_integer() else value
+
+    async def get_totals(self, gamespace_id, account_id, paths):
+        """
+        Returns a dict of counter path -> its current value (the profile value and the shards)
+        """
+        from . profile import format_json_path
+
+        values = await self.db.get(
+            """
+                SELECT {0}, {1}
+                FROM `account_profiles`
+                WHERE `gamespace_id`=%s AND `account_id`=%s;
+            """.format(", ".join(
+                "CAST(JSON_EXTRACT(`payload`, %s) AS CHAR) AS `v{0}`".format(index)
+                for index in range(0, len(paths))), SHARDS_COLUMN),
+            *([format_json_path(path) for path in paths] + [gamespace_id, account_id]))
+
+        totals = sum_shards(values["counter_shards"]) if values else {}
+
+        for index, path in enumerate(paths):
+            value = ujson.loads(values["v{0}".format(index)]) if values and values["v{0}".format(index)] else 0
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                value = 0
+            totals[path] = totals.get(path, 0) + value
+
+        return totals
+
+    async def discard(self, gamespace_id, account_id, paths, db=None):
+        """
+        Drops the pending increments of the counters that have been set directly,
+        within the transaction of db if given
+        """
+        if not paths:
+            return
+
+        await (db or self.db).execute(
+            """
+                DELETE FROM `profile_counter_shards`
+                WHERE `gamespace_id`=%s AND `account_id`=%s AND `field_path` IN %s;
+            """, gamespace_id, account_id, paths)
+
+    # folding
+
+    async def fold(self):
+        if self.folding:
+            return
+
+        self.folding = True
+
+        try:
+            accounts = await self.db.query(
+                """
+                    SELECT DISTINCT `gamespace_id`, `account_id`
+                    FROM `profile_counter_shards`
+                    LIMIT %s;
+                """, self.fold_batch)
+
+            for account in accounts:
+                await self.fold_account(account["gamespace_id"], account["account_id"])
+        except DatabaseError:
+            logging.exception("Failed to fold profile counters")
+        finally:
+            self.folding = False
+
+    async def fold_gamespace(self, gamespace_id):
+        accounts = await self.db.query(
+            """
+                SELECT DISTINCT `account_id`
+                FROM `profile_counter_shards`
+                WHERE `gamespace_id`=%s;
+            """, gamespace_id)
+
+        for account in accounts:
+            await self.fold_account(gamespace_id, account["account_id"])
+
+    async def fold_account(self, gamespace_id, account_id):
+        """
+        Moves the shards of the counters of the profile into the profile itself, in one transaction
+        """
+        public_fields = (await self.access.get_access(gamespace_id)).get_public()
+
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                folded = await self.__fold__(db, gamespace_id, account_id, public_fields)
+                await db.commit()
+            except BaseException:
+                # a connection is returned to the pool as is, along with the locks taken
+                await db.rollback()
+                raise
+
+        if folded:
+            self.stats["folds"] += 1
+
+    async def __fold__(self, db, gamespace_id, account_id, public_fields):
+        from . profile import format_json_path, restore_archived_profiles
+
+        # the profile is locked before the shards, the same way the profile writes do (see set_profile_data)
+        locked = await db.get(
+            """
+                SELECT `version`
+                FROM `account_profiles`
+                WHERE `gamespace_id`=%s AND `account_id`=%s
+                FOR UPDATE;
+            """, gamespace_id, account_id)
+
+        # the shards being incremented right now are folded next time
+        shards = await db.query(
+            """
+                SELECT `field_path`, `shard_id`, `shard_value`
+                FROM `profile_counter_shards`
+                WHERE `gamespace_id`=%s AND `account_id`=%s
+                FOR UPDATE SKIP LOCKED;
+            """, gamespace_id, account_id)
+
+        if not shards:
+            return False
+
+        sums = collections.defaultdict(int)
+        shard_ids = collections.defaultdict(list)
+
+        for shard in shards:
+            sums[shard["field_path"]] += ProfileCountersModel.__number__(shard["shard_value"])
+            shard_ids[shard["field_path"]].append(shard["shard_id"])
+
+        if not locked and not await restore_archived_profiles(db, gamespace_id, [account_id]):
+            now = access.utc_time()
+            await db.execute(
+                """
+                    INSERT IGNORE INTO `account_profiles`
+                    (`account_id`, `gamespace_id`, `payload`, `version`)
+                    VALUES (%s, %s, JSON_OBJECT('@time_created', %s, '@time_updated', %s), 0);
+                """, account_id, gamespace_id, now, now)
+
+        def folded(column, paths):
+            # JSON_SET(JSON_INSERT(<column>, <missing parents>), <path>, <value in payload> + <sum>, ...)
+            parents = []
+            args = []
+
+            for path in paths:
+                keys = path.split("/")
+                for i in range(1, len(keys)):
+                    parents.append(format_json_path(keys[:i]))
+
+            expression = "`{0}`".format(column)
+
+            if parents:
+                expression = "JSON_INSERT({0}, {1})".format(expression, ", ".join(
+                    "%s, JSON_OBJECT()" for _ in parents))
+                args.extend(parents)
+
+            expression = "JSON_SET({0}, {1})".format(expression, ", ".join(
+                "%s, IF(JSON_TYPE(JSON_EXTRACT(`payload`, %s)) IN ('INTEGER', 'UNSIGNED INTEGER', 'DOUBLE'), "
+                "JSON_EXTRACT(`payload`, %s), 0) + %s" for _ in paths))
+
+            for path in paths:
+                json_path = format_json_path(path)
+                args.extend([json_path, json_path, json_path, sums[path]])
+
+            return expression, args
+
+        payload, payload_args = folded("payload", list(sums.keys()))
+
+        # the public projection is kept up to date, the assignments refer to the payload before the update
+        public_paths = [
+            path for path in sums.keys()
+            if path.split("/")[0] in public_fields
+        ]
+
+        if public_paths:
+            payload_public, public_args = folded("payload_public", public_paths)
+            payload_public = "IF(`payload_public` IS NULL, NULL, {0})".format(payload_public)
+        else:
+            payload_public, public_args = "`payload_public`", []
+
+        await db.execute(
+            """
+                UPDATE `account_profiles`
+                SET `payload_public`={0}, `payload`={1}, `version`=`version`+1
+                WHERE `gamespace_id`=%s AND `account_id`=%s;
+            """.format(payload_public, payload),
+            *(public_args + payload_args + [gamespace_id, account_id]))
+
+        for path, ids in shard_ids.items():
+            await db.execute(
+                """
+                    DELETE FROM `profile_counter_shards`
+                    WHERE `gamespace_id`=%s AND `account_id`=%s AND `field_path`=%s AND `shard_id` IN %s;
+                """, gamespace_id, account_id, path, ids)
+
+        return True
@@ -0,0 +1,97 @@
+
+from anthill.common.database import DatabaseError
+
+from . profile import ProfileQueryTooExpensive
+
+import collections
+import datetime
+import time
+
+
+class SlowQueryAdapter(object):
+    def __init__(self, gamespace_id, filters, plan, duration, status):
+        self.time = datetime.datetime.utcnow()
+        self.gamespace_id = gamespace_id
+        self.filters = filters
+        self.plan = plan
+        self.duration = duration
+        self.status = status
+        self.estimate = QueryGuard.__estimate__(plan) if plan else None
+
+    def summary(self):
+        """
+        A short human readable version of the plan
+        """
+        if not self.plan:
+            return "unknown"
+
+        return "; ".join(
+            "{0}: {1} using {2}, ~{3} rows{4}".format(
+                row.get("table"), row.get("type"), row.get("key") or "no index", row.get("rows"),
+                " ({0})".format(row["Extra"]) if row.get("Extra") else "")
+            for row in self.plan)
+
+
+class QueryGuard(object):
+    """
+    Rejects the queries estimated (with EXPLAIN) to examine more than max_rows rows, and logs the slow ones
+    """
+
+    def __init__(self, max_rows=0, slow_time=1.0, log_size=100):
+        self.max_rows = max_rows
+        self.slow_time = slow_time
+        self.log = collections.deque(maxlen=log_size)
+        self.stats = collections.Counter()
+
+    # noinspection PyShadowingNames
+    @staticmethod
+    def __estimate__(plan):
+        # the tables are joined with nested loops, so the estimates multiply
+        estimate = 1
+        for row in plan:
+            estimate *= max(1, int(row.get("rows") or 1))
+        return estimate
+
+    @staticmethod
+    async def __explain__(db, query, args):
+        try:
+            return await db.query("EXPLAIN " + query, *args)
+        except DatabaseError:
+            return None
+
+    def __record__(self, gamespace_id, filters, plan, duration, status):
+        self.log.appendleft(SlowQueryAdapter(gamespace_id, filters, plan, duration, status))
+
+    def get_log(self):
+        return list(self.log)
+
+    async def run(self, db, gamespace_id, filters, query, args, execute):
+        """
+        Calls execute() unless the query is too expensive. A slow query is planned after execute() has returned,
+        so execute() should be done with the connection (FOUND_ROWS) by then
+        """
+        plan = None
+
+        if self.max_rows:
+            self.stats["planned"] += 1
+            plan = await QueryGuard.__explain__(db, query, args)
+
+            if plan:
+                estimate = QueryGuard.__estimate__(plan)
+                if estimate > self.max_rows:
+                    self.stats["rejected"] += 1
+                    self.__record__(gamespace_id, filters, plan, None, "rejected")
+                    raise ProfileQueryTooExpensive(estimate, self.max_rows)
+
+        started = time.time()
+
+        try:
+            return await execute()
+        finally:
+            duration = time.time() - started
+
+            if self.slow_time and duration >= self.slow_time:
+                self.stats["slow"] += 1
+                if plan is None:
+                    plan = await QueryGuard.__explain__(db, query, args)
+                self.__record__(gamespace_id, filters, plan, duration, "slow")
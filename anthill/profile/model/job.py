@@ -0,0 +1,850 @@
+
+from tornado.ioloop import PeriodicCallback, IOLoop
+
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError, ConditionError
+
+from . profile import ProfileAdapter, ProfileQueryError, format_json_path
+from . lookup import MAX_VALUE_LENGTH
+
+import asyncio
+import logging
+import base64
+import ujson
+import os
+
+
+class JobError(Exception):
+    pass
+
+
+class NoSuchJobError(Exception):
+    pass
+
+
+class JobAdapter(object):
+    def __init__(self, data):
+        self.job_id = str(data.get("job_id"))
+        self.gamespace_id = data.get("gamespace_id")
+        self.kind = data.get("job_kind")
+        self.status = data.get("job_status")
+        self.args = data.get("job_args") or {}
+        self.cursor = data.get("job_cursor", 0)
+        self.processed = data.get("job_processed", 0)
+        self.affected = data.get("job_affected", 0)
+        self.error = data.get("job_error")
+        self.created = data.get("job_created")
+        self.updated = data.get("job_updated")
+
+    def is_finished(self):
+        return self.status in ProfileJobsModel.FINISHED
+
+    def dump(self):
+        return {
+            "id": self.job_id,
+            "kind": self.kind,
+            "status": self.status,
+            "args": self.args,
+            "processed": self.processed,
+            "affected": self.affected,
+            "error": self.error,
+            "created": str(self.created),
+            "updated": str(self.updated)
+        }
+
+
+class ProfileJobsModel(Model):
+    """
+    Runs long operations over the profiles of a gamespace in the background, batch by batch,
+    the progress is saved after each batch so a job survives a restart
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_COMPLETE = "complete"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+
+    FINISHED = [STATUS_COMPLETE, STATUS_FAILED, STATUS_CANCELLED]
+
+    KIND_QUERY = "query"
+    KIND_PUBLIC = "public"
+    KIND_LOOKUP = "lookup"
+    KIND_MIGRATION = "migration"
+    KIND_CLONE = "clone"
+
+    # a running job that has not reported any progress for this long is considered abandoned
+    STALE_TIMEOUT = 120
+    POLL_INTERVAL = 10
+    # a running job reports it is alive this often, even in the middle of a long batch or a delay
+    HEARTBEAT_INTERVAL = 20
+    # the most a job may ask to be throttled by between the batches
+    MAX_BATCH_DELAY = 30
+
+    def __init__(self, db, profiles, batch_size=1000, batch_delay=0.1, concurrency=2, keep_hours=24, poll=True):
+        self.db = db
+        self.profiles = profiles
+        # whether this process picks up the jobs, otherwise it only submits them
+        self.poll = poll
+
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.concurrency = concurrency
+        self.keep_hours = keep_hours
+
+        self.running = set()
+        self.poll_callback = None
+
+        # job kind -> async function(job, after, bound) that processes a batch of profiles
+        # with account_id in (after, bound] and returns the number of affected rows
+        self.processors = {
+            ProfileJobsModel.KIND_QUERY: self.__process_query__,
+            ProfileJobsModel.KIND_PUBLIC: self.__process_public__,
+            ProfileJobsModel.KIND_LOOKUP: self.__process_lookup__,
+            ProfileJobsModel.KIND_MIGRATION: self.__process_migration__,
+            ProfileJobsModel.KIND_CLONE: self.__process_clone__
+        }
+
+    def get_setup_tables(self):
+        return ["profile_jobs", "profile_job_results"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(ProfileJobsModel, self).started(application)
+
+        if self.poll:
+            self.poll_callback = PeriodicCallback(
+                lambda: IOLoop.current().spawn_callback(self.__poll__),
+                ProfileJobsModel.POLL_INTERVAL * 1000)
+            self.poll_callback.start()
+
+    async def stopped(self):
+        if self.poll_callback:
+            self.poll_callback.stop()
+            self.poll_callback = None
+
+        await super(ProfileJobsModel, self).stopped()
+
+    async def __poll__(self):
+        try:
+            await self.db.execute(
+                """
+                    DELETE FROM `profile_jobs`
+                    WHERE `job_status` IN %s AND `job_updated` < NOW() - INTERVAL %s HOUR;
+                """, ProfileJobsModel.FINISHED, self.keep_hours)
+
+            free = self.concurrency - len(self.running)
+
+            if free <= 0:
+                return
+
+            jobs = await self.db.query(
+                """
+                    SELECT `job_id`
+                    FROM `profile_jobs`
+                    WHERE `job_status`=%s OR (`job_status`=%s AND `job_updated` < NOW() - INTERVAL %s SECOND)
+                    ORDER BY `job_id`
+                    LIMIT %s;
+                """, ProfileJobsModel.STATUS_QUEUED, ProfileJobsModel.STATUS_RUNNING,
+                ProfileJobsModel.STALE_TIMEOUT, free)
+        except DatabaseError:
+            logging.exception("Failed to poll profile jobs")
+            return
+
+        for job in jobs:
+            await self.__claim__(str(job["job_id"]))
+
+    async def __claim__(self, job_id):
+        if job_id in self.running or len(self.running) >= self.concurrency:
+            return
+
+        # the slot is taken before anything is awaited, so the overlapping polls do not exceed the concurrency
+        self.running.add(job_id)
+
+        try:
+            job = await self.__take__(job_id)
+        except BaseException:
+            self.running.discard(job_id)
+            raise
+
+        if job is None:
+            self.running.discard(job_id)
+            return
+
+        IOLoop.current().spawn_callback(self.__run__, JobAdapter(job))
+
+    async def __take__(self, job_id):
+        claimed = await self.db.execute(
+            """
+                UPDATE `profile_jobs`
+                SET `job_status`=%s, `job_updated`=NOW()
+                WHERE `job_id`=%s AND
+                    (`job_status`=%s OR (`job_status`=%s AND `job_updated` < NOW() - INTERVAL %s SECOND));
+            """, ProfileJobsModel.STATUS_RUNNING, job_id, ProfileJobsModel.STATUS_QUEUED,
+            ProfileJobsModel.STATUS_RUNNING, ProfileJobsModel.STALE_TIMEOUT)
+
+        if not claimed:
+            # somebody else took it
+            return None
+
+        return await self.db.get(
+            """
+                SELECT *
+                FROM `profile_jobs`
+                WHERE `job_id`=%s;
+            """, job_id)
+
+    async def __heartbeat__(self, job):
+        try:
+            await self.db.execute(
+                """
+                    UPDATE `profile_jobs`
+                    SET `job_updated`=NOW()
+                    WHERE `job_id`=%s AND `job_status`=%s;
+                """, job.job_id, ProfileJobsModel.STATUS_RUNNING)
+        except DatabaseError:
+            logging.exception("Failed to update profile job {0}".format(job.job_id))
+
+    @staticmethod
+    def __batch_delay__(batch_delay):
+        try:
+            batch_delay = float(batch_delay)
+        except (TypeError, ValueError):
+            raise JobError("Bad batch delay")
+
+        if batch_delay < 0 or batch_delay > ProfileJobsModel.MAX_BATCH_DELAY:
+            raise JobError("Batch delay should be between 0 and {0} seconds".format(
+                ProfileJobsModel.MAX_BATCH_DELAY))
+
+        return batch_delay
+
+    async def __run__(self, job):
+        processor = self.processors.get(job.kind)
+        after = job.cursor
+
+        # so the job is not considered abandoned (and claimed by somebody else) while it is busy
+        heartbeat = PeriodicCallback(
+            lambda: IOLoop.current().spawn_callback(self.__heartbeat__, job),
+            ProfileJobsModel.HEARTBEAT_INTERVAL * 1000)
+        heartbeat.start()
+
+        try:
+            if processor is None:
+                raise JobError("Unknown job kind: {0}".format(job.kind))
+
+            while True:
+                status = await self.db.get(
+                    """
+                        SELECT `job_status`
+                        FROM `profile_jobs`
+                        WHERE `job_id`=%s;
+                    """, job.job_id)
+
+                if not status or status["job_status"] != ProfileJobsModel.STATUS_RUNNING:
+                    # cancelled or deleted
+                    return
+
+                bound, scanned = await self.profiles.next_batch(job.gamespace_id, after, self.batch_size)
+
+                if not scanned:
+                    break
+
+                affected = await processor(job, after, bound)
+                after = bound
+
+                await self.db.execute(
+                    """
+                        UPDATE `profile_jobs`
+                        SET `job_cursor`=%s, `job_processed`=`job_processed`+%s,
+                            `job_affected`=`job_affected`+%s, `job_updated`=NOW()
+                        WHERE `job_id`=%s;
+                    """, after, scanned, affected or 0, job.job_id)
+
+                # a job may ask to be throttled more than usual
+                await asyncio.sleep(min(max(self.batch_delay, float(job.args.get("batch_delay") or 0)),
+                                        ProfileJobsModel.MAX_BATCH_DELAY))
+
+        except (JobError, ProfileQueryError, DatabaseError) as e:
+            logging.error("Profile job {0} has failed: {1}".format(job.job_id, str(e)))
+            await self.__finish__(job, ProfileJobsModel.STATUS_FAILED, str(e)[:1024])
+        except Exception as e:
+            logging.exception("Profile job {0} has failed".format(job.job_id))
+            await self.__finish__(job, ProfileJobsModel.STATUS_FAILED, "Internal error: " + str(e)[:1000])
+        else:
+            await self.__finish__(job, ProfileJobsModel.STATUS_COMPLETE)
+        finally:
+            heartbeat.stop()
+            self.running.discard(job.job_id)
+
+    async def __finish__(self, job, status, error=None):
+        try:
+            await self.db.execute(
+                """
+                    UPDATE `profile_jobs`
+                    SET `job_status`=%s, `job_error`=%s, `job_updated`=NOW()
+                    WHERE `job_id`=%s AND `job_status`=%s;
+                """, status, error, job.job_id, ProfileJobsModel.STATUS_RUNNING)
+        except DatabaseError:
+            logging.exception("Failed to finish profile job {0}".format(job.job_id))
+
+    async def submit_job(self, gamespace_id, kind, args):
+        if kind not in self.processors:
+            raise JobError("Unknown job kind: {0}".format(kind))
+
+        try:
+            job_id = await self.db.insert(
+                """
+                    INSERT INTO `profile_jobs`
+                    (`gamespace_id`, `job_kind`, `job_status`, `job_args`, `job_created`, `job_updated`)
+                    VALUES (%s, %s, %s, %s, NOW(), NOW());
+                """, gamespace_id, kind, ProfileJobsModel.STATUS_QUEUED, ujson.dumps(args))
+        except DatabaseError as e:
+            raise JobError("Failed to submit a job: " + e.args[1])
+
+        # do not wait for the next poll if this node is free
+        IOLoop.current().spawn_callback(self.__claim__, str(job_id))
+
+        return str(job_id)
+
+    async def get_job(self, gamespace_id, job_id):
+        job = await self.db.get(
+            """
+                SELECT *
+                FROM `profile_jobs`
+                WHERE `gamespace_id`=%s AND `job_id`=%s;
+            """, gamespace_id, job_id)
+
+        if job is None:
+            raise NoSuchJobError()
+
+        return JobAdapter(job)
+
+    async def list_jobs(self, gamespace_id, kind=None, limit=100):
+        jobs = await self.db.query(
+            """
+                SELECT *
+                FROM `profile_jobs`
+                WHERE `gamespace_id`=%s {0}
+                ORDER BY `job_id` DESC
+                LIMIT %s;
+            """.format("AND `job_kind`=%s" if kind else ""),
+            *([gamespace_id, kind, limit] if kind else [gamespace_id, limit]))
+
+        return list(map(JobAdapter, jobs))
+
+    async def cancel_job(self, gamespace_id, job_id):
+        await self.db.execute(
+            """
+                UPDATE `profile_jobs`
+                SET `job_status`=%s, `job_updated`=NOW()
+                WHERE `gamespace_id`=%s AND `job_id`=%s AND `job_status` IN %s;
+            """, ProfileJobsModel.STATUS_CANCELLED, gamespace_id, job_id,
+            [ProfileJobsModel.STATUS_QUEUED, ProfileJobsModel.STATUS_RUNNING])
+
+    async def delete_job(self, gamespace_id, job_id):
+        await self.db.execute(
+            """
+                DELETE FROM `profile_jobs`
+                WHERE `gamespace_id`=%s AND `job_id`=%s;
+            """, gamespace_id, job_id)
+
+    # query jobs
+
+    async def submit_query(self, gamespace_id, filters):
+        q = self.profiles.profile_query(gamespace_id)
+        q.filters = filters
+
+        # fail early on malformed filters
+        try:
+            q.__values__()
+        except ConditionError as e:
+            raise ProfileQueryError("Failed to process profile conditions: {0}".format(str(e)))
+
+        return await self.submit_job(gamespace_id, ProfileJobsModel.KIND_QUERY, {
+            "query": filters
+        })
+
+    async def __process_query__(self, job, after, bound):
+        q = self.profiles.profile_query(job.gamespace_id)
+        q.filters = job.args.get("query")
+
+        try:
+            conditions, data = q.__values__()
+        except ConditionError as e:
+            raise ProfileQueryError("Failed to process profile conditions: {0}".format(str(e)))
+
+        return await self.db.execute(
+            """
+                INSERT IGNORE INTO `profile_job_results`
+                (`job_id`, `account_id`, `payload`)
+                SELECT %s, `account_id`, `payload`
+                FROM `account_profiles`
+                WHERE {0} AND `account_id`>%s AND `account_id`<=%s;
+            """.format(" AND ".join(conditions)), job.job_id, *(data + [after, bound]))
+
+    async def get_query_results(self, gamespace_id, job_id, after=0, limit=1000):
+        """
+        Returns a page of the query job results (in account_id order), starting after the given account_id
+        """
+        job = await self.get_job(gamespace_id, job_id)
+
+        if job.kind != ProfileJobsModel.KIND_QUERY:
+            raise NoSuchJobError()
+
+        results = await self.db.query(
+            """
+                SELECT `account_id`, CAST(`payload` AS CHAR) AS `payload`
+                FROM `profile_job_results`
+                WHERE `job_id`=%s AND `account_id`>%s
+                ORDER BY `account_id`
+                LIMIT %s;
+            """, job.job_id, int(after), int(limit))
+
+        return job, list(map(ProfileAdapter, results))
+
+    # public projection rebuild jobs
+
+    # a key no public field would have, the missing fields are set to it and then removed at once
+    MISSING_FIELD = "$.\"@missing\""
+
+    async def submit_public_rebuild(self, gamespace_id):
+        """
+        Rebuilds the public projections of all profiles of the gamespace after its access has been changed.
+        Until a profile is processed, the reads of it simply filter the full profile.
+        """
+        public_access = await self.profiles.access.get_access(gamespace_id)
+
+        return await self.submit_job(gamespace_id, ProfileJobsModel.KIND_PUBLIC, {
+            "fields": [field for field in public_access.get_public() if field],
+            "access": public_access.get_fingerprint()
+        })
+
+    async def __process_public__(self, job, after, bound):
+        fields = job.args.get("fields", [])
+        fingerprint = job.args.get("access")
+
+        current = await self.profiles.access.get_access(job.gamespace_id)
+
+        if current.get_fingerprint() != fingerprint:
+            # the access has been changed again, and so another rebuild has been submitted
+            raise JobError("The access has been changed since the job was submitted")
+
+        return await self.__update_public__(job.gamespace_id, fields, fingerprint, after, bound)
+
+    @staticmethod
+    def __projection__(fields):
+        """
+        Returns a tuple of (SQL expression, its arguments) of the payload with only the given top-level fields left
+        """
+
+        if not fields:
+            return "JSON_OBJECT()", []
+
+        # JSON_SET(JSON_OBJECT(), <path of field 1 or MISSING_FIELD>, <value of field 1>, ...)
+        projection = "JSON_REMOVE(JSON_SET(JSON_OBJECT(), {0}), %s)".format(", ".join(
+            "IF(JSON_CONTAINS_PATH(`payload`, 'one', %s), %s, %s), JSON_EXTRACT(`payload`, %s)"
+            for _ in fields))
+
+        args = []
+
+        for field in fields:
+            path = format_json_path([field])
+            args.extend([path, path, ProfileJobsModel.MISSING_FIELD, path])
+
+        args.append(ProfileJobsModel.MISSING_FIELD)
+
+        return projection, args
+
+    async def __update_public__(self, gamespace_id, fields, fingerprint, after, bound):
+        """
+        Rebuilds the public projections of the profiles with account_id in (after, bound] that are not up to date
+        """
+
+        projection, args = ProfileJobsModel.__projection__(fields)
+
+        # time_updated is preserved, the profiles are not really changed
+        return await self.db.execute(
+            """
+                UPDATE `account_profiles`
+                SET `payload_public`={0}, `public_access`=%s, `time_updated`=`time_updated`
+                WHERE `gamespace_id`=%s AND `account_id`>%s AND `account_id`<=%s AND
+                    (`public_access` IS NULL OR `public_access`<>%s);
+            """.format(projection), *(args + [fingerprint, gamespace_id, after, bound, fingerprint]))
+
+    # lookup index rebuild jobs
+
+    async def submit_lookup_rebuild(self, gamespace_id):
+        """
+        Indexes the profiles that existed before the lookup fields of the gamespace have been declared
+        """
+        if self.profiles.lookup is None:
+            raise JobError("Lookup fields are not supported")
+
+        fields = await self.profiles.lookup.get_fields(gamespace_id)
+
+        return await self.submit_job(gamespace_id, ProfileJobsModel.KIND_LOOKUP, {
+            "fields": [field.dump() for field in fields]
+        })
+
+    async def __process_lookup__(self, job, after, bound):
+        return await self.__update_lookup__(job.gamespace_id, job.args.get("fields", []), after, bound)
+
+    async def __update_lookup__(self, gamespace_id, fields, after, bound):
+        """
+        Indexes the lookup fields (as dumped by LookupFieldAdapter) of the profiles with account_id in (after, bound]
+        """
+        affected = 0
+
+        for field in fields:
+            path = format_json_path(field["path"])
+
+            # the same values lookup_value accepts, the values already taken (by the live writes,
+            # or by another account for the unique fields) are skipped
+            affected += await self.db.execute(
+                """
+                    INSERT IGNORE INTO `profile_lookup_index`
+                    (`gamespace_id`, `field_path`, `field_value`, `account_id`, `field_uniq`)
+                    SELECT `gamespace_id`, %s, JSON_UNQUOTE(JSON_EXTRACT(`payload`, %s)), `account_id`, {0}
+                    FROM `account_profiles`
+                    WHERE `gamespace_id`=%s AND `account_id`>%s AND `account_id`<=%s AND
+                        JSON_TYPE(JSON_EXTRACT(`payload`, %s)) IN ('STRING', 'INTEGER', 'UNSIGNED INTEGER') AND
+                        CHAR_LENGTH(JSON_UNQUOTE(JSON_EXTRACT(`payload`, %s))) BETWEEN 1 AND %s;
+                """.format("0" if field.get("unique") else "`account_id`"),
+                field["path"], path, gamespace_id, after, bound, path, path, MAX_VALUE_LENGTH) or 0
+
+        return affected
+
+    # migration jobs
+
+    MIGRATION_OPERATIONS = ["rename", "move", "delete", "default"]
+    MAX_MIGRATION_STEPS = 32
+
+    @staticmethod
+    def __split_path__(path):
+        if not isinstance(path, str):
+            raise JobError("Bad path: {0}".format(path))
+        keys = list(filter(bool, path.split("/")))
+        if not keys:
+            raise JobError("Bad path: {0}".format(path))
+        return keys
+
+    @staticmethod
+    def __parents__(keys):
+        """
+        Returns (a condition that the parents of the path are missing or objects, its arguments) and
+        (JSON_INSERT arguments that create the missing ones, since JSON_SET would not, their arguments)
+        """
+        conditions = []
+        inserts = []
+        args = []
+
+        for i in range(1, len(keys)):
+            parent = format_json_path(keys[:i])
+            conditions.append("COALESCE(JSON_TYPE(JSON_EXTRACT(`payload`, %s)), 'OBJECT')='OBJECT'")
+            inserts.append("%s, JSON_OBJECT()")
+            args.append(parent)
+
+        return conditions, inserts, args
+
+    @staticmethod
+    def __migration_step__(step):
+        """
+        Converts a migration step into a tuple of (SQL condition, condition arguments, new payload expression,
+        expression arguments). The expressions refer to the payload before the step.
+        """
+
+        if not isinstance(step, dict):
+            raise JobError("Each step should be an object")
+
+        operation = step.get("op")
+
+        if operation in ["rename", "move"]:
+            source = ProfileJobsModel.__split_path__(step.get("from"))
+            target = ProfileJobsModel.__split_path__(step.get("to"))
+
+            if target[:len(source)] == source:
+                raise JobError("Cannot move '{0}' inside itself".format(step.get("from")))
+
+            conditions, inserts, parents = ProfileJobsModel.__parents__(target)
+            source, target = format_json_path(source), format_json_path(target)
+
+            payload = "JSON_REMOVE(`payload`, %s)"
+            payload_args = [source]
+
+            if inserts:
+                payload = "JSON_INSERT({0}, {1})".format(payload, ", ".join(inserts))
+                payload_args.extend(parents)
+
+            return (
+                " AND ".join(["JSON_CONTAINS_PATH(`payload`, 'one', %s)"] + conditions),
+                [source] + parents,
+                "JSON_SET({0}, %s, JSON_EXTRACT(`payload`, %s))".format(payload),
+                payload_args + [target, source]
+            )
+
+        if operation == "delete":
+            path = format_json_path(ProfileJobsModel.__split_path__(step.get("path")))
+
+            return (
+                "JSON_CONTAINS_PATH(`payload`, 'one', %s)",
+                [path],
+                "JSON_REMOVE(`payload`, %s)",
+                [path]
+            )
+
+        if operation == "default":
+            keys = ProfileJobsModel.__split_path__(step.get("path"))
+
+            if "value" not in step:
+                raise JobError("Step 'default' requires a value")
+
+            conditions, inserts, parents = ProfileJobsModel.__parents__(keys)
+            path = format_json_path(keys)
+
+            payload = "`payload`"
+            payload_args = []
+
+            if inserts:
+                payload = "JSON_INSERT(`payload`, {0})".format(", ".join(inserts))
+                payload_args.extend(parents)
+
+            return (
+                " AND ".join(["NOT JSON_CONTAINS_PATH(`payload`, 'one', %s)"] + conditions),
+                [path] + parents,
+                "JSON_SET({0}, %s, CAST(%s AS JSON))".format(payload),
+                payload_args + [path, ujson.dumps(step["value"])]
+            )
+
+        raise JobError("No such migration operation: {0}, expected one of: {1}".format(
+            operation, ", ".join(ProfileJobsModel.MIGRATION_OPERATIONS)))
+
+    async def submit_migration(self, gamespace_id, steps, dry_run=False, batch_delay=None):
+        """
+        Transforms the profiles in the background, batch by batch. The steps are applied in order, each is one of
+        {"op": "rename" or "move", "from", "to"}, {"op": "delete", "path"} or {"op": "default", "path", "value"}.
+        A dry run only counts the profiles that would change. The archived profiles are not migrated
+        """
+
+        if not isinstance(steps, list) or not steps:
+            raise JobError("Expected a non-empty list of steps")
+
+        if len(steps) > ProfileJobsModel.MAX_MIGRATION_STEPS:
+            raise JobError("Too many steps (maximum {0})".format(ProfileJobsModel.MAX_MIGRATION_STEPS))
+
+        # fail early on malformed steps
+        for step in steps:
+            ProfileJobsModel.__migration_step__(step)
+
+        args = {
+            "steps": steps,
+            "dry_run": bool(dry_run)
+        }
+
+        if batch_delay:
+            args["batch_delay"] = ProfileJobsModel.__batch_delay__(batch_delay)
+
+        return await self.submit_job(gamespace_id, ProfileJobsModel.KIND_MIGRATION, args)
+
+    async def __process_migration__(self, job, after, bound):
+        steps = list(map(ProfileJobsModel.__migration_step__, job.args.get("steps", [])))
+
+        if job.args.get("dry_run"):
+            conditions = []
+            args = []
+
+            for condition, condition_args, payload, payload_args in steps:
+                conditions.append("({0})".format(condition))
+                args.extend(condition_args)
+
+            result = await self.db.get(
+                """
+                    SELECT COUNT(*) AS `count`
+                    FROM `account_profiles`
+                    WHERE `gamespace_id`=%s AND `account_id`>%s AND `account_id`<=%s AND ({0});
+                """.format(" OR ".join(conditions)), job.gamespace_id, after, bound, *args)
+
+            return result["count"] if result else 0
+
+        affected = 0
+
+        # the batch is a transaction on its own, so it is either migrated entirely or not at all
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                for condition, condition_args, payload, payload_args in steps:
+                    # the time of the last update is preserved, so the migration would not hold off the archive;
+                    # the public projection is rebuilt below
+                    affected += await db.execute(
+                        """
+                            UPDATE `account_profiles`
+                            SET `payload`={0}, `version`=`version`+1, `public_access`=NULL,
+                                `time_updated`=`time_updated`
+                            WHERE `gamespace_id`=%s AND `account_id`>%s AND `account_id`<=%s AND {1};
+                        """.format(payload, condition),
+                        *(payload_args + [job.gamespace_id, after, bound] + condition_args)) or 0
+
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+
+        if not affected:
+            return 0
+
+        public_access = await self.profiles.access.get_access(job.gamespace_id)
+        await self.__update_public__(
+            job.gamespace_id, [field for field in public_access.get_public() if field],
+            public_access.get_fingerprint(), after, bound)
+
+        if self.profiles.lookup is not None:
+            fields = await self.profiles.lookup.get_fields(job.gamespace_id)
+
+            if fields:
+                await self.db.execute(
+                    """
+                        DELETE FROM `profile_lookup_index`
+                        WHERE `gamespace_id`=%s AND `account_id`>%s AND `account_id`<=%s;
+                    """, job.gamespace_id, after, bound)
+
+                await self.__update_lookup__(job.gamespace_id, [field.dump() for field in fields], after, bound)
+
+        self.profiles.__invalidate_queries__(job.gamespace_id)
+
+        return affected
+
+    # clone jobs
+
+    @staticmethod
+    def __clone_payload__(args):
+        """
+        Returns a tuple of (SQL expression, its arguments) of the cloned payload, see submit_clone
+        """
+        fields = args.get("fields")
+
+        if fields:
+            payload, payload_args = ProfileJobsModel.__projection__(fields)
+        else:
+            payload, payload_args = "`payload`", []
+
+        exclude = args.get("exclude")
+
+        if exclude:
+            payload = "JSON_REMOVE({0}, {1})".format(payload, ", ".join(["%s"] * len(exclude)))
+            payload_args.extend(format_json_path(path) for path in exclude)
+
+        anonymize = args.get("anonymize")
+
+        if anonymize:
+            # the same value is replaced with the same hash, so the values stay distinct (and unique ones unique)
+            payload = "JSON_REPLACE({0}, {1})".format(payload, ", ".join(
+                "%s, SHA2(CONCAT(%s, JSON_EXTRACT(`payload`, %s)), 256)" for _ in anonymize))
+
+            for path in anonymize:
+                path = format_json_path(path)
+                payload_args.extend([path, args.get("salt", ""), path])
+
+        return payload, payload_args
+
+    async def submit_clone(self, gamespace_id, target_gamespace_id, fields=None, exclude=None, anonymize=None,
+                           overwrite=False, batch_delay=None):
+        """
+        Copies the profiles (only the top-level fields, if given) and the access into another gamespace in the
+        background. The exclude paths are stripped, the anonymize ones are replaced with salted hashes, the existing
+        profiles are replaced only if overwrite. The archived profiles are not copied
+        """
+
+        try:
+            target_gamespace_id = int(target_gamespace_id)
+        except (TypeError, ValueError):
+            raise JobError("Bad target gamespace")
+
+        if str(target_gamespace_id) == str(gamespace_id):
+            raise JobError("Cannot clone the profiles into the same gamespace")
+
+        args = {
+            "target": target_gamespace_id,
+            "overwrite": bool(overwrite),
+            # a new salt for each clone, so the hashes cannot be matched between the clones
+            "salt": base64.b64encode(os.urandom(12)).decode()
+        }
+
+        for name, value in [("fields", fields), ("exclude", exclude), ("anonymize", anonymize)]:
+            if not value:
+                continue
+            if not isinstance(value, list) or not all(isinstance(path, str) and path.strip("/") for path in value):
+                raise JobError("Expected '{0}' to be a list of paths".format(name))
+            args[name] = value
+
+        if fields and any("/" in field.strip("/") for field in fields):
+            raise JobError("Only the top-level fields may be listed in 'fields'")
+
+        if batch_delay:
+            args["batch_delay"] = ProfileJobsModel.__batch_delay__(batch_delay)
+
+        # fail early on malformed paths
+        try:
+            ProfileJobsModel.__clone_payload__(args)
+        except ProfileQueryError as e:
+            raise JobError(str(e))
+
+        source_access = await self.profiles.access.get_access(gamespace_id)
+
+        await self.profiles.access.set_access(
+            target_gamespace_id,
+            source_access.get_private(),
+            source_access.get_protected(),
+            source_access.get_public())
+
+        return await self.submit_job(gamespace_id, ProfileJobsModel.KIND_CLONE, args)
+
+    async def __process_clone__(self, job, after, bound):
+        target = job.args["target"]
+        payload, payload_args = ProfileJobsModel.__clone_payload__(job.args)
+
+        if job.args.get("overwrite"):
+            statement = """
+                INSERT INTO `account_profiles`
+                (`account_id`, `gamespace_id`, `payload`, `version`)
+                SELECT `account_id`, %s, {0}, 1
+                FROM `account_profiles`
+                WHERE `gamespace_id`=%s AND `account_id`>%s AND `account_id`<=%s
+                ON DUPLICATE KEY UPDATE `payload`=VALUES(`payload`), `version`=`version`+1,
+                    `payload_public`=NULL, `public_access`=NULL;
+            """
+        else:
+            statement = """
+                INSERT IGNORE INTO `account_profiles`
+                (`account_id`, `gamespace_id`, `payload`, `version`)
+                SELECT `account_id`, %s, {0}, 1
+                FROM `account_profiles`
+                WHERE `gamespace_id`=%s AND `account_id`>%s AND `account_id`<=%s;
+            """
+
+        affected = await self.db.execute(
+            statement.format(payload), target, *(payload_args + [job.gamespace_id, after, bound])) or 0
+
+        if not affected:
+            return 0
+
+        # the copies get the public projections and the lookup index of the target gamespace
+        public_access = await self.profiles.access.get_access(target)
+        await self.__update_public__(
+            target, [field for field in public_access.get_public() if field],
+            public_access.get_fingerprint(), after, bound)
+
+        if self.profiles.lookup is not None:
+            fields = await self.profiles.lookup.get_fields(target)
+
+            if fields:
+                await self.db.execute(
+                    """
+                        DELETE FROM `profile_lookup_index`
+                        WHERE `gamespace_id`=%s AND `account_id`>%s AND `account_id`<=%s;
+                    """, target, after, bound)
+
+                await self.__update_lookup__(target, [field.dump() for field in fields], after, bound)
+
+        self.profiles.__invalidate_queries__(target)
+
+        return affected
@@ -0,0 +1,212 @@
+
+from anthill.common.model import Model
+from anthill.common.profile import ProfileError
+from anthill.common.database import DuplicateError
+
+from . singleflight import SingleFlight
+from . statements import values_placeholder
+
+
+class LookupFieldAdapter(object):
+    def __init__(self, data):
+        self.path = data.get("field_path")
+        self.unique = bool(data.get("field_unique", 0))
+
+    def dump(self):
+        return {
+            "path": self.path,
+            "unique": self.unique
+        }
+
+
+class LookupFieldError(Exception):
+    pass
+
+
+# longer values are not indexed
+MAX_VALUE_LENGTH = 255
+
+
+def lookup_value(value):
+    """
+    Returns the value as it is stored in the index, or None if such value cannot be indexed.
+    Only strings and integers are indexed, the same way JSON_UNQUOTE(JSON_EXTRACT(...)) would return them.
+    """
+    if isinstance(value, bool):
+        return None
+
+    if isinstance(value, int):
+        return str(value)
+
+    if isinstance(value, str) and 0 < len(value) <= MAX_VALUE_LENGTH:
+        return value
+
+    return None
+
+
+def lookup_values(data, paths):
+    """
+    Returns a dict of path -> indexable value of the profile, for the given paths that have one
+    """
+    result = {}
+
+    for path in paths:
+        value = data
+
+        for key in path.split("/"):
+            if not isinstance(value, dict) or key not in value:
+                value = None
+                break
+            value = value[key]
+
+        value = lookup_value(value)
+
+        if value is not None:
+            result[path] = value
+
+    return result
+
+
+async def update_lookup_index(db, gamespace_id, fields, values):
+    """
+    Replaces the index entries of the profiles (account_id -> values, see lookup_values)
+    within the transaction of the write (db)
+    """
+
+    if not values:
+        return
+
+    await db.execute(
+        """
+            DELETE FROM `profile_lookup_index`
+            WHERE `gamespace_id`=%s AND `account_id` IN %s;
+        """, gamespace_id, list(values.keys()))
+
+    rows = 0
+    entries = []
+
+    for account_id, account_values in values.items():
+        for field in fields:
+            value = account_values.get(field.path)
+            if value is None:
+                continue
+            rows += 1
+            # the unique fields share the same discriminator, so the second account with the same value collides
+            entries.extend([gamespace_id, field.path, value, account_id, 0 if field.unique else account_id])
+
+    if not rows:
+        return
+
+    try:
+        await db.execute(
+            """
+                INSERT INTO `profile_lookup_index`
+                (`gamespace_id`, `field_path`, `field_value`, `account_id`, `field_uniq`)
+                VALUES {0};
+            """.format(values_placeholder(rows, 5)), *entries)
+    except DuplicateError:
+        raise ProfileError("The value of a unique field is already taken")
+
+
+class ProfileLookupModel(Model):
+    """
+    Maintains a reverse index (value -> accounts) of the lookup fields of a gamespace (optionally unique),
+    updated within the transaction of the write
+    """
+
+    MAX_FIELDS = 16
+
+    def __init__(self, db):
+        self.db = db
+        self.reads = SingleFlight()
+
+    def get_setup_tables(self):
+        return ["profile_lookup_fields", "profile_lookup_index"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def __get_fields__(self, gamespace_id):
+        fields = await self.db.query(
+            """
+                SELECT *
+                FROM `profile_lookup_fields`
+                WHERE `gamespace_id`=%s
+                ORDER BY `field_path`;
+            """, gamespace_id, cache_hash=('profile_lookup_fields', gamespace_id), cache_time=600)
+
+        return list(map(LookupFieldAdapter, fields))
+
+    async def get_fields(self, gamespace_id):
+        return await self.reads.do(gamespace_id, lambda: self.__get_fields__(gamespace_id))
+
+    async def add_field(self, gamespace_id, path, unique=False):
+        """
+        Declares a lookup field. The profiles that already exist are not indexed until the index is rebuilt
+        (see ProfileJobsModel.submit_lookup_rebuild)
+        """
+        path = "/".join(filter(bool, path.split("/")))
+
+        if not path or len(path) > 255:
+            raise LookupFieldError("Bad field path")
+
+        fields = await self.get_fields(gamespace_id)
+
+        if path not in [field.path for field in fields] and len(fields) >= ProfileLookupModel.MAX_FIELDS:
+            raise LookupFieldError("Too many lookup fields (maximum {0})".format(ProfileLookupModel.MAX_FIELDS))
+
+        await self.db.execute(
+            """
+                INSERT INTO `profile_lookup_fields`
+                (`gamespace_id`, `field_path`, `field_unique`)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE `field_unique`=VALUES(`field_unique`);
+            """, gamespace_id, path, int(bool(unique)),
+            cache_hash=('profile_lookup_fields', gamespace_id))
+
+        # the index has to be rebuilt with the new discriminator
+        await self.db.execute(
+            """
+                DELETE FROM `profile_lookup_index`
+                WHERE `gamespace_id`=%s AND `field_path`=%s;
+            """, gamespace_id, path)
+
+        return path
+
+    async def delete_field(self, gamespace_id, path):
+        await self.db.execute(
+            """
+                DELETE FROM `profile_lookup_fields`
+                WHERE `gamespace_id`=%s AND `field_path`=%s;
+            """, gamespace_id, path, cache_hash=('profile_lookup_fields', gamespace_id))
+
+        await self.db.execute(
+            """
+                DELETE FROM `profile_lookup_index`
+                WHERE `gamespace_id`=%s AND `field_path`=%s;
+            """, gamespace_id, path)
+
+    async def lookup(self, gamespace_id, path, value, limit=100):
+        """
+        Returns a list of the accounts that have such value in the field
+        """
+        fields = await self.get_fields(gamespace_id)
+
+        if path not in [field.path for field in fields]:
+            raise LookupFieldError("No such lookup field: {0}".format(path))
+
+        value = lookup_value(value)
+
+        if value is None:
+            return []
+
+        accounts = await self.db.query(
+            """
+                SELECT `account_id`
+                FROM `profile_lookup_index`
+                WHERE `gamespace_id`=%s AND `field_path`=%s AND `field_value`=%s
+                LIMIT %s;
+            """, gamespace_id, path, value, int(limit))
+
+        return [str(account["account_id"]) for account in accounts]
+
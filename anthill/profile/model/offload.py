@@ -0,0 +1,212 @@
+
+from anthill.common.model import Model
+
+from concurrent.futures import ProcessPoolExecutor
+
+import multiprocessing
+import asyncio
+import ujson
+
+
+class OffloadRequired(Exception):
+    """
+    Raised when fetched profiles turn out to be too big to be processed on the main thread
+    """
+    def __init__(self, raw):
+        self.raw = raw
+
+
+class OffloadError(Exception):
+    # the profile quota has been exceeded (see ProfileQuotaExceeded)
+    KIND_QUOTA = "quota"
+
+    def __init__(self, message, kind=None):
+        self.message = message
+        self.kind = kind
+
+    def __str__(self):
+        return self.message
+
+    @staticmethod
+    def wrap(e):
+        from . quota import ProfileQuotaExceeded
+        return OffloadError(e.message, OffloadError.KIND_QUOTA if isinstance(e, ProfileQuotaExceeded) else None)
+
+    def unwrap(self):
+        """
+        Returns the ProfileError the offloaded work has failed with
+        """
+        from anthill.common.profile import ProfileError
+        from . quota import ProfileQuotaExceeded
+
+        if self.kind == OffloadError.KIND_QUOTA:
+            return ProfileQuotaExceeded(self.message)
+        return ProfileError(self.message)
+
+
+class JsonOffload(Model):
+    """
+    Runs the JSON work for the big profiles in a pool of processes, so it does not block the IOLoop.
+    The profiles are passed as JSON strings, pickling them would cost as much as the work itself
+    """
+
+    def __init__(self, processes=0, threshold=262144):
+        self.processes = processes
+        self.threshold = threshold
+        self.executor = None
+
+    async def started(self, application):
+        await super(JsonOffload, self).started(application)
+
+        if self.processes:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"))
+
+    async def stopped(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+        await super(JsonOffload, self).stopped()
+
+    def should_offload(self, size):
+        return self.executor is not None and size >= self.threshold
+
+    async def run(self, func, *args):
+        result = await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+        # exceptions do not survive the trip between the processes reliably, so they are passed as values
+        if isinstance(result, OffloadError):
+            raise result
+
+        return result
+
+    async def loads(self, raw):
+        """
+        Decodes a JSON request body, in the pool if it is big enough.
+        The decoded object comes back pickled, which is still cheaper to load than JSON.
+        """
+        if not self.should_offload(len(raw)):
+            return ujson.loads(raw)
+
+        try:
+            return await self.run(decode_body, raw)
+        except OffloadError as e:
+            raise ValueError(e.message)
+
+
+# The functions below are executed in the pool processes
+
+_loop = None
+
+
+def run_sync(coroutine):
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coroutine)
+
+
+def decode_json(data):
+    if data is None:
+        return None
+    return ujson.loads(data)
+
+
+def decode_body(raw):
+    try:
+        return ujson.loads(raw)
+    except ValueError as e:
+        return OffloadError(str(e))
+
+
+def merge_profile(raw_profile, fields, path, merge, public_fields=None, lookup_paths=None, quota=None):
+    """
+    Applies the fields as UserProfile.set_data does. Returns a tuple of (new profile, public projection,
+    lookup values, result), all encoded except the lookup values
+    """
+    from anthill.common.profile import ProfileError, FuncError
+    from . profile import ProfileDocument, UserProfile, public_projection
+    from . lookup import lookup_values
+    from . quota import path_sizes, encoded_size, check_paths_quota, check_size_quota
+
+    document = ProfileDocument(decode_json(raw_profile))
+    previous = path_sizes(document.data, quota.paths.keys()) if quota and quota.paths and document.data else None
+    previous_size = encoded_size(document.data) if quota and quota.max_size else 0
+
+    try:
+        result = run_sync(document.set_data(fields, path, merge=merge))
+        UserProfile.__process_dates__(document.data)
+        check_paths_quota(quota, document.data, previous)
+        encoded = ujson.dumps(document.data)
+        check_size_quota(quota, len(encoded), previous_size)
+    except (FuncError, ProfileError) as e:
+        return OffloadError.wrap(e)
+
+    encoded_public = None
+
+    if public_fields is not None:
+        encoded_public = ujson.dumps(public_projection(document.data, public_fields))
+
+    values = lookup_values(document.data, lookup_paths) if lookup_paths else {}
+
+    return encoded, encoded_public, values, ujson.dumps(result)
+
+
+def merge_profiles(raw_profiles, fields, merge, public_fields=None, lookup_paths=None, quota=None):
+    """
+    Applies the fields as UserProfiles.set_data does. Returns a tuple of (account -> new profile,
+    account -> public projection, account -> lookup values, result), encoded as merge_profile does
+    """
+    from anthill.common.profile import ProfileError, FuncError
+    from . profile import ProfileDocument, UserProfiles, public_projection
+    from . lookup import lookup_values
+    from . quota import path_sizes, encoded_size, check_paths_quota, check_size_quota
+
+    document = ProfileDocument({
+        account_id: decode_json(raw_profile)
+        for account_id, raw_profile in raw_profiles.items()
+    })
+
+    previous = {}
+    previous_sizes = {}
+
+    if quota and quota.max_size:
+        previous_sizes = {
+            account_id: encoded_size(account_profile)
+            for account_id, account_profile in document.data.items()
+        }
+
+    if quota and quota.paths:
+        previous = {
+            account_id: path_sizes(account_profile, quota.paths.keys())
+            for account_id, account_profile in document.data.items()
+            if account_profile is not None
+        }
+
+    try:
+        result = run_sync(document.set_data(fields, None, merge=merge))
+    except (FuncError, ProfileError) as e:
+        return OffloadError.wrap(e)
+
+    encoded = {}
+    encoded_public = {} if public_fields is not None else None
+    values = {}
+
+    for account_id, account_profile in document.data.items():
+        UserProfiles.__process_dates__(account_profile)
+        encoded[account_id] = ujson.dumps(account_profile)
+
+        try:
+            check_paths_quota(quota, account_profile, previous.get(account_id))
+            check_size_quota(quota, len(encoded[account_id]), previous_sizes.get(account_id, 0))
+        except ProfileError as e:
+            return OffloadError.wrap(e)
+
+        if encoded_public is not None:
+            encoded_public[account_id] = ujson.dumps(public_projection(account_profile, public_fields))
+        if lookup_paths:
+            values[account_id] = lookup_values(account_profile, lookup_paths)
+
+    return encoded, encoded_public, values, ujson.dumps(result)
@@ -1,11 +1,24 @@
 
 from . access import ProfileAccessModel
+from . singleflight import SingleFlight
+from . lookup import lookup_values, update_lookup_index
+from . cache import QueryCache
+from . statements import StatementCache, values_placeholder
+from . offload import OffloadRequired, OffloadError, merge_profile, merge_profiles
+from . quota import ProfileQuotaExceeded, path_sizes, encoded_size, check_paths_quota, check_size_quota
+from . counters import split_increments, touched_counters, apply_counters, sum_shards, SHARDS_COLUMN
 
 from anthill.common import access, profile
 from anthill.common.profile import ProfileError, FuncError, NoDataError
 from anthill.common.model import Model
-from anthill.common.database import DatabaseError, format_conditions_json, ConditionError
-
+from anthill.common.database import DatabaseError, DuplicateError, format_conditions_json, ConditionError
+from anthill.common.database import ConditionFunctions
+
+import collections
+import asyncio
+import random
+import base64
+import copy
 import ujson
 
 
@@ -17,64 +30,447 @@ class ProfileQueryError(Exception):
     pass
 
 
+class ProfileQueryTooExpensive(ProfileQueryError):
+    """
+    The query is estimated to examine too many rows (see QueryGuard)
+    """
+    def __init__(self, estimate, max_rows):
+        super(ProfileQueryTooExpensive, self).__init__(
+            "The query is too expensive: about {0} rows to examine (at most {1} allowed), "
+            "consider running it in background".format(estimate, max_rows))
+        self.estimate = estimate
+
+
+class ProfileVersionError(Exception):
+    """
+    The profile has a version, different from the one the write was conditioned on
+    """
+    def __init__(self, version):
+        self.version = version
+
+
+class ProfileConflictError(Exception):
+    """
+    Raised by an optimistic write if somebody has updated the profile concurrently
+    """
+    pass
+
+
+def format_json_path(path):
+    """
+    Converts a profile path (either "a/b/c" or ["a", "b", "c"]) into MySQL JSON path
+    """
+    if isinstance(path, str):
+        path = path.split("/")
+
+    keys = [
+        '"' + key.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        for key in path if key
+    ]
+
+    if not keys:
+        raise ProfileQueryError("Empty profile path")
+
+    return "$." + ".".join(keys)
+
+
+def filter_shape(value):
+    """
+    Returns what the SQL of a filter (see format_conditions_json) depends on besides its path:
+    the operator, and the number of values of "in"
+    """
+    if isinstance(value, list):
+        return "in", len(value)
+
+    if isinstance(value, dict):
+        values = value.get("@values")
+        return value.get("@func"), len(values) if isinstance(values, list) else None
+
+    return "=", None
+
+
+def filter_values(path, value):
+    """
+    Returns the arguments of the SQL of a filter, the same ones format_conditions_json does
+    """
+    if isinstance(value, bool):
+        return [ConditionFunctions.format_path(path), "true" if value else "false"]
+
+    if isinstance(value, (str, int, float)):
+        return [ConditionFunctions.format_path(path), str(value)]
+
+    if isinstance(value, list):
+        value = {"@func": "in", "@values": value}
+
+    if not isinstance(value, dict) or value.get("@func") not in FILTER_VALUES:
+        raise ConditionError("Bad value!")
+
+    if value["@func"] == "in":
+        # unlike the others, the path goes before each value, and is not split by the dots
+        return [arg for item in __filter_set__(value) for arg in ('$."{0}"'.format(path), item)]
+
+    return [ConditionFunctions.format_path(path)] + FILTER_VALUES[value["@func"]](value)
+
+
+def __filter_value__(obj, key="@value", types=(int, float)):
+    if key not in obj:
+        raise ConditionError("Value not passed")
+    if not isinstance(obj[key], types):
+        raise ConditionError("Bad value")
+    return obj[key]
+
+
+def __filter_set__(obj):
+    values = obj.get("@values")
+
+    if not isinstance(values, list) or not values:
+        raise ConditionError("Bad @values")
+
+    for value in values:
+        if not isinstance(value, (str, int, float, bool)):
+            raise ConditionError("Bad @value")
+
+    return values
+
+
+# operator -> the arguments of the filter after the path
+FILTER_VALUES = {
+    "=": lambda obj: [str(__filter_value__(obj, types=(str, int, float, bool)))],
+    ">": lambda obj: [__filter_value__(obj)],
+    "<": lambda obj: [__filter_value__(obj)],
+    ">=": lambda obj: [__filter_value__(obj)],
+    "<=": lambda obj: [__filter_value__(obj)],
+    "!=": lambda obj: [__filter_value__(obj)],
+    "between": lambda obj: [__filter_value__(obj, "@a"), __filter_value__(obj, "@b")],
+    "in": __filter_set__
+}
+
+
 class ProfileAdapter(object):
+    """
+    A profile found by a query. The payload is kept as JSON string as it came from the database,
+    and only decoded upon first access to the profile.
+    """
+
+    __slots__ = ("account", "raw", "_profile")
+
     def __init__(self, data):
         self.account = str(data.get("account_id"))
-        self.profile = data.get("payload")
+        self.raw = data.get("payload")
+        self._profile = None
+
+    @property
+    def profile(self):
+        if self._profile is None and self.raw is not None:
+            if isinstance(self.raw, (str, bytes)):
+                self._profile = ujson.loads(self.raw)
+            else:
+                self._profile = self.raw
+            # no need to keep both
+            self.raw = None
+        return self._profile
 
 
 class ProfileQuery(object):
-    def __init__(self, gamespace_id, db):
+    AGGREGATE_FUNCTIONS = {
+        "count": "COUNT",
+        "sum": "SUM",
+        "min": "MIN",
+        "max": "MAX",
+        "avg": "AVG"
+    }
+
+    MAX_GROUPS = 1000
+
+    def __init__(self, gamespace_id, db, columns=None, guard=None, cache=None, statements=None):
         self.gamespace_id = gamespace_id
         self.db = db
+        # profile paths that have indexed generated columns, path -> column name
+        self.columns = columns or {}
+        # a QueryGuard to plan the queries with (if any)
+        self.guard = guard
+        # a QueryCache to keep the results in (if any)
+        self.cache = cache if cache is not None and cache.is_enabled() else None
+        # a StatementCache to keep the SQL built for the filters in (if any)
+        self.statements = statements
 
         self.filters = None
 
         self.offset = 0
         self.limit = 0
 
-    def __values__(self):
-        conditions = [
-            "`account_profiles`.`gamespace_id`=%s"
-        ]
+        # if set, only these (top level) fields of the profiles are fetched
+        self.fields = None
 
-        data = [
-            str(self.gamespace_id)
-        ]
+        # a profile path to sort the results by, ties are broken by account_id
+        self.order_by = None
+        self.order_desc = False
+
+        # a cursor to continue from, as returned in next_cursor of the previous query
+        self.after = None
+        self.next_cursor = None
+
+        # set by a grouped aggregate if there were more than MAX_GROUPS groups
+        self.truncated = False
+
+    @staticmethod
+    def __encode_cursor__(value, account_id):
+        return base64.urlsafe_b64encode(ujson.dumps([value, account_id]).encode()).decode()
+
+    @staticmethod
+    def __decode_cursor__(cursor):
+        try:
+            value, account_id = ujson.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return value, int(account_id)
+        except (ValueError, TypeError):
+            raise ProfileQueryError("Corrupted cursor")
+
+    def __filter_key__(self):
+        # the paths and the operators only, the values are bound on each query
+        return tuple(
+            (path, filter_shape(value))
+            for path, value in self.filters.items()
+        ) if self.filters else ()
+
+    def __conditions__(self):
+        conditions = []
+        data = []
 
         if self.filters:
             for condition, values in format_conditions_json('payload', self.filters):
                 conditions.append(condition)
                 data.extend(values)
 
-        return conditions, data
+        return tuple(conditions), tuple(data)
+
+    def __shared__(self):
+        # the filters that are not even a dict are left to format_conditions_json to complain about
+        return self.statements is not None and (not self.filters or isinstance(self.filters, dict))
+
+    def __values__(self):
+        if self.__shared__():
+            conditions = self.statements.get(("conditions", self.__filter_key__()), lambda: self.__conditions__()[0])
+            data = [
+                arg
+                for path, value in (self.filters or {}).items()
+                for arg in filter_values(path, value)
+            ]
+        else:
+            conditions, data = self.__conditions__()
+
+        return ["`account_profiles`.`gamespace_id`=%s"] + list(conditions), [str(self.gamespace_id)] + list(data)
+
+    async def __execute__(self, query, data, execute):
+        if self.guard is None:
+            return await execute()
+        return await self.guard.run(self.db, self.gamespace_id, self.filters, query, data, execute)
+
+    def __field__(self, path):
+        """
+        Returns SQL expression (and its arguments) that extracts a field by path from the profile,
+        using the indexed generated column if there is one for this path
+        """
+        key = path if isinstance(path, str) else "/".join(path)
+        column = self.columns.get(key.strip("/"))
+        if column:
+            return "`{0}`".format(column), []
+        return "JSON_EXTRACT(`payload`, %s)", [format_json_path(path)]
+
+    async def aggregate(self, function, field=None, group_by=None, bucket=None):
+        """
+        Aggregates the field with the function (count, sum, min, max, avg) over the profiles matching the filters.
+        If group_by is set, returns a dict of group (or a range of bucket size) -> value, MAX_GROUPS of them at most,
+        and sets self.truncated if there were more
+        """
+
+        if function not in ProfileQuery.AGGREGATE_FUNCTIONS:
+            raise ProfileQueryError("No such aggregate function: {0}".format(function))
+
+        cache_key = None
+
+        if self.cache:
+            cache_key = QueryCache.key(self.gamespace_id, "aggregate", self.filters, function, field, group_by, bucket)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                value, self.truncated = cached
+                return value
 
-    async def query(self, one=False, count=False):
         try:
             conditions, data = self.__values__()
         except ConditionError as e:
             raise ProfileQueryError("Failed to process profile conditions: {0}".format(str(e)))
 
+        columns = []
+        args = []
+
+        if field:
+            expression, expression_args = self.__field__(field)
+            if function != "count":
+                expression = "CAST({0} AS DECIMAL(65,10))".format(expression)
+            columns.append("{0}({1}) AS `value`".format(ProfileQuery.AGGREGATE_FUNCTIONS[function], expression))
+            args.extend(expression_args)
+        elif function == "count":
+            columns.append("COUNT(*) AS `value`")
+        else:
+            raise ProfileQueryError("Aggregate function {0} requires a field".format(function))
+
+        if group_by:
+            expression, expression_args = self.__field__(group_by)
+            if bucket:
+                try:
+                    bucket = float(bucket)
+                except (TypeError, ValueError):
+                    raise ProfileQueryError("Bucket should be a number")
+                if bucket <= 0:
+                    raise ProfileQueryError("Bucket should be positive")
+                expression = "FLOOR({0} / %s) * %s".format(expression)
+                expression_args = expression_args + [bucket, bucket]
+            else:
+                expression = "JSON_UNQUOTE({0})".format(expression)
+
+            columns.append("{0} AS `group`".format(expression))
+            args.extend(expression_args)
+
         query = """
-            SELECT {0} `account_id`, `payload` FROM `account_profiles`
+            SELECT {0} FROM `account_profiles`
             WHERE {1}
-        """.format(
-            "SQL_CALC_FOUND_ROWS" if count else "",
-            " AND ".join(conditions))
+        """.format(", ".join(columns), " AND ".join(conditions))
 
-        if self.limit:
+        args.extend(data)
+
+        if group_by:
             query += """
-                LIMIT %s,%s
+                GROUP BY `group`
+                ORDER BY `group`
+                LIMIT %s
             """
+            # one more to know if there are more
+            args.append(ProfileQuery.MAX_GROUPS + 1)
+
+        query += ";"
+
+        try:
+            result = await self.__execute__(query, args, lambda: self.db.query(query, *args))
+        except DatabaseError as e:
+            raise ProfileQueryError("Failed to aggregate profiles: " + e.args[1])
+
+        def number(value):
+            if value is None:
+                return None
+            value = float(value)
+            return int(value) if value.is_integer() else value
+
+        self.truncated = False
+
+        if group_by:
+            if len(result) > ProfileQuery.MAX_GROUPS:
+                result = result[:ProfileQuery.MAX_GROUPS]
+                self.truncated = True
+
+            value = {
+                str(number(row["group"]) if bucket else row["group"]): number(row["value"])
+                for row in result
+            }
+        else:
+            value = number(result[0]["value"]) if result else None
+
+        if cache_key:
+            # wrapped, so a cached None is not a miss
+            self.cache.put(self.gamespace_id, cache_key, (value, self.truncated),
+                           QueryCache.ROW_OVERHEAD * (len(value) + 1 if group_by else 1))
+
+        return value
+
+    async def query(self, one=False, count=False):
+        cache_key = None
+
+        if self.cache and not one:
+            cache_key = QueryCache.key(
+                self.gamespace_id, "query", self.filters, self.fields, self.order_by, self.order_desc,
+                self.after, int(self.offset), int(self.limit))
+
+            cached = self.cache.get(cache_key)
+
+            # the results cached along with the count do for both kinds of queries
+            if cached is not None and (cached[1] is not None or not count):
+                rows, count_result, self.next_cursor = cached
+                items = map(ProfileAdapter, rows)
+
+                if count:
+                    return items, count_result
+
+                return items
+
+        try:
+            conditions, data = self.__values__()
+        except ConditionError as e:
+            raise ProfileQueryError("Failed to process profile conditions: {0}".format(str(e)))
+
+        columns = ["`account_id`"]
+        column_args = []
+
+        if self.fields:
+            columns.append("CAST(JSON_OBJECT({0}) AS CHAR) AS `payload`".format(
+                ", ".join("%s, JSON_EXTRACT(`payload`, %s)" for _ in self.fields)))
+            for field in self.fields:
+                column_args.extend([field, format_json_path([field])])
+        else:
+            columns.append("CAST(`payload` AS CHAR) AS `payload`")
+
+        if self.order_by:
+            order, order_args = self.__field__(self.order_by)
+            columns.append("{0} AS `order_value`".format(order))
+            column_args.extend(order_args)
+
+            # profiles without the field cannot be positioned by a cursor, so they are left out
+            conditions.append("{0} IS NOT NULL".format(order))
+            data.extend(order_args)
+
+            if self.after:
+                after_value, after_account = ProfileQuery.__decode_cursor__(self.after)
+                conditions.append("({0} {1} %s OR ({0} = %s AND `account_id` {1} %s))".format(
+                    order, "<" if self.order_desc else ">"))
+                data.extend(order_args + [after_value] + order_args + [after_value, after_account])
+
+        def build():
+            statement = """
+                SELECT {0} {1} FROM `account_profiles`
+                WHERE {2}
+            """.format(
+                "SQL_CALC_FOUND_ROWS" if count else "",
+                ", ".join(columns),
+                " AND ".join(conditions))
+
+            if self.order_by:
+                statement += """
+                    ORDER BY `order_value` {0}, `account_id` {0}
+                """.format("DESC" if self.order_desc else "ASC")
+
+            if self.limit:
+                statement += """
+                    LIMIT %s,%s
+                """
+
+            return statement + ";"
+
+        if self.__shared__():
+            query = self.statements.get((
+                "query", self.__filter_key__(), tuple(self.fields or ()),
+                self.order_by if isinstance(self.order_by, str) else tuple(self.order_by or ()),
+                bool(self.order_desc), bool(self.after), bool(self.limit), bool(count)), build)
+        else:
+            query = build()
+
+        # the column arguments go before the conditions ones
+        data = column_args + data
 
+        if self.limit:
             data.append(int(self.offset))
             data.append(int(self.limit))
 
-        query += ";"
-
         if one:
             try:
-                result = await self.db.get(query, *data)
+                result = await self.__execute__(query, data, lambda: self.db.get(query, *data))
             except DatabaseError as e:
                 raise ProfileQueryError("Failed to get profiles: " + e.args[1])
 
@@ -83,19 +479,33 @@ class ProfileQuery(object):
 
             return ProfileAdapter(result)
         else:
+            async def execute():
+                async with self.db.acquire() as db:
+                    rows = await db.query(query, *data)
+                    if not count:
+                        return rows, 0
+                    # right after the query on the same connection, the guard plans the slow ones afterwards
+                    found = await db.get(
+                        """
+                            SELECT FOUND_ROWS() AS count;
+                        """)
+                    return rows, found["count"]
+
             try:
-                result = await self.db.query(query, *data)
+                result, count_result = await self.__execute__(query, data, execute)
             except DatabaseError as e:
                 raise ProfileQueryError("Failed to query profiles: " + e.args[1])
 
-            count_result = 0
+            if self.order_by and self.limit and len(result) >= int(self.limit):
+                last = result[-1]
+                self.next_cursor = ProfileQuery.__encode_cursor__(last["order_value"], last["account_id"])
+            else:
+                self.next_cursor = None
 
-            if count:
-                count_result = await self.db.get(
-                    """
-                        SELECT FOUND_ROWS() AS count;
-                    """)
-                count_result = count_result["count"]
+            if cache_key:
+                self.cache.put(self.gamespace_id, cache_key,
+                               (result, count_result if count else None, self.next_cursor),
+                               QueryCache.rows_size(result))
 
             items = map(ProfileAdapter, result)
 
@@ -105,14 +515,260 @@ class ProfileQuery(object):
             return items
 
 
+async def restore_archived_profiles(db, gamespace_id, account_ids):
+    """
+    Moves the profiles back from the archive within the transaction of db, returns how many were restored.
+    A concurrent restore restores nothing, so the profiles are to be read again with a locking read anyway
+    """
+    archived = await db.query(
+        """
+            SELECT `account_id`
+            FROM `account_profiles_archive`
+            WHERE `gamespace_id`=%s AND `account_id` IN %s
+            FOR UPDATE;
+        """, gamespace_id, account_ids)
+
+    if not archived:
+        return 0
+
+    account_ids = [row["account_id"] for row in archived]
+
+    await db.execute(
+        """
+            INSERT IGNORE INTO `account_profiles`
+            (`account_id`, `gamespace_id`, `payload`, `version`)
+            SELECT `account_id`, `gamespace_id`, CAST(CAST(UNCOMPRESS(`payload`) AS CHAR) AS JSON), `version`
+            FROM `account_profiles_archive`
+            WHERE `gamespace_id`=%s AND `account_id` IN %s;
+        """, gamespace_id, account_ids)
+
+    await db.execute(
+        """
+            DELETE FROM `account_profiles_archive`
+            WHERE `gamespace_id`=%s AND `account_id` IN %s;
+        """, gamespace_id, account_ids)
+
+    return len(account_ids)
+
+
+class RawJSON(str):
+    """
+    A result that is already encoded as JSON (see JsonOffload), to be passed to the client as is
+    """
+    pass
+
+
+class ProfileDocument(profile.Profile):
+    """
+    A profile that lives in memory only. Used to apply changes (with the same merge and function semantics)
+    to the profiles already fetched (and locked) by other means.
+    """
+
+    # noinspection PyShadowingNames
+    def __init__(self, data):
+        super(ProfileDocument, self).__init__()
+        self.data = data
+
+    async def get(self):
+        if self.data is None:
+            raise profile.NoDataError()
+        return self.data
+
+    async def insert(self, data):
+        self.data = data
+
+    async def update(self, data):
+        self.data = data
+
+
+def public_projection(data, public_fields):
+    """
+    Returns the part of the profile everybody may see
+    """
+    if not isinstance(data, dict):
+        return {}
+
+    return {
+        field: data[field]
+        for field in public_fields
+        if field and field in data
+    }
+
+
+def extract_path(data, path):
+    """
+    Returns the part of the profile by path, or None if there's no such
+    """
+    for key in path or []:
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+class ProfilePreconditionError(Exception):
+    def __init__(self, index, message):
+        self.index = index
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+# MySQL errors upon which the whole transaction could be just retried
+RETRY_ERRORS = (
+    1205,  # lock wait timeout exceeded
+    1213,  # deadlock found when trying to get lock
+)
+
+
+def is_retryable(e):
+    return bool(e.args) and e.args[0] in RETRY_ERRORS
+
+
+PRECONDITIONS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    "exists": lambda a, b: a is not None,
+    "not_exists": lambda a, b: a is None
+}
+
+
+def check_precondition(data, path, op, value):
+    """
+    Checks a condition like "gold >= 100" against a profile
+    """
+    if op not in PRECONDITIONS:
+        raise ProfileError("No such precondition operation: {0}".format(op))
+
+    current = extract_path(data, path)
+
+    if current is None and op not in ("exists", "not_exists", "==", "!="):
+        return False
+
+    try:
+        return PRECONDITIONS[op](current, value)
+    except TypeError:
+        return False
+
+
+class BatchOperationError(Exception):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+    def dump(self):
+        return {
+            "error": {
+                "code": self.code,
+                "message": self.message
+            }
+        }
+
+
 class ProfilesModel(Model):
     TIME_CREATED = "@time_created"
     TIME_UPDATED = "@time_updated"
 
+    BATCH_ACTIONS = ["get", "update", "query"]
+    MAX_BATCH_OPERATIONS = 1000
+
+    # the tables that hold the data of the profiles
+    PROFILE_TABLES = ["account_profiles", "account_profiles_archive", "profile_lookup_index",
+                      "profile_counter_shards"]
+    # how many profiles are deleted (or changed) within a single transaction
+    DELETE_CHUNK = 500
+
     # noinspection PyShadowingNames
-    def __init__(self, db, access):
+    def __init__(self, db, access, optimistic_writes=False, optimistic_retries=5, optimistic_backoff=0.02,
+                 indexed_fields=None, offload=None, lookup=None, guard=None, cache=None, statements=None,
+                 changes=None, quotas=None, counters=None):
         self.db = db
         self.access = access
+        # a ProfileCountersModel to keep the increments of the counter fields in (if any)
+        self.counters = counters
+        # a ProfileQuotaModel to limit the size of the profiles with (if any)
+        self.quotas = quotas
+        # a ProfileChangesModel to notify the subscribers about the changes with (if any)
+        self.changes = changes
+        # a ProfileLookupModel to maintain the lookup index with (if any)
+        self.lookup = lookup
+        # a QueryGuard to protect the database from the expensive queries with (if any)
+        self.guard = guard
+        # a QueryCache to keep the query results in (if any)
+        self.cache = cache
+        self.statements = statements if statements is not None else StatementCache()
+        # a JsonOffload to process the writes of the big profiles with (if any)
+        self.offload = offload
+        # profile paths that have indexed generated columns on `account_profiles`, path -> column name
+        self.indexed_fields = indexed_fields or {}
+
+        self.stats = collections.Counter()
+        # concurrent reads of the same profile (a popular account being viewed by many) share one fetch
+        self.reads = SingleFlight(self.stats, "coalesced_reads")
+
+        self.optimistic_writes = optimistic_writes
+        self.optimistic_retries = optimistic_retries
+        self.optimistic_backoff = optimistic_backoff
+
+    async def __lookup_fields__(self, gamespace_id):
+        if self.lookup is None:
+            return None
+        return await self.lookup.get_fields(gamespace_id)
+
+    async def __quota__(self, gamespace_id):
+        if self.quotas is None:
+            return None
+        quota = await self.quotas.get_quota(gamespace_id)
+        return None if quota.is_empty() else quota
+
+    async def __counter_fields__(self, gamespace_id):
+        if self.counters is None:
+            return None
+        return await self.counters.get_fields(gamespace_id)
+
+    async def has_counters(self, gamespace_id):
+        """
+        The profiles of the gamespace may change without their version being changed, see ProfileCountersModel
+        """
+        return bool(await self.__counter_fields__(gamespace_id))
+
+    async def __add_counters__(self, gamespace_id, path, data, sums, public_fields=None):
+        """
+        Adds the increments of the counter fields not folded into the profile yet (counter path -> sum,
+        read along with the data, see SHARDS_COLUMN) to the data read
+        """
+        fields = await self.__counter_fields__(gamespace_id)
+
+        if not fields or not sums:
+            return data
+
+        sums = {
+            field.path: sums[field.path] for field in fields
+            if field.path in sums and (public_fields is None or field.path.split("/")[0] in public_fields)
+        }
+
+        if not sums:
+            return data
+
+        return apply_counters(data, path, sums)
+
+    def __user_profile__(self, gamespace_id, account_id, version=None, public_access=None, lookup_fields=None,
+                         quota=None):
+        return UserProfile(
+            self.db, gamespace_id, account_id,
+            version=version,
+            optimistic=self.optimistic_writes,
+            retries=self.optimistic_retries,
+            backoff=self.optimistic_backoff,
+            offload=self.offload,
+            public_access=public_access,
+            lookup_fields=lookup_fields,
+            quota=quota)
 
     def get_setup_tables(self):
         return ["account_profiles"]
@@ -124,45 +780,284 @@ class ProfilesModel(Model):
         return True
 
     async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+        for table in ProfilesModel.PROFILE_TABLES:
+            if gamespace_only:
+                await self.db.execute(
+                    """
+                        DELETE FROM `{0}`
+                        WHERE `gamespace_id`=%s AND `account_id` IN %s;
+                    """.format(table), gamespace, accounts)
+            else:
+                await self.db.execute(
+                    """
+                        DELETE FROM `{0}`
+                        WHERE `account_id` IN %s;
+                    """.format(table), accounts)
+
         if gamespace_only:
+            self.__invalidate_queries__(gamespace)
+
+    async def delete_profile(self, gamespace_id, account_id):
+        for table in ProfilesModel.PROFILE_TABLES:
             await self.db.execute(
                 """
-                    DELETE FROM `account_profiles`
-                    WHERE `gamespace_id`=%s AND `account_id` IN %s;
-                """, gamespace, accounts)
-        else:
-            await self.db.execute(
-                """
-                    DELETE FROM `account_profiles`
-                    WHERE `account_id` IN %s;
-                """, accounts)
+                    DELETE FROM `{0}`
+                    WHERE `account_id`=%s AND `gamespace_id`=%s;
+                """.format(table), account_id, gamespace_id)
 
-    async def delete_profile(self, gamespace_id, account_id):
-        await self.db.execute(
+    async def __restore__(self, gamespace_id, account_ids):
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                restored = await restore_archived_profiles(db, gamespace_id, account_ids)
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+        return restored
+
+    @staticmethod
+    def __chunks__(account_ids):
+        """
+        Splits the accounts into chunks in primary key order, so the concurrent operations over the overlapping
+        sets of accounts lock the rows in the same order and do not deadlock
+        """
+        try:
+            account_ids = sorted(set(int(account_id) for account_id in account_ids))
+        except (TypeError, ValueError):
+            raise ProfileError("Bad account id")
+
+        for i in range(0, len(account_ids), ProfilesModel.DELETE_CHUNK):
+            yield account_ids[i:i + ProfilesModel.DELETE_CHUNK]
+
+    async def delete_profiles(self, gamespace_id, account_ids):
+        """
+        Deletes the profiles of several accounts, chunk by chunk. Returns how many profiles have been deleted.
+        """
+        deleted = 0
+
+        for chunk in ProfilesModel.__chunks__(account_ids):
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    for table in ProfilesModel.PROFILE_TABLES:
+                        affected = await db.execute(
+                            """
+                                DELETE FROM `{0}`
+                                WHERE `gamespace_id`=%s AND `account_id` IN %s;
+                            """.format(table), gamespace_id, chunk)
+
+                        if table == "account_profiles":
+                            deleted += affected or 0
+
+                    await db.commit()
+                except BaseException:
+                    await db.rollback()
+                    raise
+
+        if len(account_ids) > 1:
+            self.__invalidate_queries__(gamespace_id)
+
+        return deleted
+
+    async def delete_profiles_path(self, gamespace_id, account_ids, path):
+        """
+        Removes a part of the profiles (by path) right in the database, without reading and writing
+        the whole profiles (the archived ones included). Returns how many of the profiles had it.
+        """
+        keys = list(filter(bool, path.split("/"))) if isinstance(path, str) else list(path or [])
+
+        if not keys:
+            raise ProfileError("Path is required, use delete_profiles to delete the whole profiles")
+
+        json_path = format_json_path(keys)
+        time_path = format_json_path([ProfilesModel.TIME_UPDATED])
+        now = access.utc_time()
+
+        # the lookup fields at (or under) the path lose their values
+        lookup_fields = [
+            field.path
+            for field in (await self.__lookup_fields__(gamespace_id) or [])
+            if field.path.split("/")[:len(keys)] == keys
+        ]
+
+        deleted = 0
+
+        for chunk in ProfilesModel.__chunks__(account_ids):
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    # the archived profiles stay archived, the path is removed from them in place
+                    archived = await db.execute(
+                        """
+                            UPDATE `account_profiles_archive`
+                            SET `payload`=COMPRESS(CAST(JSON_SET(JSON_REMOVE(
+                                    CAST(CAST(UNCOMPRESS(`payload`) AS CHAR) AS JSON), %s), %s, %s) AS CHAR)),
+                                `version`=`version`+1, `time_updated`=`time_updated`
+                            WHERE `gamespace_id`=%s AND `account_id` IN %s AND
+                                JSON_CONTAINS_PATH(CAST(CAST(UNCOMPRESS(`payload`) AS CHAR) AS JSON), 'one', %s);
+                        """, json_path, time_path, now, gamespace_id, chunk, json_path) or 0
+
+                    # the public projection has the same structure, so the same path is removed from it too
+                    affected = await db.execute(
+                        """
+                            UPDATE `account_profiles`
+                            SET `payload`=JSON_SET(JSON_REMOVE(`payload`, %s), %s, %s),
+                                `payload_public`=JSON_REPLACE(JSON_REMOVE(`payload_public`, %s), %s, %s),
+                                `version`=`version`+1
+                            WHERE `gamespace_id`=%s AND `account_id` IN %s AND JSON_CONTAINS_PATH(`payload`, 'one', %s);
+                        """, json_path, time_path, now, json_path, time_path, now, gamespace_id, chunk, json_path) or 0
+
+                    affected += archived
+
+                    if affected and lookup_fields:
+                        await db.execute(
+                            """
+                                DELETE FROM `profile_lookup_index`
+                                WHERE `gamespace_id`=%s AND `account_id` IN %s AND `field_path` IN %s;
+                            """, gamespace_id, chunk, lookup_fields)
+
+                    await db.commit()
+                except BaseException:
+                    await db.rollback()
+                    raise
+
+            deleted += affected
+
+        self.stats["writes"] += deleted
+
+        if deleted > 1:
+            self.__invalidate_queries__(gamespace_id)
+
+        if deleted:
+            # which ones have actually had the path is not known, the subscribers check the versions
+            self.__publish_changes__(gamespace_id, [
+                (account_id, [keys[0]], None)
+                for account_id in account_ids
+            ])
+
+        return deleted
+
+    async def next_batch(self, gamespace_id, after, batch_size):
+        """
+        Returns (the last account_id, number of profiles) of the next batch after the account, in primary key order
+        """
+        result = await self.db.get(
             """
-                DELETE FROM `account_profiles`
-                WHERE `account_id`=%s AND `gamespace_id`=%s;
-            """, account_id, gamespace_id)
+                SELECT MAX(`account_id`) AS `bound`, COUNT(*) AS `count` FROM (
+                    SELECT `account_id`
+                    FROM `account_profiles`
+                    WHERE `gamespace_id`=%s AND `account_id`>%s
+                    ORDER BY `account_id`
+                    LIMIT %s
+                ) AS `batch`;
+            """, gamespace_id, after, batch_size)
+
+        if not result or not result["count"]:
+            return None, 0
+
+        return result["bound"], result["count"]
 
     def profile_query(self, gamespace_id):
-        return ProfileQuery(gamespace_id, self.db)
+        return ProfileQuery(gamespace_id, self.db, columns=self.indexed_fields, guard=self.guard, cache=self.cache,
+                            statements=self.statements)
 
-    async def get_profile_data(self, gamespace_id, account_id, path):
-        user_profile = UserProfile(
-            self.db,
-            gamespace_id,
-            account_id)
+    @staticmethod
+    def __changed_fields__(fields, path):
+        """
+        Returns the top-level fields a write of the fields (at path) changes
+        """
+        if path:
+            return [path[0]]
+        return list(fields.keys())
+
+    def __publish_changes__(self, gamespace_id, changes):
+        if self.changes is not None:
+            self.changes.publish(gamespace_id, changes)
+
+    def __invalidate_queries__(self, gamespace_id):
+        """
+        Called after the bulk operations, the single profile writes only make the cached results bounded-stale
+        """
+        if self.cache is not None:
+            self.cache.invalidate(gamespace_id)
+
+    async def get_profile_data(self, gamespace_id, account_id, path, with_version=False):
+        user_profile = self.__user_profile__(gamespace_id, account_id)
+        user_profile.counted = await self.has_counters(gamespace_id)
+        self.stats["reads"] += 1
 
         try:
             data = await user_profile.get_data(path)
         except NoDataError:
             raise NoSuchProfileError()
 
+        if user_profile.counted:
+            data = await self.__add_counters__(gamespace_id, path, data, sum_shards(user_profile.counter_shards))
+
+        if with_version:
+            return data, user_profile.version
+
         return data
 
-    async def get_profile_me(self, gamespace_id, account_id, path):
-        
-        profile_data = await self.get_profile_data(gamespace_id, account_id, path)
+    async def get_profile_data_raw(self, gamespace_id, account_id, path):
+        """
+        Returns a tuple of (the profile, or its part by path, as JSON string straight from the database, version)
+        """
+        counted = await self.has_counters(gamespace_id)
+        shards = (", " + SHARDS_COLUMN) if counted else ""
+
+        async def fetch():
+            if path:
+                return await self.db.get(
+                    """
+                        SELECT CAST(JSON_EXTRACT(`payload`, %s) AS CHAR) AS `payload`, `version`{0}
+                        FROM `account_profiles`
+                        WHERE `account_id`=%s AND `gamespace_id`=%s;
+                    """.format(shards), format_json_path(path), account_id, gamespace_id)
+            else:
+                return await self.db.get(
+                    """
+                        SELECT CAST(`payload` AS CHAR) AS `payload`, `version`{0}
+                        FROM `account_profiles`
+                        WHERE `account_id`=%s AND `gamespace_id`=%s;
+                    """.format(shards), account_id, gamespace_id)
+
+        self.stats["reads"] += 1
+        result = await fetch()
+
+        if not result:
+            await self.__restore__(gamespace_id, [account_id])
+            result = await fetch()
+            if not result:
+                raise NoSuchProfileError()
+
+        payload = result["payload"] or "null"
+
+        if counted:
+            data = ujson.loads(payload)
+            updated = await self.__add_counters__(gamespace_id, path, data, sum_shards(result["counter_shards"]))
+            if updated is not data:
+                payload = ujson.dumps(updated)
+
+        return payload, result["version"]
+
+    async def get_profile_version(self, gamespace_id, account_id):
+        """
+        Returns the current version of the profile without fetching it, or None if there is no such profile
+        """
+        result = await self.db.get(
+            """
+                SELECT `version`
+                FROM `account_profiles`
+                WHERE `account_id`=%s AND `gamespace_id`=%s;
+            """, account_id, gamespace_id)
+
+        if not result:
+            return None
+
+        return result["version"]
+
+    async def get_profile_me(self, gamespace_id, account_id, path, with_version=False):
+
+        profile_data, version = await self.get_profile_data(gamespace_id, account_id, path, with_version=True)
 
         if not path:
             # if the path is not specified, get them all
@@ -188,11 +1083,61 @@ class ProfilesModel(Model):
             else:
                 result = None
 
+        if with_version:
+            return result, version
+
         return result
 
-    async def get_profile_others(self, gamespace_id, account_id, path):
-        
-        profile_data = await self.get_profile_data(gamespace_id, account_id, path)
+    async def __get_public_projections__(self, gamespace_id, account_ids, public_access, counted=False):
+        """
+        Returns a dict of account_id -> (projection, version, counter shards if counted) for the profiles
+        that have the projection built with the current access
+        """
+        if not account_ids:
+            return {}
+
+        profiles = await self.db.query(
+            """
+                SELECT `account_id`, `payload_public`, `version`{0}
+                FROM `account_profiles`
+                WHERE `account_id` IN %s AND `gamespace_id`=%s AND `public_access`=%s;
+            """.format((", " + SHARDS_COLUMN) if counted else ""),
+            account_ids, gamespace_id, public_access.get_fingerprint())
+
+        return {
+            str(user["account_id"]): (
+                user["payload_public"] or {}, user["version"],
+                sum_shards(user["counter_shards"]) if counted else None)
+            for user in profiles
+        }
+
+    async def get_profile_others(self, gamespace_id, account_id, path, with_version=False):
+
+        if not path:
+            public_access = await self.access.get_access(gamespace_id)
+            account_id = str(account_id)
+
+            counted = await self.has_counters(gamespace_id)
+
+            projected = await self.reads.do(
+                (gamespace_id, account_id, public_access.get_fingerprint()),
+                lambda: self.__get_public_projections__(gamespace_id, [account_id], public_access, counted))
+
+            if account_id in projected:
+                self.stats["public_reads"] += 1
+                result, version, sums = projected[account_id]
+                if counted:
+                    result = await self.__add_counters__(
+                        gamespace_id, None, result, sums, public_fields=public_access.get_public())
+
+                if with_version:
+                    return result, version
+
+                return result
+
+        profile_data, version = await self.reads.do(
+            (gamespace_id, str(account_id), tuple(path or [])),
+            lambda: self.get_profile_data(gamespace_id, account_id, path, with_version=True))
 
         if not path:
             # if the path is not specified, get them all
@@ -217,43 +1162,89 @@ class ProfilesModel(Model):
             else:
                 result = None
 
+        if with_version:
+            return result, version
+
         return result
 
+    async def __get_payloads__(self, gamespace_id, account_ids):
+        """
+        Fetches the payloads of several profiles at once, restoring the archived ones if needed
+        """
+        query = """
+            SELECT `account_id`, `payload`
+            FROM `account_profiles`
+            WHERE `account_id` IN %s AND `gamespace_id`=%s;
+        """
+
+        profiles = await self.db.query(query, account_ids, gamespace_id)
+
+        if len(profiles) < len(set(account_ids)):
+            found = {str(user["account_id"]) for user in profiles}
+            missing = [account_id for account_id in account_ids if str(account_id) not in found]
+            await self.__restore__(gamespace_id, missing)
+            profiles = await self.db.query(query, account_ids, gamespace_id)
+
+        return profiles
+
     async def get_profiles(self, gamespace_id, action, account_ids, profile_fields):
 
         async def get_private():
 
-            result = {}
+            result = {
+                account_id: {}
+                for account_id in account_ids
+            }
 
-            for account_id in account_ids:
-                data = (await self.get_profile_data(gamespace_id, account_id, [])) or {}
+            if not account_ids:
+                return result
+
+            profiles = await self.__get_payloads__(gamespace_id, account_ids)
+
+            for user in profiles:
+                data = user["payload"] or {}
 
                 if profile_fields:
-                    result[account_id] = {
+                    data = {
                         field: (data[field])
                         for field in profile_fields if field in data
                     }
-                else:
-                    result[account_id] = data
+
+                result[str(user["account_id"])] = data
 
             return result
 
         async def get_public():
 
+            public_access = await self.access.get_access(gamespace_id)
+
             if profile_fields:
                 valid_fields = await self.access.validate_access(gamespace_id, profile_fields,
                                                                  ProfileAccessModel.READ_OTHERS)
             else:
-                public_access = await self.access.get_access(gamespace_id)
                 valid_fields = public_access.get_public()
 
             result = {}
 
+            if not account_ids:
+                return result
+
+            projected = await self.__get_public_projections__(gamespace_id, account_ids, public_access)
+            self.stats["public_reads"] += len(projected)
+
+            # the profiles without an up to date projection are filtered the usual way
+            missing = [account_id for account_id in account_ids if account_id not in projected]
+            profiles = {}
+
+            if missing:
+                for user in await self.__get_payloads__(gamespace_id, missing):
+                    profiles[str(user["account_id"])] = user["payload"]
+
             for account_id in account_ids:
-                try:
-                    data = (await self.get_profile_data(gamespace_id, account_id, []))
-                except NoSuchProfileError:
-                    data = {}
+                if account_id in projected:
+                    data = projected[account_id][0]
+                else:
+                    data = profiles.get(account_id) or {}
                 result[account_id] = {
                     field: (data[field])
                     for field in valid_fields if field in data
@@ -273,23 +1264,317 @@ class ProfilesModel(Model):
         profiles = await actions[action]()
         return profiles
 
-    async def set_profile_data(self, gamespace_id, account_id, fields, path, merge=True):
-        user_profile = UserProfile(self.db, gamespace_id, account_id)
+    async def set_profile_data(self, gamespace_id, account_id, fields, path, merge=True,
+                               version=None, with_version=False):
+        """
+        Updates the profile, if the version is passed, only if the profile has exactly this version
+        (otherwise raises ProfileVersionError). Returns (result, new version) if with_version
+        """
+        if path is not None:
+            # may be an iterator
+            path = list(path)
+
+        counters = await self.__counter_fields__(gamespace_id)
+        counter_paths = [field.path for field in counters or []]
+        increments = {}
+
+        # the writes conditioned on the version go to the profile itself
+        if counters and merge and version is None and isinstance(fields, dict):
+            fields, increments = split_increments(fields, path, counter_paths)
+
+        if increments and fields is None:
+            # nothing else to write, so the profile is not even locked
+            await self.counters.increment(gamespace_id, account_id, increments, counters)
+            self.stats["counter_increments"] += len(increments)
+
+            # the result is the new values of the counters
+            totals = await self.counters.get_totals(gamespace_id, account_id, list(increments.keys()))
+            # either the value of the counter itself, or an object of the counters under the path
+            result = apply_counters(None if "/".join(path or []) in increments else {}, path, totals)
+
+            self.__publish_changes__(gamespace_id, [
+                (account_id, list({counter.split("/")[0] for counter in increments.keys()}), None)
+            ])
+
+            if with_version:
+                return result, await self.get_profile_version(gamespace_id, account_id)
+
+            return result
+
+        public_access = await self.access.get_access(gamespace_id)
+        user_profile = self.__user_profile__(gamespace_id, account_id, version=version, public_access=public_access,
+                                             lookup_fields=await self.__lookup_fields__(gamespace_id),
+                                             quota=await self.__quota__(gamespace_id))
+        sums = {}
+
+        if counters:
+            # the counters set directly lose the increments made before
+            discarded = [
+                counter for counter in touched_counters(fields, path, merge, counter_paths)
+                if counter not in increments
+            ]
+
+            async def write_counters(conn):
+                # along with the profile, so nothing is incremented if the write fails,
+                # and the profile is locked, so nothing is folded in between
+                await self.counters.increment(gamespace_id, account_id, increments, counters, db=conn)
+                await self.counters.discard(gamespace_id, account_id, discarded, db=conn)
+                sums.clear()
+                sums.update(await self.counters.get_sums(gamespace_id, account_id, db=conn))
+
+            user_profile.on_write.append(write_counters)
+
+        self.stats["writes"] += 1
         try:
             result = await user_profile.set_data(fields, path, merge=merge)
         except FuncError as e:
             raise ProfileError("Failed to update profile: " + e.message)
+        finally:
+            self.stats["write_conflicts"] += user_profile.conflicts
+
+        self.stats["counter_increments"] += len(increments)
+
+        if counters and not isinstance(result, RawJSON):
+            result = await self.__add_counters__(gamespace_id, path, result, sums)
+
+        changed = ProfilesModel.__changed_fields__(fields, path)
+        changed.extend(counter.split("/")[0] for counter in increments.keys() if counter.split("/")[0] not in changed)
+
+        self.__publish_changes__(gamespace_id, [
+            (account_id, changed, user_profile.version)
+        ])
+
+        if with_version:
+            return result, user_profile.version
+
         return result
 
     async def set_profiles_data(self, gamespace_id, accounts: dict, merge=True):
-        user_profiles = UserProfiles(self.db, gamespace_id, list(accounts.keys()))
+        public_access = await self.access.get_access(gamespace_id)
+        user_profiles = UserProfiles(self.db, gamespace_id, list(accounts.keys()),
+                                     offload=self.offload, public_access=public_access,
+                                     lookup_fields=await self.__lookup_fields__(gamespace_id),
+                                     quota=await self.__quota__(gamespace_id))
+        self.stats["writes"] += len(accounts)
         try:
             result = await user_profiles.set_data(accounts, None, merge=merge)
         except FuncError as e:
             raise ProfileError("Failed to update profiles: " + e.message)
+        finally:
+            self.stats["deadlock_retries"] += user_profiles.retried
+        self.__invalidate_queries__(gamespace_id)
+        self.__publish_changes__(gamespace_id, [
+            (account_id, list(fields.keys()), None)
+            for account_id, fields in accounts.items()
+        ])
         return result
 
-    async def set_profile_me(self, gamespace_id, account_id, fields, path, merge=True):
+    async def batch(self, gamespace_id, operations):
+        """
+        Executes the operations in order, the consecutive ones of the same kind are grouped into a single query
+        (or transaction). Each is {"action": "get", "account", "path"}, {"action": "update", "account", "fields",
+        "path", "merge"} or {"action": "query", "query", "limit"}. Returns a list of {"result"} or {"error"}
+        """
+
+        if len(operations) > ProfilesModel.MAX_BATCH_OPERATIONS:
+            raise ProfileError("Maximum operations limit exceeded ({0}).".format(
+                ProfilesModel.MAX_BATCH_OPERATIONS))
+
+        results = [None] * len(operations)
+        groups = []
+
+        for index, operation in enumerate(operations):
+            action = operation.get("action") if isinstance(operation, dict) else None
+
+            if action not in ProfilesModel.BATCH_ACTIONS:
+                results[index] = BatchOperationError(400, "No such action: {0}".format(action)).dump()
+                continue
+
+            if groups and groups[-1][0] == action:
+                groups[-1][1].append((index, operation))
+            else:
+                groups.append((action, [(index, operation)]))
+
+        for action, group in groups:
+            if action == "get":
+                await self.__batch_get__(gamespace_id, group, results)
+            elif action == "update":
+                await self.__batch_update__(gamespace_id, group, results)
+            elif action == "query":
+                for index, operation in group:
+                    try:
+                        limit = int(operation.get("limit", 1000))
+                    except (TypeError, ValueError):
+                        results[index] = BatchOperationError(400, "Bad limit").dump()
+                        continue
+
+                    if limit <= 0:
+                        results[index] = BatchOperationError(400, "Limit should be positive").dump()
+                        continue
+
+                    q = self.profile_query(gamespace_id)
+                    q.filters = operation.get("query")
+                    q.limit = min(limit, 1000)
+                    try:
+                        items = await q.query()
+                    except ProfileQueryError as e:
+                        results[index] = BatchOperationError(400, str(e)).dump()
+                    else:
+                        results[index] = {
+                            "result": {
+                                item.account: item.profile
+                                for item in items
+                            }
+                        }
+
+        return results
+
+    @staticmethod
+    def __batch_path__(operation):
+        path = operation.get("path")
+        if isinstance(path, str):
+            path = list(filter(bool, path.split("/")))
+        return path or None
+
+    async def __batch_get__(self, gamespace_id, group, results):
+        account_ids = list({str(operation.get("account")) for index, operation in group})
+
+        try:
+            profiles = await self.__get_payloads__(gamespace_id, account_ids)
+        except DatabaseError as e:
+            for index, operation in group:
+                results[index] = BatchOperationError(500, "Failed to get profiles: " + e.args[1]).dump()
+            return
+
+        profiles = {
+            str(user["account_id"]): user["payload"]
+            for user in profiles
+        }
+
+        for index, operation in group:
+            data = profiles.get(str(operation.get("account")))
+            if data is None:
+                results[index] = BatchOperationError(404, "No profile found").dump()
+            else:
+                results[index] = {
+                    "result": extract_path(data, ProfilesModel.__batch_path__(operation))
+                }
+
+    async def __batch_update__(self, gamespace_id, group, results):
+        changes = []
+
+        for index, operation in group:
+            fields = operation.get("fields")
+            if not isinstance(fields, dict):
+                results[index] = BatchOperationError(
+                    400, "Expected 'fields' to be an object (a set of fields).").dump()
+                continue
+
+            changes.append((index, str(operation.get("account")), fields,
+                            ProfilesModel.__batch_path__(operation), operation.get("merge", True)))
+
+        if not changes:
+            return
+
+        public_access = await self.access.get_access(gamespace_id)
+        user_profiles = UserProfiles(self.db, gamespace_id, list({change[1] for change in changes}),
+                                     public_access=public_access,
+                                     lookup_fields=await self.__lookup_fields__(gamespace_id),
+                                     quota=await self.__quota__(gamespace_id))
+        self.stats["writes"] += len(changes)
+
+        try:
+            applied = await user_profiles.apply(changes)
+        except DatabaseError as e:
+            for index, account_id, fields, path, merge in changes:
+                results[index] = BatchOperationError(500, "Failed to update profiles: " + e.args[1]).dump()
+            return
+        except ProfileError as e:
+            # the whole group is rejected (the quota of the profiles, a duplicate lookup value),
+            # but the groups before it are applied already, so it is reported for this group only
+            status = 413 if isinstance(e, ProfileQuotaExceeded) else 400
+            for index, account_id, fields, path, merge in changes:
+                results[index] = BatchOperationError(status, "Failed to update profiles: " + e.message).dump()
+            return
+        finally:
+            self.stats["deadlock_retries"] += user_profiles.retried
+
+        if len(changes) > 1:
+            self.__invalidate_queries__(gamespace_id)
+
+        for index, result in applied.items():
+            if isinstance(result, (FuncError, ProfileError)):
+                results[index] = BatchOperationError(400, "Failed to update profile: " + result.message).dump()
+            else:
+                results[index] = {
+                    "result": result
+                }
+
+        self.__publish_changes__(gamespace_id, [
+            (account_id, ProfilesModel.__changed_fields__(fields, path), None)
+            for index, account_id, fields, path, merge in changes
+            if not isinstance(applied.get(index), (FuncError, ProfileError))
+        ])
+
+    async def update_profiles_atomic(self, gamespace_id, changes, preconditions=None):
+        """
+        Updates several profiles within a single transaction, all or nothing. The changes ({"account", "fields",
+        "path", "merge"}) are applied in order, once the preconditions ({"account", "path", "op", "value"}) hold
+        """
+
+        preconditions = preconditions or []
+
+        if len(changes) > ProfilesModel.MAX_BATCH_OPERATIONS:
+            raise ProfileError("Maximum operations limit exceeded ({0}).".format(
+                ProfilesModel.MAX_BATCH_OPERATIONS))
+
+        prepared = []
+        accounts = set()
+
+        for index, change in enumerate(changes):
+            fields = change.get("fields") if isinstance(change, dict) else None
+            if not isinstance(fields, dict):
+                raise ProfileError("Change {0}: expected 'fields' to be an object (a set of fields).".format(index))
+            account_id = str(change.get("account"))
+            accounts.add(account_id)
+            prepared.append((index, account_id, fields, ProfilesModel.__batch_path__(change),
+                             change.get("merge", True)))
+
+        prepared_conditions = []
+
+        for index, condition in enumerate(preconditions):
+            if not isinstance(condition, dict):
+                raise ProfileError("Precondition {0}: expected an object.".format(index))
+            account_id = str(condition.get("account"))
+            accounts.add(account_id)
+            prepared_conditions.append((index, account_id, ProfilesModel.__batch_path__(condition),
+                                        condition.get("op", "=="), condition.get("value")))
+
+        if not prepared:
+            return []
+
+        public_access = await self.access.get_access(gamespace_id)
+        user_profiles = UserProfiles(self.db, gamespace_id, list(accounts), public_access=public_access,
+                                     lookup_fields=await self.__lookup_fields__(gamespace_id),
+                                     quota=await self.__quota__(gamespace_id))
+        self.stats["writes"] += len(prepared)
+        try:
+            applied = await user_profiles.apply(prepared, preconditions=prepared_conditions, atomic=True)
+        finally:
+            self.stats["deadlock_retries"] += user_profiles.retried
+
+        if len(prepared) > 1:
+            self.__invalidate_queries__(gamespace_id)
+
+        self.__publish_changes__(gamespace_id, [
+            (account_id, ProfilesModel.__changed_fields__(fields, path), None)
+            for index, account_id, fields, path, merge in prepared
+        ])
+
+        return [applied[index] for index, account_id, fields, path, merge in prepared]
+
+    async def set_profile_me(self, gamespace_id, account_id, fields, path, merge=True,
+                             version=None, with_version=False):
 
         if not path:
             await self.access.validate_access(
@@ -297,7 +1582,8 @@ class ProfilesModel(Model):
                 list(fields.keys()),
                 ProfileAccessModel.WRITE)
 
-            result = await self.set_profile_data(gamespace_id, account_id, fields, path, merge=merge)
+            result = await self.set_profile_data(gamespace_id, account_id, fields, path, merge=merge,
+                                                 version=version, with_version=with_version)
         else:
             key = path[0]
             await self.access.validate_access(
@@ -305,12 +1591,15 @@ class ProfilesModel(Model):
                 [key],
                 ProfileAccessModel.WRITE)
 
-            result = await self.set_profile_data(gamespace_id, account_id, fields, path, merge=merge)
+            result = await self.set_profile_data(gamespace_id, account_id, fields, path, merge=merge,
+                                                 version=version, with_version=with_version)
 
         return result
 
-    async def set_profile_rw(self, gamespace_id, account_id, fields, path, merge=True):
-        result = await self.set_profile_data(gamespace_id, account_id, fields, path, merge=merge)
+    async def set_profile_rw(self, gamespace_id, account_id, fields, path, merge=True,
+                             version=None, with_version=False):
+        result = await self.set_profile_data(gamespace_id, account_id, fields, path, merge=merge,
+                                             version=version, with_version=with_version)
         return result
 
     async def set_profiles_rw(self, gamespace_id, accounts: dict, merge=True):
@@ -318,21 +1607,88 @@ class ProfilesModel(Model):
         return result
 
 
-class UserProfile(profile.DatabaseProfile):
+class TransactionProfile(profile.DatabaseProfile):
+    """
+    A profile written within a single transaction (see __transaction__): Profile.set_data reads and writes it
+    on the same connection, instead of acquiring (and committing) one of its own
+    """
+
+    def __init__(self, db):
+        super(TransactionProfile, self).__init__(db)
+        self.transaction = False
+
+    async def init(self):
+        if not self.transaction:
+            await super(TransactionProfile, self).init()
+
+    async def release(self):
+        if not self.transaction:
+            await super(TransactionProfile, self).release()
+
+    async def __transaction__(self, method):
+        async with self.db.acquire(auto_commit=False) as self.conn:
+            self.transaction = True
+            try:
+                result = await method()
+                await self.conn.commit()
+            except BaseException:
+                # a connection is returned to the pool as is, along with the locks taken
+                await self.conn.rollback()
+                raise
+            finally:
+                self.transaction = False
+
+        return result
+
+
+class UserProfile(TransactionProfile):
     # noinspection PyShadowingNames
     @staticmethod
     def __encode_profile__(profile):
         return ujson.dumps(profile)
 
-    def __init__(self, db, gamespace_id, account_id):
+    def __init__(self, db, gamespace_id, account_id, version=None, optimistic=False, retries=5, backoff=0.02,
+                 offload=None, public_access=None, lookup_fields=None, quota=None):
         super(UserProfile, self).__init__(db)
         self.gamespace_id = gamespace_id
         self.account_id = account_id
+        self.offload = offload
+        # the quota (QuotaAdapter) the writes are checked against, if any
+        self.quota = quota
+        # the sizes of the profile (and of the parts limited by the quota) before the write
+        self.size = 0
+        self.path_sizes = None
+        # the access (AccessAdapter) to maintain the public projection of the profile with, if known
+        self.public_access = public_access
+        # the lookup fields (LookupFieldAdapter) of the gamespace to maintain the lookup index for
+        self.lookup_fields = lookup_fields or []
+        # only the writes are offloaded, the reads of big profiles should use get_profile_data_raw
+        self.writing = False
+
+        # the version the write is conditioned on (if any)
+        self.expected_version = version
+        # the version of the profile last read or written, 0 means no profile
+        self.version = 0
+
+        self.optimistic = optimistic
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = False
+        self.conflicts = 0
+
+        # if set, the pending counter increments are read along with the profile, see SHARDS_COLUMN
+        self.counted = False
+        self.counter_shards = None
+        # coroutine functions called with the connection once the profile is written,
+        # to be committed (or rolled back) along with it
+        self.on_write = []
 
     # noinspection PyShadowingNames
     @staticmethod
     def __parse_profile__(profile):
-        return profile
+        if profile is None:
+            return None
+        return ujson.loads(profile)
 
     # noinspection PyShadowingNames
     @staticmethod
@@ -342,52 +1698,234 @@ class UserProfile(profile.DatabaseProfile):
 
         profile[ProfilesModel.TIME_UPDATED] = access.utc_time()
 
+    def __check_version__(self):
+        if self.expected_version is not None and self.expected_version != self.version:
+            raise ProfileVersionError(self.version)
+
+    async def set_data(self, fields, path, merge=True):
+        self.writing = True
+
+        if not self.optimistic:
+            # the profile row stays locked until the write is committed
+            self.lock = True
+            return await self.__transaction__(lambda: self.__set_data__(fields, path, merge))
+
+        attempt = 0
+
+        while True:
+            try:
+                # nothing is locked upon read, but the lookup index has to be updated along with the profile
+                # (the merge may alter the fields, so every attempt gets its own copy)
+                return await self.__transaction__(lambda: self.__set_data__(copy.deepcopy(fields), path, merge))
+            except ProfileConflictError:
+                self.conflicts += 1
+                attempt += 1
+                if attempt >= self.retries:
+                    raise ProfileError("Failed to update profile: too many concurrent updates")
+
+            await asyncio.sleep(self.backoff * (2 ** attempt) * random.random())
+
+    async def __set_data__(self, fields, path, merge):
+        try:
+            result = await super(profile.DatabaseProfile, self).set_data(fields, path, merge=merge)
+        except OffloadRequired as e:
+            # the profile is still locked by the read, so it is written on the same connection
+            try:
+                encoded, encoded_public, values, result = await self.offload.run(
+                    merge_profile, e.raw, fields, path, merge,
+                    self.public_access.get_public() if self.public_access else None,
+                    [field.path for field in self.lookup_fields], self.quota)
+            except OffloadError as e:
+                raise e.unwrap()
+
+            await self.__update_encoded__(encoded, encoded_public)
+            await self.__update_lookup__(values)
+            result = RawJSON(result)
+
+        for callback in self.on_write:
+            await callback(self.conn)
+
+        return result
+
+    GET_QUERY = """
+        SELECT CAST(`payload` AS CHAR) AS `payload`, `version`{0}
+        FROM `account_profiles`
+        WHERE `account_id`=%s AND `gamespace_id`=%s{1};
+    """
+
+    def __get_query__(self, lock):
+        return UserProfile.GET_QUERY.format(
+            (", " + SHARDS_COLUMN) if self.counted else "",
+            " FOR UPDATE" if lock else "")
+
     async def get(self):
-        user = await self.conn.get(
-            """
-                SELECT `payload`
-                FROM `account_profiles`
-                WHERE `account_id`=%s AND `gamespace_id`=%s
-                FOR UPDATE;
-            """, self.account_id, self.gamespace_id)
+        user = await self.conn.get(self.__get_query__(self.lock), self.account_id, self.gamespace_id)
+
+        if not user:
+            await restore_archived_profiles(self.conn, self.gamespace_id, [self.account_id])
+            # unlike a consistent read, a locking one also sees a profile restored by a concurrent transaction
+            user = await self.conn.get(self.__get_query__(True), self.account_id, self.gamespace_id)
 
-        if user:
-            return UserProfile.__parse_profile__(user["payload"])
+        if user and self.counted:
+            self.counter_shards = user["counter_shards"]
 
-        raise profile.NoDataError()
+        self.version = user["version"] if user else 0
+        self.__check_version__()
+
+        if not user:
+            raise profile.NoDataError()
+
+        raw = user["payload"]
+
+        if self.writing and raw and self.offload and self.offload.should_offload(len(raw)):
+            raise OffloadRequired(raw)
+
+        data = UserProfile.__parse_profile__(raw)
+
+        if self.writing and self.quota and self.quota.max_size:
+            self.size = encoded_size(data)
+
+        if self.writing and self.quota and self.quota.paths and data is not None:
+            self.path_sizes = path_sizes(data, self.quota.paths.keys())
+
+        return data
+
+    def __encode_public__(self, data):
+        if self.public_access is None:
+            return None
+        return UserProfile.__encode_profile__(public_projection(data, self.public_access.get_public()))
+
+    def __public_fingerprint__(self):
+        return self.public_access.get_fingerprint() if self.public_access else None
+
+    async def __update_lookup__(self, values):
+        if self.lookup_fields:
+            await update_lookup_index(self.conn, self.gamespace_id, self.lookup_fields, {self.account_id: values})
+
+    def __lookup_values__(self, data):
+        return lookup_values(data, [field.path for field in self.lookup_fields]) if self.lookup_fields else {}
 
     async def insert(self, data):
         UserProfile.__process_dates__(data)
+        check_paths_quota(self.quota, data)
+        encoded_public = self.__encode_public__(data)
+        values = self.__lookup_values__(data)
         data = UserProfile.__encode_profile__(data)
+        check_size_quota(self.quota, len(data))
 
-        await self.conn.insert(
-            """
-                INSERT INTO `account_profiles`
-                (`account_id`, `gamespace_id`, `payload`)
-                VALUES (%s, %s, %s);
-            """, self.account_id, self.gamespace_id, data)
+        try:
+            await self.conn.insert(
+                """
+                    INSERT INTO `account_profiles`
+                    (`account_id`, `gamespace_id`, `payload`, `payload_public`, `public_access`, `version`)
+                    VALUES (%s, %s, %s, %s, %s, 1);
+                """, self.account_id, self.gamespace_id, data, encoded_public, self.__public_fingerprint__())
+        except DuplicateError:
+            if self.optimistic:
+                raise ProfileConflictError()
+            raise
+
+        self.version = 1
+        await self.__update_lookup__(values)
 
     async def update(self, data):
         UserProfile.__process_dates__(data)
+        check_paths_quota(self.quota, data, self.path_sizes)
         encoded = UserProfile.__encode_profile__(data)
-        await self.conn.execute(
-            """
-                UPDATE `account_profiles`
-                SET `payload`=%s
-                WHERE `account_id`=%s AND `gamespace_id`=%s;
-            """, encoded, self.account_id, self.gamespace_id)
+        check_size_quota(self.quota, len(encoded), self.size)
+        await self.__update_encoded__(encoded, self.__encode_public__(data))
+        await self.__update_lookup__(self.__lookup_values__(data))
+
+    async def __update_encoded__(self, encoded, encoded_public):
+        if self.optimistic:
+            updated = await self.conn.execute(
+                """
+                    UPDATE `account_profiles`
+                    SET `payload`=%s, `payload_public`=%s, `public_access`=%s, `version`=`version`+1
+                    WHERE `account_id`=%s AND `gamespace_id`=%s AND `version`=%s;
+                """, encoded, encoded_public, self.__public_fingerprint__(),
+                self.account_id, self.gamespace_id, self.version)
+
+            if not updated:
+                raise ProfileConflictError()
+        else:
+            await self.conn.execute(
+                """
+                    UPDATE `account_profiles`
+                    SET `payload`=%s, `payload_public`=%s, `public_access`=%s, `version`=`version`+1
+                    WHERE `account_id`=%s AND `gamespace_id`=%s;
+                """, encoded, encoded_public, self.__public_fingerprint__(), self.account_id, self.gamespace_id)
+
+        self.version += 1
 
 
-class UserProfiles(profile.DatabaseProfile):
+class UserProfiles(TransactionProfile):
     # noinspection PyShadowingNames
     @staticmethod
     def __encode_profile__(profile):
         return ujson.dumps(profile)
 
-    def __init__(self, db, gamespace_id, account_ids):
+    def __init__(self, db, gamespace_id, account_ids, retries=5, backoff=0.02, offload=None, public_access=None,
+                 lookup_fields=None, quota=None):
         super(UserProfiles, self).__init__(db)
         self.gamespace_id = gamespace_id
-        self.account_ids = account_ids
+        self.offload = offload
+        self.public_access = public_access
+        self.lookup_fields = lookup_fields or []
+        self.quota = quota
+        # account -> the sizes of the profile (and of the parts limited by the quota) before the write
+        self.sizes = {}
+        self.path_sizes = {}
+        self.writing = False
+        # the rows are always locked in the same order, so concurrent updates of
+        # overlapping sets of profiles would wait for each other instead of deadlocking
+        self.account_ids = sorted(set(str(account_id) for account_id in account_ids))
+        self.versions = {}
+
+        self.retries = retries
+        self.backoff = backoff
+        self.retried = 0
+
+    async def __retry__(self, method):
+        attempt = 0
+
+        while True:
+            try:
+                return await method()
+            except DatabaseError as e:
+                if not is_retryable(e):
+                    raise
+                self.retried += 1
+                attempt += 1
+                if attempt >= self.retries:
+                    raise
+
+            await asyncio.sleep(self.backoff * (2 ** attempt) * random.random())
+
+    async def set_data(self, fields, path, merge=True):
+        return await self.__retry__(lambda: self.__set_data__(copy.deepcopy(fields), path, merge))
+
+    async def __set_data__(self, fields, path, merge):
+        self.writing = True
+
+        return await self.__transaction__(lambda: self.__merge__(fields, path, merge))
+
+    async def __merge__(self, fields, path, merge):
+        try:
+            return await super(profile.DatabaseProfile, self).set_data(fields, path, merge=merge)
+        except OffloadRequired as e:
+            # the profiles are still locked by the read, so those are written on the same connection
+            try:
+                encoded, encoded_public, values, result = await self.offload.run(
+                    merge_profiles, e.raw, fields, merge,
+                    self.public_access.get_public() if self.public_access else None,
+                    [field.path for field in self.lookup_fields], self.quota)
+            except OffloadError as e:
+                raise e.unwrap()
+
+            await self.__update_encoded__(encoded, encoded_public)
+            await self.__update_lookup__(values)
+            return RawJSON(result)
 
     # noinspection PyShadowingNames
     @staticmethod
@@ -398,38 +1936,154 @@ class UserProfiles(profile.DatabaseProfile):
         profile[ProfilesModel.TIME_UPDATED] = access.utc_time()
 
     async def get(self):
-        users = await self.conn.query(
-            """
-                SELECT `payload`, `account_id`
-                FROM `account_profiles`
-                WHERE `account_id` IN %s AND `gamespace_id`=%s
-                FOR UPDATE;
-            """, self.account_ids, self.gamespace_id)
+        query = """
+            SELECT CAST(`payload` AS CHAR) AS `payload`, `account_id`, `version`
+            FROM `account_profiles`
+            WHERE `account_id` IN %s AND `gamespace_id`=%s
+            ORDER BY `account_id`, `gamespace_id`
+            FOR UPDATE;
+        """
+
+        users = await self.conn.query(query, self.account_ids, self.gamespace_id)
+
+        if len(users) < len(self.account_ids):
+            found = {str(user["account_id"]) for user in users}
+            missing = [account_id for account_id in self.account_ids if account_id not in found]
+            await restore_archived_profiles(self.conn, self.gamespace_id, missing)
+            users = await self.conn.query(query, self.account_ids, self.gamespace_id)
+
+        self.versions = {
+            str(user["account_id"]): user["version"]
+            for user in users
+        }
 
-        return {
+        raw = {
             str(user["account_id"]): user["payload"]
             for user in users
         }
 
+        if self.writing and self.offload and self.offload.should_offload(
+                sum(len(payload) for payload in raw.values() if payload)):
+            raise OffloadRequired(raw)
+
+        profiles = {
+            account_id: UserProfile.__parse_profile__(payload)
+            for account_id, payload in raw.items()
+        }
+
+        if self.quota and self.quota.max_size:
+            self.sizes = {
+                account_id: encoded_size(account_profile)
+                for account_id, account_profile in profiles.items()
+            }
+
+        if self.quota and self.quota.paths:
+            self.path_sizes = {
+                account_id: path_sizes(account_profile, self.quota.paths.keys())
+                for account_id, account_profile in profiles.items()
+                if account_profile is not None
+            }
+
+        return profiles
+
     async def insert(self, data):
         # not supported since get never returns NoDataError
         pass
 
+    async def apply(self, changes, preconditions=None, atomic=False):
+        """
+        Applies the changes (index, account_id, fields, path, merge) in order within a single transaction, once
+        the preconditions (index, account_id, path, op, value) hold. If atomic, a failed change cancels all of them.
+        Returns a dict of index -> result (or error)
+        """
+        return await self.__retry__(lambda: self.__apply__(changes, preconditions or [], atomic))
+
+    async def __apply__(self, changes, preconditions, atomic):
+        return await self.__transaction__(lambda: self.__apply_changes__(changes, preconditions, atomic))
+
+    async def __apply_changes__(self, changes, preconditions, atomic):
+        results = {}
+        profiles = await self.get()
+        changed = set()
+
+        for index, account_id, path, op, value in preconditions:
+            if not check_precondition(profiles.get(account_id), path, op, value):
+                raise ProfilePreconditionError(index, "Precondition {0} failed".format(index))
+
+        for index, account_id, fields, path, merge in changes:
+            # work on a copy so a failed change leaves the profile intact
+            document = ProfileDocument(copy.deepcopy(profiles.get(account_id)))
+
+            try:
+                results[index] = await document.set_data(copy.deepcopy(fields), path, merge=merge)
+                # the parts limited by the quota are checked change by change, so a change that exceeds
+                # the quota fails alone (the whole size is checked once the profiles are encoded)
+                check_paths_quota(self.quota, document.data, self.path_sizes.get(account_id))
+            except (FuncError, ProfileError) as e:
+                if atomic:
+                    # the transaction is rolled back, along with the locks of all the profiles
+                    raise ProfileError("Change {0} failed: {1}".format(index, e.message))
+                results[index] = e
+            else:
+                profiles[account_id] = document.data
+                changed.add(account_id)
+
+        if changed:
+            await self.update({
+                account_id: profiles[account_id]
+                for account_id in changed
+            })
+
+        return results
+
     async def update(self, data: dict):
         for account_id, account_profile in data.items():
             UserProfiles.__process_dates__(account_profile)
+            check_paths_quota(self.quota, account_profile, self.path_sizes.get(account_id))
+
+        encoded_public = None
+
+        if self.public_access is not None:
+            encoded_public = {
+                account_id: UserProfiles.__encode_profile__(
+                    public_projection(account_profile, self.public_access.get_public()))
+                for account_id, account_profile in data.items()
+            }
+
+        encoded = {
+            account_id: UserProfiles.__encode_profile__(account_profile)
+            for account_id, account_profile in data.items()
+        }
 
-        values = []
+        for account_id, account_profile in encoded.items():
+            check_size_quota(self.quota, len(account_profile), self.sizes.get(account_id, 0))
+
+        await self.__update_encoded__(encoded, encoded_public)
+
+        if self.lookup_fields:
+            paths = [field.path for field in self.lookup_fields]
+            await self.__update_lookup__({
+                account_id: lookup_values(account_profile, paths)
+                for account_id, account_profile in data.items()
+            })
+
+    async def __update_lookup__(self, values):
+        if self.lookup_fields:
+            await update_lookup_index(self.conn, self.gamespace_id, self.lookup_fields, values)
+
+    async def __update_encoded__(self, encoded: dict, encoded_public=None):
         entries = []
+        public_fingerprint = self.public_access.get_fingerprint() if self.public_access else None
 
-        for account_id, account_profile in data.items():
-            values.append("(%s, %s, %s)")
-            entries.extend([account_id, self.gamespace_id,
-                            UserProfiles.__encode_profile__(account_profile)])
+        for account_id, account_profile in encoded.items():
+            entries.extend([account_id, self.gamespace_id, account_profile,
+                            encoded_public.get(account_id) if encoded_public else None,
+                            public_fingerprint if encoded_public else None,
+                            self.versions.get(str(account_id), 0) + 1])
 
         await self.conn.execute(
             """
                 REPLACE INTO `account_profiles`
-                (`account_id`, `gamespace_id`, `payload`)
+                (`account_id`, `gamespace_id`, `payload`, `payload_public`, `public_access`, `version`)
                 VALUES {0};
-            """.format(", ".join(values)), *entries)
+            """.format(values_placeholder(len(encoded), 6)), *entries)
@@ -0,0 +1,312 @@
+
+from tornado.ioloop import PeriodicCallback, IOLoop
+
+from anthill.common.model import Model
+from anthill.common.profile import ProfileError
+from anthill.common.database import DatabaseError
+
+from . singleflight import SingleFlight
+
+import collections
+import asyncio
+import logging
+import heapq
+import ujson
+
+
+class ProfileQuotaExceeded(ProfileError):
+    pass
+
+
+class QuotaAdapter(object):
+    def __init__(self, data):
+        self.max_size = data.get("quota_max_size") or 0
+        paths = data.get("quota_paths") or {}
+        if isinstance(paths, str):
+            paths = ujson.loads(paths)
+        # path ("a/b") -> maximum size of it
+        self.paths = paths
+
+    def is_empty(self):
+        return not self.max_size and not self.paths
+
+    def dump(self):
+        return {
+            "max_size": self.max_size,
+            "paths": self.paths
+        }
+
+
+def path_sizes(data, paths):
+    """
+    Returns a dict of path -> size of the value at the path (as JSON), for the given paths
+    """
+    result = {}
+
+    for path in paths:
+        value = data
+
+        for key in path.split("/"):
+            if not isinstance(value, dict) or key not in value:
+                value = None
+                break
+            value = value[key]
+
+        result[path] = len(ujson.dumps(value)) if value is not None else 0
+
+    return result
+
+
+def encoded_size(data):
+    """
+    Returns the size of the data as written (MySQL returns the payload formatted differently)
+    """
+    return len(ujson.dumps(data)) if data is not None else 0
+
+
+def check_paths_quota(quota, data, previous=None):
+    """
+    Raises ProfileQuotaExceeded if a limited part of the profile is too big and has grown
+    """
+    if not quota or not quota.paths:
+        return
+
+    for path, size in path_sizes(data, quota.paths.keys()).items():
+        limit = quota.paths[path]
+        if size > limit and size > (previous or {}).get(path, 0):
+            raise ProfileQuotaExceeded("Profile field '{0}' is too big ({1} bytes, maximum {2})".format(
+                path, size, limit))
+
+
+def check_size_quota(quota, size, previous=0):
+    """
+    Raises ProfileQuotaExceeded if the encoded profile is too big (and has grown)
+    """
+    if quota and quota.max_size and size > quota.max_size and size > previous:
+        raise ProfileQuotaExceeded("Profile is too big ({0} bytes, maximum {1})".format(size, quota.max_size))
+
+
+class SizeReportAdapter(object):
+    def __init__(self, data):
+        self.gamespace_id = data.get("gamespace_id")
+        self.count = data.get("report_count", 0)
+        self.total = data.get("report_total", 0)
+        self.histogram = ProfileQuotaModel.__decode__(data.get("report_histogram")) or []
+        self.largest = ProfileQuotaModel.__decode__(data.get("report_largest")) or []
+        self.time = data.get("report_time")
+
+
+class ProfileQuotaModel(Model):
+    """
+    Bounds the size of the profiles (and of their parts by path), samples the sizes in the background
+    """
+
+    # the upper bounds of the histogram buckets, in bytes
+    HISTOGRAM = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+    LARGEST = 20
+
+    def __init__(self, db, interval=3600, batch_size=1000, batch_delay=0.1):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+
+        self.reads = SingleFlight()
+        self.sample_callback = None
+        self.sampling = False
+        self.stats = collections.Counter()
+
+    def get_setup_tables(self):
+        return ["profile_quotas", "profile_size_reports"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(ProfileQuotaModel, self).started(application)
+
+        if self.interval:
+            self.sample_callback = PeriodicCallback(
+                lambda: IOLoop.current().spawn_callback(self.sample),
+                self.interval * 1000)
+            self.sample_callback.start()
+
+    async def stopped(self):
+        if self.sample_callback:
+            self.sample_callback.stop()
+            self.sample_callback = None
+
+        await super(ProfileQuotaModel, self).stopped()
+
+    @staticmethod
+    def __decode__(value):
+        if isinstance(value, str):
+            return ujson.loads(value)
+        return value
+
+    # quotas
+
+    async def __get_quota__(self, gamespace_id):
+        quota = await self.db.get(
+            """
+                SELECT *
+                FROM `profile_quotas`
+                WHERE `gamespace_id`=%s;
+            """, gamespace_id, cache_hash=('profile_quota', gamespace_id), cache_time=600)
+
+        return QuotaAdapter(quota or {})
+
+    async def get_quota(self, gamespace_id):
+        return await self.reads.do(gamespace_id, lambda: self.__get_quota__(gamespace_id))
+
+    async def set_quota(self, gamespace_id, max_size, paths):
+        """
+        Sets the maximum size of the profiles (0 for unlimited), and a dict of path -> maximum size of it
+        """
+        if max_size < 0:
+            raise ProfileError("Bad maximum size")
+
+        if not isinstance(paths, dict):
+            raise ProfileError("Expected the paths to be an object")
+
+        normalized = {}
+
+        for path, limit in paths.items():
+            path = "/".join(filter(bool, path.split("/")))
+            if not path or not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+                raise ProfileError("Bad limit of '{0}'".format(path))
+            normalized[path] = limit
+
+        await self.db.execute(
+            """
+                INSERT INTO `profile_quotas`
+                (`gamespace_id`, `quota_max_size`, `quota_paths`)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE `quota_max_size`=VALUES(`quota_max_size`),
+                    `quota_paths`=VALUES(`quota_paths`);
+            """, gamespace_id, max_size, ujson.dumps(normalized),
+            cache_hash=('profile_quota', gamespace_id))
+
+    # size reports
+
+    async def get_report(self, gamespace_id):
+        report = await self.db.get(
+            """
+                SELECT *
+                FROM `profile_size_reports`
+                WHERE `gamespace_id`=%s AND `report_time` IS NOT NULL;
+            """, gamespace_id)
+
+        return SizeReportAdapter(report) if report else None
+
+    async def sample(self):
+        if self.sampling:
+            return
+
+        self.sampling = True
+
+        try:
+            # the other nodes may have sampled some of the gamespaces recently
+            gamespaces = await self.db.query(
+                """
+                    SELECT `gamespaces`.`gamespace_id`
+                    FROM (
+                        SELECT DISTINCT `gamespace_id`
+                        FROM `account_profiles`
+                    ) AS `gamespaces`
+                    LEFT JOIN `profile_size_reports` AS `reports`
+                    ON `reports`.`gamespace_id`=`gamespaces`.`gamespace_id`
+                    WHERE `reports`.`report_time` IS NULL OR `reports`.`report_time` < NOW() - INTERVAL %s SECOND;
+                """, max(self.interval - 60, 0))
+
+            for gamespace in gamespaces:
+                if await self.__claim__(gamespace["gamespace_id"]):
+                    await self.sample_gamespace(gamespace["gamespace_id"])
+        except DatabaseError:
+            logging.exception("Failed to sample profile sizes")
+        finally:
+            self.sampling = False
+
+    async def __claim__(self, gamespace_id):
+        """
+        Makes sure only one node samples the gamespace, the claim expires along with the report
+        """
+        claimed = await self.db.execute(
+            """
+                INSERT INTO `profile_size_reports`
+                (`gamespace_id`, `report_claimed`)
+                VALUES (%s, NOW())
+                ON DUPLICATE KEY UPDATE `report_claimed`=IF(
+                    `report_claimed` IS NULL OR `report_claimed` < NOW() - INTERVAL %s SECOND,
+                    NOW(), `report_claimed`);
+            """, gamespace_id, max(self.interval - 60, 0))
+
+        # 0 rows are affected if somebody else has claimed it already
+        return bool(claimed)
+
+    async def sample_gamespace(self, gamespace_id):
+        """
+        Walks all the profiles of the gamespace in primary key order, batch by batch, and saves the report
+        """
+        histogram = [0] * (len(ProfileQuotaModel.HISTOGRAM) + 1)
+        largest = []
+        count = 0
+        total = 0
+        after = 0
+
+        while True:
+            sizes = await self.db.query(
+                """
+                    SELECT `account_id`, JSON_STORAGE_SIZE(`payload`) AS `size`
+                    FROM `account_profiles`
+                    WHERE `gamespace_id`=%s AND `account_id`>%s
+                    ORDER BY `account_id`
+                    LIMIT %s;
+                """, gamespace_id, after, self.batch_size)
+
+            if not sizes:
+                break
+
+            for entry in sizes:
+                size = entry["size"] or 0
+
+                count += 1
+                total += size
+
+                bucket = 0
+                while bucket < len(ProfileQuotaModel.HISTOGRAM) and size > ProfileQuotaModel.HISTOGRAM[bucket]:
+                    bucket += 1
+                histogram[bucket] += 1
+
+                if len(largest) < ProfileQuotaModel.LARGEST:
+                    heapq.heappush(largest, (size, str(entry["account_id"])))
+                elif size > largest[0][0]:
+                    heapq.heapreplace(largest, (size, str(entry["account_id"])))
+
+            self.stats["sampled"] += len(sizes)
+            after = sizes[-1]["account_id"]
+            await asyncio.sleep(self.batch_delay)
+
+        await self.db.execute(
+            """
+                INSERT INTO `profile_size_reports`
+                (`gamespace_id`, `report_count`, `report_total`, `report_histogram`, `report_largest`, `report_time`)
+                VALUES (%s, %s, %s, %s, %s, NOW())
+                ON DUPLICATE KEY UPDATE `report_count`=VALUES(`report_count`), `report_total`=VALUES(`report_total`),
+                    `report_histogram`=VALUES(`report_histogram`), `report_largest`=VALUES(`report_largest`),
+                    `report_time`=VALUES(`report_time`);
+            """, gamespace_id, count, total,
+            ujson.dumps([
+                {
+                    "max": ProfileQuotaModel.HISTOGRAM[bucket] if bucket < len(ProfileQuotaModel.HISTOGRAM) else None,
+                    "count": bucket_count
+                }
+                for bucket, bucket_count in enumerate(histogram)
+            ]),
+            ujson.dumps([
+                {
+                    "account": account_id,
+                    "size": size
+                }
+                for size, account_id in sorted(largest, reverse=True)
+            ]))
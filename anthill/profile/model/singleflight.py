@@ -0,0 +1,39 @@
+
+import asyncio
+
+
+class SingleFlight(object):
+    """
+    Coalesces the concurrent calls with the same key into one, the callers share the result (or exception),
+    so they should not modify it
+    """
+
+    def __init__(self, stats=None, stat_name="coalesced"):
+        self.flights = {}
+        # an optional collections.Counter to count the coalesced calls in
+        self.stats = stats
+        self.stat_name = stat_name
+
+    async def do(self, key, func):
+        """
+        Calls func() (a coroutine function) unless a call with the same key is already in flight
+        """
+        future = self.flights.get(key)
+
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self.flights[key] = future
+            future.add_done_callback(lambda f: self.__done__(key, f))
+        elif self.stats is not None:
+            self.stats[self.stat_name] += 1
+
+        # a cancelled caller should not cancel the call for everybody else
+        return await asyncio.shield(future)
+
+    def __done__(self, key, future):
+        if self.flights.get(key) is future:
+            del self.flights[key]
+
+        # the exception is retrieved by the callers, unless they all are gone
+        if not future.cancelled():
+            future.exception()
@@ -0,0 +1,57 @@
+
+import collections
+import functools
+
+
+class StatementCache(object):
+    """
+    Keeps the SQL built for the dynamic profile queries, least recently used evicted first
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.stats = collections.Counter()
+
+    def get(self, key, build):
+        """
+        Returns the entry by key, calling build() to make it if there is no such one yet
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            pass
+        else:
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+        self.stats["misses"] += 1
+        value = build()
+
+        self.entries[key] = value
+
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+        return value
+
+    def get_stats(self):
+        placeholders = values_placeholder.cache_info()
+
+        stats = dict(self.stats)
+        stats["size"] = len(self.entries)
+        stats["placeholder_hits"] = placeholders.hits
+        stats["placeholder_misses"] = placeholders.misses
+
+        return stats
+
+
+@functools.lru_cache(maxsize=256)
+def values_placeholder(rows, columns):
+    """
+    Returns "(%s, %s), (%s, %s)" for the multi-row INSERTs, for the given number of rows and columns
+    """
+    row = "(" + ", ".join(["%s"] * columns) + ")"
+    return ", ".join([row] * rows)
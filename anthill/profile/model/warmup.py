@@ -0,0 +1,127 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError
+
+import contextlib
+import asyncio
+import logging
+import time
+
+
+class ProfileWarmupModel(Model):
+    """
+    Fills the database pool and preloads the settings of the recently active gamespaces (optionally, the recent
+    profiles too), the node is ready once done or after the timeout
+    """
+
+    RETRY_DELAY = 5
+
+    # noinspection PyShadowingNames
+    def __init__(self, db, profiles, enabled=True, connections=1, active_hours=24, max_gamespaces=1000,
+                 prefetch=0, timeout=60):
+        self.db = db
+        self.profiles = profiles
+        self.enabled = enabled
+        self.connections = connections
+        self.active_hours = active_hours
+        self.max_gamespaces = max_gamespaces
+        # how many of the recently updated profiles of each gamespace to read, 0 to read none
+        self.prefetch = prefetch
+        self.timeout = timeout
+
+        self.ready = False
+        self.started_at = None
+        self.duration = None
+        self.gamespaces = 0
+
+    def is_ready(self):
+        if not self.ready and self.started_at and time.time() - self.started_at > self.timeout:
+            logging.warning("Warm-up takes too long, reporting the node as ready anyway")
+            self.ready = True
+        return self.ready
+
+    def dump(self):
+        return {
+            "ready": self.is_ready(),
+            "duration": self.duration,
+            "gamespaces": self.gamespaces
+        }
+
+    async def started(self, application):
+        await super(ProfileWarmupModel, self).started(application)
+
+        if not self.enabled:
+            self.ready = True
+            return
+
+        self.started_at = time.time()
+        IOLoop.current().spawn_callback(self.warmup)
+
+    async def warmup(self):
+        # the database has to be reachable at least
+        while True:
+            try:
+                await self.__open_connections__()
+            except DatabaseError as e:
+                logging.warning("Warm-up: the database is not available ({0}), retrying".format(str(e)))
+                await asyncio.sleep(ProfileWarmupModel.RETRY_DELAY)
+            else:
+                break
+
+        try:
+            gamespaces = await self.__active_gamespaces__()
+
+            for gamespace_id in gamespaces:
+                await self.__preload_gamespace__(gamespace_id)
+                self.gamespaces += 1
+
+        except DatabaseError:
+            logging.exception("Warm-up has failed")
+
+        self.duration = time.time() - self.started_at
+        self.ready = True
+
+        logging.info("Warm-up is complete in {0:.2f}s, {1} gamespace(s)".format(self.duration, self.gamespaces))
+
+    async def __open_connections__(self):
+        # all of them are held at once, so each one is a new connection
+        async with contextlib.AsyncExitStack() as stack:
+            for _ in range(0, self.connections):
+                db = await stack.enter_async_context(self.db.acquire())
+                await db.get("SELECT 1 AS `ok`;")
+
+    async def __active_gamespaces__(self):
+        gamespaces = await self.db.query(
+            """
+                SELECT DISTINCT `gamespace_id`
+                FROM `account_profiles`
+                WHERE `time_updated` > NOW() - INTERVAL %s HOUR
+                LIMIT %s;
+            """, self.active_hours, self.max_gamespaces)
+
+        return [gamespace["gamespace_id"] for gamespace in gamespaces]
+
+    async def __preload_gamespace__(self, gamespace_id):
+        profiles = self.profiles
+
+        # the same calls the requests make, so the same caches are filled
+        await profiles.access.get_access(gamespace_id)
+
+        for model in [profiles.lookup, profiles.counters]:
+            if model is not None:
+                await model.get_fields(gamespace_id)
+
+        if profiles.quotas is not None:
+            await profiles.quotas.get_quota(gamespace_id)
+
+        if self.prefetch:
+            await self.db.query(
+                """
+                    SELECT `account_id`, JSON_STORAGE_SIZE(`payload`) AS `size`
+                    FROM `account_profiles`
+                    WHERE `gamespace_id`=%s
+                    ORDER BY `time_updated` DESC
+                    LIMIT %s;
+                """, gamespace_id, self.prefetch)
@@ -0,0 +1,271 @@
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from anthill.common.model import Model
+from anthill.common.database import Database
+
+import tornado.process
+import tornado.netutil
+import tornado.httpserver
+import tormysql.cursor
+import tormysql
+import collections
+import tempfile
+import logging
+import socket
+import time
+import os
+import ujson
+
+
+# set in the worker process by fork()
+WORKER_ID = 0
+WORKERS_PATH = None
+# port -> the listening sockets bound by fork() before forking, shared by all the workers
+SOCKETS = None
+
+
+class WorkerHTTPServer(tornado.httpserver.HTTPServer):
+    """
+    Serves the sockets bound by fork() instead of binding the port again (see fork)
+    """
+
+    def listen(self, port, address=None, **kwargs):
+        sockets = SOCKETS.get(port) if SOCKETS else None
+        if sockets is None:
+            return super(WorkerHTTPServer, self).listen(port, address, **kwargs)
+        self.add_sockets(sockets)
+
+
+class WorkerDatabase(Database):
+    """
+    The Database with the pool of max_connections (the common one always allows 256), for each worker
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, max_connections, host=None, database=None, user=None, password=None, **kwargs):
+        self.pool = tormysql.ConnectionPool(
+            max_connections=max_connections,
+            wait_connection_timeout=15,
+            idle_seconds=15,
+            host=host,
+            db=database,
+            user=user,
+            passwd=password,
+            cursorclass=tormysql.cursor.DictCursor,
+            autocommit=True,
+            use_unicode=True,
+            charset="utf8",
+            **kwargs
+        )
+
+
+def fork(workers, ports=None, address="127.0.0.1", max_restarts=100):
+    """
+    Forks the workers (the ports, if given, are bound first so they share the sockets), the original process
+    stays as a supervisor. Returns the id of the worker
+    """
+
+    global WORKER_ID, WORKERS_PATH, SOCKETS
+
+    if workers <= 1:
+        return 0
+
+    WORKERS_PATH = os.path.join(tempfile.gettempdir(), "anthill-profile-{0}".format(os.getpid()))
+    os.makedirs(WORKERS_PATH, exist_ok=True)
+
+    if ports:
+        # the same address the server listens on otherwise (see Server.listen_server)
+        SOCKETS = {
+            port: tornado.netutil.bind_sockets(port, address)
+            for port in ports
+        }
+
+    WORKER_ID = tornado.process.fork_processes(workers, max_restarts=max_restarts)
+
+    if SOCKETS is not None:
+        # HTTPServer is Configurable, so the server the application creates gets the sockets above
+        tornado.httpserver.HTTPServer.configure(WorkerHTTPServer)
+
+    return WORKER_ID
+
+
+class WorkerGroup(Model):
+    """
+    Connects the workers of the same node with unix datagram sockets, to broadcast messages (best effort)
+    and aggregate the counters
+    """
+
+    STATS_INTERVAL = 5
+    # how long the counters of a worker that stopped reporting are still counted
+    STATS_EXPIRE = 30
+    MAX_MESSAGE = 65536
+
+    def __init__(self, workers=1, worker_id=None, path=None):
+        self.workers = workers
+        self.worker_id = WORKER_ID if worker_id is None else worker_id
+        self.path = WORKERS_PATH if path is None else path
+
+        self.socket = None
+        self.stats_callback = None
+
+        # message kind -> list of callbacks
+        self.handlers = collections.defaultdict(list)
+        # counter group name -> a function returning a dict of counters
+        self.stats_sources = {}
+        # worker id -> (time received, counters)
+        self.peer_stats = {}
+
+        self.subscribe("stats", self.__on_stats__)
+
+    def is_multi(self):
+        return self.workers > 1 and self.path is not None
+
+    def is_primary(self):
+        """
+        Only the first worker of the node runs the background sweeps (archive, counter folding, jobs etc)
+        """
+        return self.worker_id == 0
+
+    def __address__(self, worker_id):
+        return os.path.join(self.path, "{0}.sock".format(worker_id))
+
+    async def started(self, application):
+        await super(WorkerGroup, self).started(application)
+
+        if not self.is_multi():
+            return
+
+        address = self.__address__(self.worker_id)
+
+        try:
+            os.unlink(address)
+        except OSError:
+            pass
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.bind(address)
+
+        IOLoop.current().add_handler(self.socket.fileno(), self.__on_read__, IOLoop.READ)
+
+        self.stats_callback = PeriodicCallback(self.__publish_stats__, WorkerGroup.STATS_INTERVAL * 1000)
+        self.stats_callback.start()
+
+    async def stopped(self):
+        if self.stats_callback:
+            self.stats_callback.stop()
+            self.stats_callback = None
+
+        if self.socket:
+            IOLoop.current().remove_handler(self.socket.fileno())
+            self.socket.close()
+            self.socket = None
+
+        await super(WorkerGroup, self).stopped()
+
+    def subscribe(self, kind, callback):
+        """
+        Calls callback(data) each time another worker broadcasts a message of this kind
+        """
+        self.handlers[kind].append(callback)
+
+    def broadcast(self, kind, data):
+        """
+        Sends a message to every other worker of the node
+        """
+        if self.socket is None:
+            return
+
+        message = ujson.dumps([kind, self.worker_id, data]).encode()
+
+        if len(message) > WorkerGroup.MAX_MESSAGE:
+            logging.warning("Worker message '{0}' is too big to be sent".format(kind))
+            return
+
+        for worker_id in range(0, self.workers):
+            if worker_id == self.worker_id:
+                continue
+
+            try:
+                self.socket.sendto(message, self.__address__(worker_id))
+            except OSError:
+                # the worker is being restarted, or is too busy to receive
+                pass
+
+    def __on_read__(self, fd, events):
+        while True:
+            try:
+                message = self.socket.recv(WorkerGroup.MAX_MESSAGE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                logging.exception("Failed to receive worker message")
+                return
+
+            try:
+                kind, sender, data = ujson.loads(message)
+            except (ValueError, TypeError):
+                continue
+
+            for callback in self.handlers.get(kind, []):
+                try:
+                    callback(data)
+                except Exception:
+                    logging.exception("Failed to process worker message '{0}'".format(kind))
+
+    # counters
+
+    def add_stats(self, name, source):
+        """
+        Registers a group of counters, source is a function that returns a dict of name -> number
+        """
+        self.stats_sources[name] = source
+
+    def local_stats(self):
+        return {
+            name: dict(source())
+            for name, source in self.stats_sources.items()
+        }
+
+    def __publish_stats__(self):
+        self.broadcast("stats", {
+            "worker": self.worker_id,
+            "stats": self.local_stats()
+        })
+
+    def __on_stats__(self, data):
+        self.peer_stats[data["worker"]] = (time.time(), data["stats"])
+
+    def aggregate_stats(self):
+        """
+        Returns the counters summed across all the (alive) workers of the node
+        """
+        now = time.time()
+        result = collections.defaultdict(collections.Counter)
+        snapshots = [self.local_stats()]
+
+        for worker_id, (received, stats) in list(self.peer_stats.items()):
+            if now - received > WorkerGroup.STATS_EXPIRE:
+                self.peer_stats.pop(worker_id, None)
+                continue
+            snapshots.append(stats)
+
+        for snapshot in snapshots:
+            for name, counters in snapshot.items():
+                for key, value in counters.items():
+                    if isinstance(value, (int, float)):
+                        result[name][key] += value
+
+        return {
+            name: dict(counters)
+            for name, counters in result.items()
+        }
+
+    def alive_workers(self):
+        now = time.time()
+        return 1 + len([
+            worker_id
+            for worker_id, (received, stats) in self.peer_stats.items()
+            if now - received <= WorkerGroup.STATS_EXPIRE
+        ])
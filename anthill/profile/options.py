@@ -38,4 +38,185 @@ define("db_password",
 define("db_name",
        default="dev_profile",
        type=str,
-       help="MySQL database name")
\ No newline at end of file
+       help="MySQL database name")
+
+define("db_pool_size",
+       default=0,
+       type=int,
+       help="Total number of MySQL connections this node may open, split evenly between the workers. "
+            "0 to leave the connection pool defaults")
+
+# Workers
+
+define("workers",
+       default=1,
+       type=int,
+       help="Number of worker processes. With more than one, the port is bound once and shared by the workers, "
+            "or get a unix socket each (with a .N suffix) if the service listens on a unix socket")
+
+# Profile writes
+
+define("profile_optimistic_writes",
+       default=False,
+       type=bool,
+       help="Write profiles without locking them (SELECT ... FOR UPDATE), relying on the profile version instead")
+
+define("profile_optimistic_retries",
+       default=5,
+       type=int,
+       help="How many times an optimistic profile write is retried upon a version conflict")
+
+define("profile_optimistic_backoff",
+       default=0.02,
+       type=float,
+       help="Base delay (in seconds) between optimistic write retries, doubled after each conflict")
+
+define("profile_offload_processes",
+       default=0,
+       type=int,
+       help="How many processes decode, merge and encode the big profiles upon a write, "
+            "so they would not block the service, 0 to process everything in place")
+
+define("profile_offload_threshold",
+       default=262144,
+       type=int,
+       help="Profiles (or sets of profiles in a mass update) of this size (in bytes) or bigger are "
+            "processed by the offload processes")
+
+# Profile queries
+
+define("profile_indexed_fields",
+       default="",
+       type=str,
+       help="Profile fields that have an indexed generated column on `account_profiles`, used by queries for "
+            "sorting and aggregation instead of extracting the field from the payload. "
+            "A comma-separated list of path=column pairs, for example: rating=rating_idx,stats/level=level_idx. "
+            "The columns should be created beforehand, for example: "
+            "ALTER TABLE `account_profiles` ADD COLUMN `rating_idx` INT "
+            "GENERATED ALWAYS AS (`payload`->'$.rating') VIRTUAL, "
+            "ADD INDEX `rating_idx` (`gamespace_id`, `rating_idx`, `account_id`);")
+
+define("profile_query_max_rows",
+       default=0,
+       type=int,
+       help="Profile queries estimated (with EXPLAIN) to examine more rows than this are rejected "
+            "(or run as a background job, if the caller allows that), 0 to disable the check")
+
+define("profile_query_slow_time",
+       default=1.0,
+       type=float,
+       help="Profile queries that took longer than this (in seconds) are recorded into the slow query log")
+
+define("profile_query_cache_ttl",
+       default=0,
+       type=int,
+       help="How long (in seconds) the results of the profile queries are reused for the same queries, "
+            "so they may be that stale, 0 to disable")
+
+define("profile_query_cache_size",
+       default=67108864,
+       type=int,
+       help="Approximate memory budget (in bytes) for the cached profile query results, per worker")
+
+# Background jobs
+
+define("profile_jobs_batch_size",
+       default=1000,
+       type=int,
+       help="How many profiles a background job (like a profile query) processes at once")
+
+define("profile_jobs_batch_delay",
+       default=0.1,
+       type=float,
+       help="A delay (in seconds) between the batches of a background job, to throttle the load on the database")
+
+define("profile_jobs_concurrency",
+       default=2,
+       type=int,
+       help="How many background jobs may run on this node simultaneously")
+
+define("profile_jobs_keep_hours",
+       default=24,
+       type=int,
+       help="How long finished background jobs (and their results) are kept")
+
+# Archive
+
+define("profile_archive_interval",
+       default=3600,
+       type=int,
+       help="How often (in seconds) inactive profiles are moved into the archive, 0 to disable")
+
+define("profile_archive_batch_size",
+       default=500,
+       type=int,
+       help="How many profiles are moved into the archive at once")
+
+define("profile_archive_batch_delay",
+       default=0.5,
+       type=float,
+       help="A delay (in seconds) between archive batches")
+
+
+# Sizes
+
+define("profile_size_sample_interval",
+       default=3600,
+       type=int,
+       help="How often (in seconds) the sizes of the profiles are sampled for the admin report, 0 to disable")
+
+define("profile_size_sample_batch_size",
+       default=1000,
+       type=int,
+       help="How many profiles are sampled at once")
+
+define("profile_size_sample_batch_delay",
+       default=0.1,
+       type=float,
+       help="A delay (in seconds) between the sampling batches")
+
+# Counters
+
+define("profile_counters_fold_interval",
+       default=60,
+       type=int,
+       help="How often (in seconds) the shards of the counter fields are folded into the profiles, 0 to disable")
+
+define("profile_counters_fold_batch",
+       default=100,
+       type=int,
+       help="How many profiles have their counters folded at once")
+
+# Changes
+
+define("profile_changes_max_subscribers",
+       default=10000,
+       type=int,
+       help="How many clients may wait for the changes of their profiles at once (per worker)")
+
+# Warm-up
+
+define("profile_warmup",
+       default=True,
+       type=bool,
+       help="Whether to warm the node up once started (the node is reported as ready on /ready afterwards)")
+
+define("profile_warmup_active_hours",
+       default=24,
+       type=int,
+       help="The gamespaces with the profiles updated within this many hours are warmed up")
+
+define("profile_warmup_gamespaces",
+       default=1000,
+       type=int,
+       help="Maximum number of the gamespaces to warm up")
+
+define("profile_warmup_prefetch",
+       default=0,
+       type=int,
+       help="How many of the most recently updated profiles of each gamespace to read upon warm-up, 0 for none")
+
+define("profile_warmup_timeout",
+       default=60,
+       type=int,
+       help="The node is reported as ready after this many seconds, even if the warm-up is not complete")
\ No newline at end of file
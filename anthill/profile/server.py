@@ -4,6 +4,17 @@ from anthill.common import server, database, access
 
 from . model.profile import ProfilesModel
 from . model.access import ProfileAccessModel
+from . model.job import ProfileJobsModel
+from . model.archive import ProfileArchiveModel
+from . model.workers import WorkerGroup, WorkerDatabase, fork as fork_workers
+from . model.offload import JsonOffload
+from . model.lookup import ProfileLookupModel
+from . model.guard import QueryGuard
+from . model.cache import QueryCache
+from . model.changes import ProfileChangesModel, WorkerChangeBus
+from . model.quota import ProfileQuotaModel
+from . model.counters import ProfileCountersModel
+from . model.warmup import ProfileWarmupModel
 from . import handler as h
 from . import options as _opts
 from . import admin
@@ -14,17 +25,133 @@ class ProfileServer(server.Server):
     def __init__(self):
         super(ProfileServer, self).__init__()
 
-        self.db = database.Database(
-            host=options.db_host,
-            database=options.db_name,
-            user=options.db_username,
-            password=options.db_password)
+        self.workers = WorkerGroup(workers=options.workers)
+        # the background sweeps are run by the first worker of the node only
+        primary = self.workers.is_primary()
+
+        connections = 1
+
+        if options.db_pool_size:
+            # every worker has its own pool
+            connections = max(1, options.db_pool_size // max(1, options.workers))
+
+            self.db = WorkerDatabase(
+                connections,
+                host=options.db_host,
+                database=options.db_name,
+                user=options.db_username,
+                password=options.db_password)
+        else:
+            self.db = database.Database(
+                host=options.db_host,
+                database=options.db_name,
+                user=options.db_username,
+                password=options.db_password)
 
         self.access = ProfileAccessModel(self.db)
-        self.profiles = ProfilesModel(self.db, self.access)
+        self.lookup = ProfileLookupModel(self.db)
+        self.guard = QueryGuard(
+            max_rows=options.profile_query_max_rows,
+            slow_time=options.profile_query_slow_time)
+        self.query_cache = QueryCache(
+            ttl=options.profile_query_cache_ttl,
+            max_size=options.profile_query_cache_size,
+            workers=self.workers)
+
+        # the changes are delivered to the other workers of the node, another bus may be plugged in
+        # to deliver them across the nodes (see ChangeBus)
+        self.changes = ProfileChangesModel(
+            bus=WorkerChangeBus(self.workers),
+            max_subscribers=options.profile_changes_max_subscribers)
+
+        self.quotas = ProfileQuotaModel(
+            self.db,
+            interval=options.profile_size_sample_interval if primary else 0,
+            batch_size=options.profile_size_sample_batch_size,
+            batch_delay=options.profile_size_sample_batch_delay)
+
+        self.counters = ProfileCountersModel(
+            self.db, self.access,
+            fold_interval=options.profile_counters_fold_interval if primary else 0,
+            fold_batch=options.profile_counters_fold_batch)
+
+        self.offload = JsonOffload(
+            processes=options.profile_offload_processes,
+            threshold=options.profile_offload_threshold)
+
+        self.profiles = ProfilesModel(
+            self.db, self.access,
+            optimistic_writes=options.profile_optimistic_writes,
+            optimistic_retries=options.profile_optimistic_retries,
+            optimistic_backoff=options.profile_optimistic_backoff,
+            indexed_fields=ProfileServer.__parse_indexed_fields__(options.profile_indexed_fields),
+            offload=self.offload,
+            lookup=self.lookup,
+            guard=self.guard,
+            cache=self.query_cache,
+            changes=self.changes,
+            quotas=self.quotas,
+            counters=self.counters)
+
+        self.jobs = ProfileJobsModel(
+            self.db, self.profiles,
+            batch_size=options.profile_jobs_batch_size,
+            batch_delay=options.profile_jobs_batch_delay,
+            concurrency=options.profile_jobs_concurrency,
+            keep_hours=options.profile_jobs_keep_hours,
+            poll=primary)
+
+        self.archive = ProfileArchiveModel(
+            self.db,
+            interval=options.profile_archive_interval if primary else 0,
+            batch_size=options.profile_archive_batch_size,
+            batch_delay=options.profile_archive_batch_delay)
+
+        self.warmup = ProfileWarmupModel(
+            self.db, self.profiles,
+            enabled=options.profile_warmup,
+            connections=connections,
+            active_hours=options.profile_warmup_active_hours,
+            max_gamespaces=options.profile_warmup_gamespaces,
+            prefetch=options.profile_warmup_prefetch,
+            timeout=options.profile_warmup_timeout)
+
+        self.workers.add_stats("profiles", lambda: self.profiles.stats)
+        self.workers.add_stats("queries", lambda: self.guard.stats)
+        self.workers.add_stats("query_cache", lambda: self.query_cache.stats)
+        self.workers.add_stats("statements", lambda: self.profiles.statements.get_stats())
+        self.workers.add_stats("changes", lambda: self.changes.get_stats())
+        self.workers.add_stats("sizes", lambda: self.quotas.stats)
+        self.workers.add_stats("counters", lambda: self.counters.stats)
+
+    @staticmethod
+    def __parse_indexed_fields__(value):
+        result = {}
+
+        for entry in filter(bool, value.split(",")):
+            path, sep, column = entry.partition("=")
+            if not sep or not column.strip():
+                raise ValueError("Bad profile_indexed_fields entry: {0}".format(entry))
+            result[path.strip().strip("/")] = column.strip()
+
+        return result
+
+    @staticmethod
+    def __parse_ports__(listen):
+        kind, sep, addresses = listen.partition(":")
+
+        if kind != "port":
+            return None
+
+        try:
+            return [int(port) for port in addresses.split(":")]
+        except ValueError:
+            raise ValueError("Bad listen value: {0}".format(listen))
 
     def get_models(self):
-        return [self.access, self.profiles]
+        # the warm-up goes last, once everything it warms up is started
+        return [self.workers, self.changes, self.offload, self.access, self.lookup, self.quotas, self.counters,
+                self.profiles, self.jobs, self.archive, self.warmup]
 
     def get_admin(self):
         return {
@@ -32,7 +159,17 @@ class ProfileServer(server.Server):
             "access": admin.GamespaceAccessController,
             "profiles": admin.ProfilesController,
             "profile": admin.ProfileController,
-            "query": admin.QueryProfilesController
+            "query": admin.QueryProfilesController,
+            "query_jobs": admin.QueryJobsController,
+            "query_job": admin.QueryJobController,
+            "archive": admin.ArchiveController,
+            "lookup_fields": admin.LookupFieldsController,
+            "migration": admin.MigrationController,
+            "clone": admin.CloneController,
+            "quotas": admin.QuotasController,
+            "counter_fields": admin.CounterFieldsController,
+            "slow_queries": admin.SlowQueriesController,
+            "workers": admin.WorkersController
         }
 
     def get_metadata(self):
@@ -44,6 +181,8 @@ class ProfileServer(server.Server):
 
     def get_handlers(self):
         return [
+            (r"/ready", h.ReadyHandler),
+            (r"/profile/changes", h.ProfileChangesHandler),
             (r"/profile/me/?([\w/]*)", h.ProfileMeHandler),
             (r"/profile/([\w]+)/?([\w/]*)", h.ProfileUserHandler),
             (r"/profiles", h.MassProfileUsersHandler)
@@ -56,4 +195,13 @@ class ProfileServer(server.Server):
 if __name__ == "__main__":
     stt = server.init()
     access.AccessToken.init([access.public()])
+
+    if options.workers > 1:
+        # the ports are bound once and shared by the workers
+        worker_id = fork_workers(options.workers, ports=ProfileServer.__parse_ports__(options.listen))
+
+        if options.listen.startswith("unix:"):
+            # unix sockets cannot be shared, so each worker gets its own
+            options.listen = "{0}.{1}".format(options.listen, worker_id)
+
     server.start(ProfileServer)
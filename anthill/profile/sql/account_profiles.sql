@@ -2,5 +2,10 @@ CREATE TABLE `account_profiles` (
   `account_id` int(11) NOT NULL,
   `gamespace_id` int(11) NOT NULL,
   `payload` json DEFAULT NULL,
-  PRIMARY KEY (`account_id`,`gamespace_id`)
+  `payload_public` json DEFAULT NULL,
+  `public_access` char(8) DEFAULT NULL,
+  `version` int(11) unsigned NOT NULL DEFAULT '0',
+  `time_updated` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`account_id`,`gamespace_id`),
+  KEY `time_updated` (`gamespace_id`,`time_updated`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
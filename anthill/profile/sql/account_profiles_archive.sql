@@ -0,0 +1,10 @@
+CREATE TABLE `account_profiles_archive` (
+  `account_id` int(11) NOT NULL,
+  `gamespace_id` int(11) NOT NULL,
+  `payload` mediumblob NOT NULL,
+  `version` int(11) unsigned NOT NULL DEFAULT '0',
+  `time_updated` timestamp NOT NULL,
+  `time_archived` timestamp NOT NULL,
+  PRIMARY KEY (`account_id`,`gamespace_id`),
+  KEY `gamespace_id` (`gamespace_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,5 @@
+CREATE TABLE `profile_archive_settings` (
+  `gamespace_id` int(11) NOT NULL,
+  `archive_after_days` int(11) unsigned NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gamespace_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,6 @@
+CREATE TABLE `profile_counter_fields` (
+  `gamespace_id` int(11) NOT NULL,
+  `field_path` varchar(255) NOT NULL,
+  `field_shards` int(11) unsigned NOT NULL DEFAULT '1',
+  PRIMARY KEY (`gamespace_id`,`field_path`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
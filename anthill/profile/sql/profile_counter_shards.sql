@@ -0,0 +1,8 @@
+CREATE TABLE `profile_counter_shards` (
+  `gamespace_id` int(11) NOT NULL,
+  `account_id` int(11) NOT NULL,
+  `field_path` varchar(255) NOT NULL,
+  `shard_id` int(11) unsigned NOT NULL,
+  `shard_value` double NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gamespace_id`,`account_id`,`field_path`,`shard_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,7 @@
+CREATE TABLE `profile_job_results` (
+  `job_id` int(11) unsigned NOT NULL,
+  `account_id` int(11) NOT NULL,
+  `payload` json DEFAULT NULL,
+  PRIMARY KEY (`job_id`,`account_id`),
+  CONSTRAINT `profile_job_results_ibfk_1` FOREIGN KEY (`job_id`) REFERENCES `profile_jobs` (`job_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
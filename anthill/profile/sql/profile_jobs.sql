@@ -0,0 +1,16 @@
+CREATE TABLE `profile_jobs` (
+  `job_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) NOT NULL,
+  `job_kind` varchar(32) NOT NULL,
+  `job_status` enum('queued','running','complete','failed','cancelled') NOT NULL DEFAULT 'queued',
+  `job_args` json NOT NULL,
+  `job_cursor` int(11) NOT NULL DEFAULT '0',
+  `job_processed` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_affected` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_error` varchar(1024) DEFAULT NULL,
+  `job_created` datetime NOT NULL,
+  `job_updated` datetime NOT NULL,
+  PRIMARY KEY (`job_id`),
+  KEY `gamespace_id` (`gamespace_id`,`job_id`),
+  KEY `job_status` (`job_status`,`job_updated`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,6 @@
+CREATE TABLE `profile_lookup_fields` (
+  `gamespace_id` int(11) NOT NULL,
+  `field_path` varchar(255) NOT NULL,
+  `field_unique` tinyint(1) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gamespace_id`,`field_path`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
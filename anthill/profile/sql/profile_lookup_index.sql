@@ -0,0 +1,9 @@
+CREATE TABLE `profile_lookup_index` (
+  `gamespace_id` int(11) NOT NULL,
+  `field_path` varchar(255) NOT NULL,
+  `field_value` varchar(255) NOT NULL,
+  `account_id` int(11) NOT NULL,
+  `field_uniq` int(11) NOT NULL,
+  PRIMARY KEY (`gamespace_id`,`field_path`,`field_value`,`field_uniq`),
+  KEY `account_id` (`gamespace_id`,`account_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
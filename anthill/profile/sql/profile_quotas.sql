@@ -0,0 +1,6 @@
+CREATE TABLE `profile_quotas` (
+  `gamespace_id` int(11) NOT NULL,
+  `quota_max_size` int(11) unsigned NOT NULL DEFAULT '0',
+  `quota_paths` json DEFAULT NULL,
+  PRIMARY KEY (`gamespace_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
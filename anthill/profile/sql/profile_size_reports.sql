@@ -0,0 +1,10 @@
+CREATE TABLE `profile_size_reports` (
+  `gamespace_id` int(11) NOT NULL,
+  `report_count` int(11) unsigned NOT NULL DEFAULT '0',
+  `report_total` bigint(20) unsigned NOT NULL DEFAULT '0',
+  `report_histogram` json DEFAULT NULL,
+  `report_largest` json DEFAULT NULL,
+  `report_time` datetime DEFAULT NULL,
+  `report_claimed` datetime DEFAULT NULL,
+  PRIMARY KEY (`gamespace_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,99 @@
+
+from anthill.profile.model.counters import increment_delta, split_increments, touched_counters
+from anthill.profile.model.counters import apply_counters, sum_shards
+
+import unittest
+
+
+class IncrementTestCase(unittest.TestCase):
+    def test_delta(self):
+        self.assertEqual(increment_delta({"@func": "++"}), 1)
+        self.assertEqual(increment_delta({"@func": "++", "@value": 5}), 5)
+        self.assertEqual(increment_delta({"@func": "--", "@value": 2.5}), -2.5)
+
+    def test_not_increments(self):
+        for value in [5, "++", None, {}, {"@func": "*="}, {"@func": "++", "@value": True},
+                      {"@func": "++", "@value": "5"}, {"@func": "++", "@value": 1, "@cond": 0}]:
+            self.assertIsNone(increment_delta(value))
+
+
+class SplitIncrementsTestCase(unittest.TestCase):
+    COUNTERS = ["guild/score", "guild/stats/kills", "coins"]
+
+    def test_split(self):
+        fields = {"guild": {"score": {"@func": "++", "@value": 3}, "name": "a"}, "level": 2}
+
+        rest, increments = split_increments(fields, [], self.COUNTERS)
+
+        self.assertEqual(rest, {"guild": {"name": "a"}, "level": 2})
+        self.assertEqual(increments, {"guild/score": 3})
+        # the caller's fields are left intact
+        self.assertEqual(fields["guild"]["score"], {"@func": "++", "@value": 3})
+
+    def test_emptied_parents(self):
+        fields = {"guild": {"stats": {"kills": {"@func": "++"}}}, "level": 2}
+
+        self.assertEqual(split_increments(fields, [], self.COUNTERS), ({"level": 2}, {"guild/stats/kills": 1}))
+
+    def test_nothing_left(self):
+        fields = {"score": {"@func": "--"}, "stats": {"kills": {"@func": "++", "@value": 2}}}
+
+        self.assertEqual(split_increments(fields, ["guild"], self.COUNTERS),
+                         (None, {"guild/score": -1, "guild/stats/kills": 2}))
+
+    def test_counter_path(self):
+        self.assertEqual(split_increments({"@func": "++", "@value": 10}, ["coins"], self.COUNTERS),
+                         (None, {"coins": 10}))
+
+    def test_plain_values(self):
+        fields = {"coins": 5, "guild": {"score": {"@func": "*=", "@value": 2}}}
+
+        self.assertEqual(split_increments(fields, [], self.COUNTERS), (fields, {}))
+
+
+class TouchedCountersTestCase(unittest.TestCase):
+    COUNTERS = ["guild/score", "guild/stats/kills", "coins"]
+
+    def test_merge(self):
+        self.assertEqual(touched_counters({"guild": {"score": 0}}, [], True, self.COUNTERS), ["guild/score"])
+        self.assertEqual(touched_counters({"stats": {"kills": 1}}, ["guild"], True, self.COUNTERS),
+                         ["guild/stats/kills"])
+        self.assertEqual(touched_counters({"level": 1}, [], True, self.COUNTERS), [])
+
+    def test_replace(self):
+        # everything under the path is overwritten
+        self.assertEqual(touched_counters({}, ["guild"], False, self.COUNTERS), ["guild/score", "guild/stats/kills"])
+        self.assertEqual(touched_counters({}, [], False, self.COUNTERS), self.COUNTERS)
+
+
+class ApplyCountersTestCase(unittest.TestCase):
+    def test_apply(self):
+        data = {"guild": {"score": 10, "name": "a"}}
+
+        result = apply_counters(data, [], {"guild/score": 5, "guild/stats/kills": 2, "coins": 1})
+
+        self.assertEqual(result, {"guild": {"score": 15, "name": "a", "stats": {"kills": 2}}, "coins": 1})
+        # copy on write
+        self.assertEqual(data, {"guild": {"score": 10, "name": "a"}})
+
+    def test_path(self):
+        self.assertEqual(apply_counters({"score": 1}, ["guild"], {"guild/score": 2, "coins": 3}), {"score": 3})
+        self.assertEqual(apply_counters(7, ["coins"], {"coins": 3}), 10)
+        self.assertEqual(apply_counters(None, ["coins"], {"coins": 3}), 3)
+
+    def test_not_numbers(self):
+        self.assertEqual(apply_counters({"coins": "many"}, [], {"coins": 3}), {"coins": 3})
+        self.assertEqual(apply_counters({"coins": True}, [], {"coins": 3}), {"coins": 3})
+        # a counter under a value that is not an object is left alone
+        self.assertEqual(apply_counters({"guild": 5}, [], {"guild/score": 3}), {"guild": 5})
+
+
+class SumShardsTestCase(unittest.TestCase):
+    def test_sum(self):
+        self.assertEqual(sum_shards(None), {})
+        self.assertEqual(sum_shards([["coins", 1.0], ["coins", 2.0], ["guild/score", 0.5]]),
+                         {"coins": 3, "guild/score": 0.5})
+        self.assertEqual(sum_shards('[["coins", -1.0]]'), {"coins": -1})
+
+    def test_whole_values(self):
+        self.assertIsInstance(sum_shards([["coins", 2.0]])["coins"], int)
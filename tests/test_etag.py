@@ -0,0 +1,28 @@
+
+from tornado.web import HTTPError
+
+from anthill.profile.handler import format_etag, parse_etag_version
+
+import unittest
+
+
+class EtagTestCase(unittest.TestCase):
+    def test_format(self):
+        self.assertEqual(format_etag(5), '"5"')
+        self.assertEqual(format_etag(5, "abc"), '"5-abc"')
+
+    def test_parse(self):
+        self.assertIsNone(parse_etag_version(None))
+        self.assertIsNone(parse_etag_version("*"))
+        self.assertEqual(parse_etag_version('"5"'), 5)
+        self.assertEqual(parse_etag_version('W/"5-abc"'), 5)
+        self.assertEqual(parse_etag_version('"7", "8"'), 7)
+
+    def test_round_trip(self):
+        self.assertEqual(parse_etag_version(format_etag(12)), 12)
+        self.assertEqual(parse_etag_version(format_etag(12, "ff")), 12)
+
+    def test_corrupted(self):
+        with self.assertRaises(HTTPError) as e:
+            parse_etag_version('"abc"')
+        self.assertEqual(e.exception.status_code, 400)
@@ -0,0 +1,98 @@
+
+from anthill.profile.model.job import ProfileJobsModel, JobError
+
+import unittest
+import asyncio
+
+
+def step(**kwargs):
+    condition, condition_args, payload, payload_args = ProfileJobsModel.__migration_step__(kwargs)
+
+    # every placeholder gets an argument
+    assert condition.count("%s") == len(condition_args)
+    assert payload.count("%s") == len(payload_args)
+
+    return condition, condition_args, payload, payload_args
+
+
+class MigrationStepTestCase(unittest.TestCase):
+    def test_delete(self):
+        self.assertEqual(step(op="delete", path="event/2026"), (
+            "JSON_CONTAINS_PATH(`payload`, 'one', %s)", ['$."event"."2026"'],
+            "JSON_REMOVE(`payload`, %s)", ['$."event"."2026"']))
+
+    def test_rename(self):
+        self.assertEqual(step(**{"op": "rename", "from": "coins", "to": "gold"}), (
+            "JSON_CONTAINS_PATH(`payload`, 'one', %s)", ['$."coins"'],
+            "JSON_SET(JSON_REMOVE(`payload`, %s), %s, JSON_EXTRACT(`payload`, %s))",
+            ['$."coins"', '$."gold"', '$."coins"']))
+
+    def test_move_creates_parents(self):
+        condition, condition_args, payload, payload_args = step(**{"op": "move", "from": "coins",
+                                                                   "to": "currency/soft"})
+
+        # the parent has to be either missing or an object
+        self.assertIn("COALESCE(JSON_TYPE(JSON_EXTRACT(`payload`, %s)), 'OBJECT')='OBJECT'", condition)
+        self.assertEqual(condition_args, ['$."coins"', '$."currency"'])
+        self.assertTrue(payload.startswith("JSON_SET(JSON_INSERT(JSON_REMOVE(`payload`, %s), %s, JSON_OBJECT())"))
+        self.assertEqual(payload_args, ['$."coins"', '$."currency"', '$."currency"."soft"', '$."coins"'])
+
+    def test_default(self):
+        condition, condition_args, payload, payload_args = step(op="default", path="settings/sound", value=True)
+
+        self.assertTrue(condition.startswith("NOT JSON_CONTAINS_PATH(`payload`, 'one', %s)"))
+        self.assertEqual(condition_args, ['$."settings"."sound"', '$."settings"'])
+        self.assertEqual(payload, "JSON_SET(JSON_INSERT(`payload`, %s, JSON_OBJECT()), %s, CAST(%s AS JSON))")
+        self.assertEqual(payload_args, ['$."settings"', '$."settings"."sound"', "true"])
+
+    def test_bad_steps(self):
+        for bad in [
+            "delete",
+            {"op": "explode", "path": "a"},
+            {"op": "delete"},
+            {"op": "delete", "path": "/"},
+            {"op": "rename", "from": "a", "to": "a/b"},
+            {"op": "default", "path": "a"}
+        ]:
+            with self.assertRaises(JobError):
+                ProfileJobsModel.__migration_step__(bad)
+
+
+class FakeJobsDatabase(object):
+    async def execute(self, query, *args):
+        # the claim of the other job gets in here
+        await asyncio.sleep(0)
+        return 1
+
+    async def get(self, query, job_id):
+        return {"job_id": job_id, "job_kind": ProfileJobsModel.KIND_MIGRATION}
+
+
+class ClaimTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrency(self):
+        jobs = ProfileJobsModel(FakeJobsDatabase(), None, concurrency=1)
+        started = []
+
+        async def run(job):
+            started.append(job.job_id)
+
+        jobs.__run__ = run
+
+        await asyncio.gather(jobs.__claim__("1"), jobs.__claim__("2"))
+        await asyncio.sleep(0)
+
+        self.assertEqual(started, ["1"])
+        self.assertEqual(jobs.running, {"1"})
+
+    async def test_not_claimed(self):
+        db = FakeJobsDatabase()
+        jobs = ProfileJobsModel(db, None, concurrency=1)
+
+        async def taken(query, *args):
+            return 0
+
+        db.execute = taken
+        await jobs.__claim__("1")
+
+        # the slot is free again
+        self.assertEqual(jobs.running, set())
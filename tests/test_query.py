@@ -0,0 +1,86 @@
+
+from anthill.common.database import format_conditions_json, ConditionError
+
+from anthill.profile.model.profile import format_json_path, filter_values, ProfileQuery, ProfileQueryError
+from anthill.profile.model.statements import StatementCache
+
+import unittest
+
+
+class JsonPathTestCase(unittest.TestCase):
+    def test_path(self):
+        self.assertEqual(format_json_path("a"), '$."a"')
+        self.assertEqual(format_json_path("a/b/c"), '$."a"."b"."c"')
+        self.assertEqual(format_json_path(["a", "b"]), '$."a"."b"')
+
+    def test_empty_keys(self):
+        self.assertEqual(format_json_path("/a//b/"), '$."a"."b"')
+
+    def test_escaping(self):
+        self.assertEqual(format_json_path(['we"ird']), '$."we\\"ird"')
+        self.assertEqual(format_json_path(["back\\slash"]), '$."back\\\\slash"')
+
+    def test_empty(self):
+        for path in ["", "/", []]:
+            with self.assertRaises(ProfileQueryError):
+                format_json_path(path)
+
+
+class FilterTestCase(unittest.TestCase):
+    FILTERS = [
+        {"nickname": "a"},
+        {"level": 5, "vip": True, "stats.rating": 1.5},
+        {"level": {"@func": ">=", "@value": 10}, "gold": {"@func": "<", "@value": 5}},
+        {"level": {"@func": "between", "@a": 1, "@b": 10}},
+        {"clan": ["a", "b", 3]},
+        {"clan": {"@func": "in", "@values": ["a"]}, "name": {"@func": "=", "@value": True}},
+        {"a": {"@func": "!=", "@value": 1}, "b": {"@func": "<=", "@value": 2}, "c": {"@func": ">", "@value": 3}}
+    ]
+
+    BAD_FILTERS = [
+        {"a": None},
+        {"a": {}},
+        {"a": {"@func": "like", "@value": "x"}},
+        {"a": {"@func": ">", "@value": "x"}},
+        {"a": {"@func": "between", "@a": 1}},
+        {"a": []},
+        {"a": [{}]}
+    ]
+
+    def test_values(self):
+        for filters in FilterTestCase.FILTERS:
+            expected = [arg for condition, args in format_conditions_json("payload", filters) for arg in args]
+            self.assertEqual([
+                arg for path, value in filters.items() for arg in filter_values(path, value)
+            ], expected)
+
+    def test_bad_values(self):
+        for filters in FilterTestCase.BAD_FILTERS:
+            for path, value in filters.items():
+                with self.assertRaises(ConditionError):
+                    filter_values(path, value)
+
+    def query(self, statements, filters):
+        q = ProfileQuery(1, None, statements=statements)
+        q.filters = filters
+        return q.__values__()
+
+    def test_shared_statements(self):
+        statements = StatementCache()
+
+        for filters in FilterTestCase.FILTERS:
+            self.assertEqual(self.query(statements, filters), self.query(None, filters))
+
+        # the same filters with the other values
+        self.assertEqual(self.query(statements, {"nickname": "b"}), (
+            ["`account_profiles`.`gamespace_id`=%s",
+             "CAST(JSON_UNQUOTE(JSON_EXTRACT(`payload`, %s)) AS CHAR) = %s"],
+            ["1", '$."nickname"', "b"]))
+        self.assertEqual(self.query(statements, {"clan": ["c", "d", "e"]}), self.query(None, {"clan": ["c", "d", "e"]}))
+
+        self.assertEqual(statements.get_stats()["size"], len(FilterTestCase.FILTERS))
+        self.assertEqual(statements.get_stats()["hits"], 2)
+
+        for filters in FilterTestCase.BAD_FILTERS:
+            with self.assertRaises(ConditionError):
+                self.query(statements, filters)
@@ -0,0 +1,61 @@
+
+from anthill.profile.model.quota import QuotaAdapter, ProfileQuotaExceeded
+from anthill.profile.model.quota import path_sizes, encoded_size, check_paths_quota, check_size_quota
+
+import unittest
+
+
+class QuotaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.quota = QuotaAdapter({
+            "quota_max_size": 100,
+            "quota_paths": '{"mail/inbox": 10}'
+        })
+
+    def test_adapter(self):
+        self.assertEqual(self.quota.paths, {"mail/inbox": 10})
+        self.assertFalse(self.quota.is_empty())
+        self.assertTrue(QuotaAdapter({}).is_empty())
+
+    def test_path_sizes(self):
+        data = {"mail": {"inbox": [1, 2]}, "name": "abc"}
+        self.assertEqual(path_sizes(data, ["mail/inbox", "name", "mail/outbox", "name/first"]), {
+            "mail/inbox": len("[1,2]"),
+            "name": len('"abc"'),
+            "mail/outbox": 0,
+            "name/first": 0
+        })
+
+    def test_encoded_size(self):
+        self.assertEqual(encoded_size(None), 0)
+        # compact, the way the profiles are written
+        self.assertEqual(encoded_size({"a": 1, "b": [1, 2]}), len('{"a":1,"b":[1,2]}'))
+
+    def test_size_quota(self):
+        check_size_quota(None, 1000)
+        check_size_quota(QuotaAdapter({}), 1000)
+        check_size_quota(self.quota, 100)
+
+        with self.assertRaises(ProfileQuotaExceeded):
+            check_size_quota(self.quota, 101)
+
+        with self.assertRaises(ProfileQuotaExceeded):
+            check_size_quota(self.quota, 150, 120)
+
+        # a profile over the quota already may shrink, or stay the same
+        check_size_quota(self.quota, 150, 200)
+        check_size_quota(self.quota, 150, 150)
+
+    def test_paths_quota(self):
+        check_paths_quota(None, {"mail": {"inbox": "x" * 100}})
+        check_paths_quota(self.quota, {"mail": {"inbox": [1, 2]}})
+
+        with self.assertRaises(ProfileQuotaExceeded):
+            check_paths_quota(self.quota, {"mail": {"inbox": "x" * 100}})
+
+        # the part over the quota already may shrink
+        check_paths_quota(self.quota, {"mail": {"inbox": "x" * 50}}, {"mail/inbox": 102})
+
+    def test_exceeded_is_profile_error(self):
+        from anthill.common.profile import ProfileError
+        self.assertTrue(issubclass(ProfileQuotaExceeded, ProfileError))
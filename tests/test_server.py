@@ -0,0 +1,50 @@
+
+from anthill.common.options import options
+
+from anthill.profile.server import ProfileServer
+from anthill.profile.model.workers import WorkerDatabase
+
+import pymysql.connections
+import unittest
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.defaults = {
+            "db_pool_size": options.db_pool_size,
+            "workers": options.workers
+        }
+
+    def tearDown(self):
+        for name, value in self.defaults.items():
+            setattr(options, name, value)
+
+    def test_pool_size(self):
+        options.db_pool_size = 8
+        options.workers = 2
+
+        server = ProfileServer()
+
+        self.assertIsInstance(server.db, WorkerDatabase)
+        # split between the workers
+        self.assertEqual(server.db.pool._max_connections, 4)
+        self.assertEqual(server.warmup.connections, 4)
+
+        # the rest of the arguments go to the connections, which should accept them
+        pymysql.connections.Connection(defer_connect=True, **server.db.pool._kwargs)
+
+    def test_default_pool(self):
+        options.db_pool_size = 0
+
+        server = ProfileServer()
+
+        self.assertNotIsInstance(server.db, WorkerDatabase)
+        self.assertEqual(server.warmup.connections, 1)
+
+    def test_ports(self):
+        self.assertEqual(ProfileServer.__parse_ports__("port:9505"), [9505])
+        self.assertEqual(ProfileServer.__parse_ports__("port:9505:9506"), [9505, 9506])
+        self.assertIsNone(ProfileServer.__parse_ports__("unix:/tmp/profile.sock"))
+
+        with self.assertRaises(ValueError):
+            ProfileServer.__parse_ports__("port:abc")
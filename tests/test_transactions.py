@@ -0,0 +1,228 @@
+
+from anthill.common.database import DuplicateError
+from anthill.common.profile import ProfileError
+
+from anthill.profile.model.profile import UserProfile, UserProfiles, ProfilePreconditionError
+from anthill.profile.model.lookup import LookupFieldAdapter
+from anthill.profile.model.counters import ProfileCountersModel
+from anthill.profile.model.offload import JsonOffload
+
+from concurrent.futures import ThreadPoolExecutor
+
+import unittest
+import ujson
+import re
+
+
+class FakeConnection(object):
+    def __init__(self, db):
+        self.db = db
+
+    def __log__(self, entry):
+        self.db.log.append((id(self), entry))
+
+    async def init(self):
+        self.__log__("acquire")
+        return self
+
+    async def __aenter__(self):
+        return await self.init()
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.__log__("release")
+
+    async def commit(self):
+        self.__log__("commit")
+
+    async def rollback(self):
+        self.__log__("rollback")
+
+    async def __statement__(self, query):
+        # "UPDATE account_profiles" and so on
+        table = re.search(r"(?:FROM|INTO|UPDATE)\s+`(\w+)`", query).group(1)
+        statement = "{0} {1}".format(query.split()[0].upper(), table)
+        self.__log__(statement)
+        if statement in self.db.errors:
+            raise self.db.errors[statement]
+        return self.db.results.get(statement)
+
+    async def get(self, query, *args, **kwargs):
+        return await self.__statement__(query)
+
+    async def query(self, query, *args, **kwargs):
+        return await self.__statement__(query)
+
+    async def execute(self, query, *args, **kwargs):
+        return await self.__statement__(query) or 1
+
+    async def insert(self, query, *args, **kwargs):
+        return await self.__statement__(query)
+
+
+class FakeDatabase(object):
+    def __init__(self, results=None, errors=None):
+        self.log = []
+        self.results = results or {}
+        self.errors = errors or {}
+
+    def acquire(self, auto_commit=True):
+        return FakeConnection(self)
+
+    def connections(self):
+        return {connection for connection, entry in self.log}
+
+    def statements(self):
+        return [entry for connection, entry in self.log]
+
+
+class FakeAccess(object):
+    class Access(object):
+        def get_public(self):
+            return []
+
+    async def get_access(self, gamespace_id):
+        return FakeAccess.Access()
+
+
+class TransactionsTestCase(unittest.IsolatedAsyncioTestCase):
+    PROFILE = {"payload": ujson.dumps({"nickname": "a", "gold": 100}), "version": 3}
+
+    def profile_db(self, **kwargs):
+        return FakeDatabase(results={"SELECT account_profiles": TransactionsTestCase.PROFILE}, **kwargs)
+
+    async def test_single_connection(self):
+        db = self.profile_db()
+
+        result = await UserProfile(db, 1, 1).set_data({"gold": 50}, None)
+
+        self.assertEqual(result["gold"], 50)
+        self.assertEqual(len(db.connections()), 1)
+        self.assertEqual(db.statements(), [
+            "acquire", "SELECT account_profiles", "UPDATE account_profiles", "commit", "release"])
+
+    async def test_lookup_conflict(self):
+        db = self.profile_db(errors={"INSERT profile_lookup_index": DuplicateError(1062, "Duplicate entry")})
+        user_profile = UserProfile(db, 1, 1, lookup_fields=[
+            LookupFieldAdapter({"field_path": "nickname", "field_unique": 1})
+        ])
+
+        with self.assertRaises(ProfileError):
+            await user_profile.set_data({"nickname": "b"}, None)
+
+        # the profile is not written either
+        self.assertEqual(db.statements(), [
+            "acquire", "SELECT account_profiles", "UPDATE account_profiles", "DELETE profile_lookup_index",
+            "INSERT profile_lookup_index", "rollback", "release"])
+
+    async def test_on_write(self):
+        db = self.profile_db()
+        user_profile = UserProfile(db, 1, 1)
+        connections = []
+
+        async def callback(conn):
+            connections.append(conn)
+            await conn.execute("INSERT INTO `profile_counter_shards`")
+
+        user_profile.on_write.append(callback)
+        await user_profile.set_data({"gold": 50}, None)
+
+        self.assertEqual(len(db.connections()), 1)
+        self.assertEqual(id(connections[0]), db.log[0][0])
+        self.assertEqual(db.statements(), [
+            "acquire", "SELECT account_profiles", "UPDATE account_profiles", "INSERT profile_counter_shards",
+            "commit", "release"])
+
+    async def test_on_write_failed(self):
+        db = self.profile_db(errors={"INSERT profile_counter_shards": DuplicateError(1062, "Duplicate entry")})
+        user_profile = UserProfile(db, 1, 1)
+
+        async def callback(conn):
+            await conn.execute("INSERT INTO `profile_counter_shards`")
+
+        user_profile.on_write.append(callback)
+
+        with self.assertRaises(DuplicateError):
+            await user_profile.set_data({"gold": 50}, None)
+
+        self.assertEqual(db.statements()[-2:], ["rollback", "release"])
+        self.assertNotIn("commit", db.statements())
+
+    async def test_fold_nothing(self):
+        db = FakeDatabase(results={"SELECT account_profiles": {"version": 3}, "SELECT profile_counter_shards": []})
+
+        await ProfileCountersModel(db, FakeAccess(), fold_interval=0).fold_account(1, 1)
+
+        # the profile is not left locked
+        self.assertEqual(db.statements(), [
+            "acquire", "SELECT account_profiles", "SELECT profile_counter_shards", "commit", "release"])
+
+    def offload(self):
+        offload = JsonOffload(threshold=0)
+        offload.executor = ThreadPoolExecutor(1)
+        self.addCleanup(offload.executor.shutdown)
+        return offload
+
+    async def test_offload(self):
+        db = self.profile_db()
+
+        result = await UserProfile(db, 1, 1, offload=self.offload()).set_data({"gold": 50}, None)
+
+        self.assertEqual(ujson.loads(result)["gold"], 50)
+        # the offloaded profile is written on the connection that has locked it
+        self.assertEqual(len(db.connections()), 1)
+        self.assertEqual(db.statements(), [
+            "acquire", "SELECT account_profiles", "UPDATE account_profiles", "commit", "release"])
+
+    async def test_offload_many(self):
+        db = FakeDatabase(results={"SELECT account_profiles": [
+            dict(TransactionsTestCase.PROFILE, account_id=1),
+            dict(TransactionsTestCase.PROFILE, account_id=2)
+        ]})
+
+        await UserProfiles(db, 1, [1, 2], offload=self.offload()).set_data({"1": {"gold": 50}}, None)
+
+        self.assertEqual(len(db.connections()), 1)
+        self.assertEqual(db.statements(), [
+            "acquire", "SELECT account_profiles", "REPLACE account_profiles", "commit", "release"])
+
+    def accounts_db(self):
+        return FakeDatabase(results={"SELECT account_profiles": [
+            dict(TransactionsTestCase.PROFILE, account_id=1),
+            dict(TransactionsTestCase.PROFILE, account_id=2)
+        ]})
+
+    async def test_apply(self):
+        db = self.accounts_db()
+
+        results = await UserProfiles(db, 1, [1, 2]).apply(
+            [(0, "1", {"gold": 50}, None, True)],
+            [(0, "2", ["gold"], ">=", 100)])
+
+        self.assertEqual(results[0]["gold"], 50)
+        self.assertEqual(db.statements(), [
+            "acquire", "SELECT account_profiles", "REPLACE account_profiles", "commit", "release"])
+
+    async def test_apply_precondition(self):
+        db = self.accounts_db()
+
+        with self.assertRaises(ProfilePreconditionError):
+            await UserProfiles(db, 1, [1, 2]).apply(
+                [(0, "1", {"gold": 50}, None, True)],
+                [(0, "2", ["gold"], ">=", 1000)])
+
+        # the profiles locked are released at once
+        self.assertEqual(db.statements(), ["acquire", "SELECT account_profiles", "rollback", "release"])
+
+    async def test_apply_atomic(self):
+        db = self.accounts_db()
+
+        with self.assertRaises(ProfileError):
+            await UserProfiles(db, 1, [1, 2]).apply([
+                (0, "1", {"gold": 50}, None, True),
+                (1, "2", {"gold": {"@func": "--", "@value": "all"}}, None, True)
+            ], atomic=True)
+
+        self.assertEqual(db.statements(), ["acquire", "SELECT account_profiles", "rollback", "release"])